@@ -21,6 +21,7 @@ setup(
         'console_scripts': [
             'tbh-setup = trust_boundary_hooks.cli:tbh_setup',
             'tbh-hook-pre-push = trust_boundary_hooks.cli:tbh_hook_pre_push',
+            'tbh-hook-pre-receive = trust_boundary_hooks.cli:tbh_hook_pre_receive',
             'tbh-hook-pre-commit = trust_boundary_hooks.cli:tbh_hook_pre_commit',
             'tbh-hook-commit-msg = trust_boundary_hooks.cli:tbh_hook_commit_msg',
             'tbh-utils = trust_boundary_hooks.cli:tbh_utils',
@@ -0,0 +1,79 @@
+import os
+import subprocess
+from typing import Callable, Dict, Iterator, Union
+import keyring
+import pytest
+from file_keyring import FileKeyring
+
+TESTS_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+class GitRepo:
+    """ A scratch git repository to commit test content to """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def git(self, *args: str) -> str:
+        return subprocess.check_output(["git", *args], cwd=self.path).decode('utf-8').strip()
+
+    def write(self, files: Dict[str, Union[str, bytes]]) -> None:
+        for name, content in files.items():
+            path = os.path.join(self.path, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(content if isinstance(content, bytes) else content.encode('utf-8'))
+
+    def commit(self, files: Dict[str, Union[str, bytes]], message: str = "Change") -> str:
+        self.write(files)
+        self.git("add", "-A")
+        self.git("commit", "-q", "--allow-empty", "-m", message)
+        return self.git("rev-parse", "HEAD")
+
+
+def _init_repo(path: str, bare: bool = False) -> GitRepo:
+    os.makedirs(path, exist_ok=True)
+    subprocess.check_call(["git", "init", "-q", "-b", "main"] + (["--bare"] if bare else []), cwd=path)
+    return GitRepo(path)
+
+
+@pytest.fixture
+def git_env(monkeypatch, tmp_path) -> None:
+    """ Git run without the user's configuration, as a fixed identity """
+    monkeypatch.setenv("GIT_CONFIG_GLOBAL", os.devnull)
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+    for role in ("AUTHOR", "COMMITTER"):
+        monkeypatch.setenv(f"GIT_{role}_NAME", "Test")
+        monkeypatch.setenv(f"GIT_{role}_EMAIL", "test@example.org")
+
+
+@pytest.fixture
+def make_repo(git_env, tmp_path) -> Callable[..., GitRepo]:
+    """ Makes scratch repositories, at paths relative to the test's directory """
+    return lambda name, bare=False: _init_repo(str(tmp_path / name), bare=bare)
+
+
+@pytest.fixture
+def repo(make_repo, monkeypatch) -> GitRepo:
+    """ A scratch repository, made the working directory as hooks run in it """
+    repo = make_repo("repo")
+    monkeypatch.chdir(repo.path)
+    return repo
+
+
+@pytest.fixture
+def home(monkeypatch, tmp_path) -> Iterator[str]:
+    """ A home directory of the test's own, for the files kept there, with a keyring and no key agent """
+    path = str(tmp_path / "home")
+    os.makedirs(path)
+    monkeypatch.setenv("HOME", path)
+    monkeypatch.setenv("TBH_AGENT_SOCK", os.path.join(path, "no-agent.sock"))
+    monkeypatch.setenv("TBH_DAEMON_SOCK", os.path.join(path, "no-daemon.sock"))
+    # Hooks run as subprocesses use the same keyring
+    monkeypatch.setenv("PYTHON_KEYRING_BACKEND", "file_keyring.FileKeyring")
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join(filter(None, [TESTS_PATH, os.environ.get("PYTHONPATH")])))
+    previous = keyring.get_keyring()
+    keyring.set_keyring(FileKeyring())
+    keyring.set_password("tbh-cli", "minio_secret_key", "secret")
+    yield path
+    keyring.set_keyring(previous)
@@ -0,0 +1,36 @@
+import os
+import json
+from typing import Dict, Optional
+import keyring.backend
+
+
+class FileKeyring(keyring.backend.KeyringBackend):
+    """ A keyring kept in a file of the test's home directory, so hooks run as subprocesses share it """
+
+    priority = 1
+
+    @property
+    def _path(self) -> str:
+        return os.path.expanduser("~/.test_keyring")
+
+    def _read(self) -> Dict[str, str]:
+        try:
+            with open(self._path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def get_password(self, service: str, username: str) -> Optional[str]:
+        return self._read().get(f"{service}/{username}")
+
+    def set_password(self, service: str, username: str, password: str) -> None:
+        passwords = self._read()
+        passwords[f"{service}/{username}"] = password
+        with open(self._path, "w") as f:
+            json.dump(passwords, f)
+
+    def delete_password(self, service: str, username: str) -> None:
+        passwords = self._read()
+        passwords.pop(f"{service}/{username}", None)
+        with open(self._path, "w") as f:
+            json.dump(passwords, f)
@@ -0,0 +1,66 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from typing import Iterator
+import keyring
+import pytest
+from trust_boundary_hooks.agent import Agent, get_secret
+from trust_boundary_hooks.crypto import Crypto
+
+
+@pytest.fixture
+def agent_path(home, monkeypatch) -> Iterator[str]:
+    # Unix socket paths are short, too short for pytest's temporary directories
+    directory = tempfile.mkdtemp(prefix="tbh")
+    path = os.path.join(directory, "agent.sock")
+    monkeypatch.setenv("TBH_AGENT_SOCK", path)
+    keyring.set_password(Crypto.SERVICE_NAME, Crypto.DAR_KEY_NAME, "from-keyring")
+    yield path
+    Agent(path).stop()
+    shutil.rmtree(directory)
+
+
+def _serve(path: str, ttl: float) -> threading.Thread:
+    thread = threading.Thread(target=Agent(path).serve, args=({Crypto.DAR_KEY_NAME: "from-agent"}, ttl), daemon=True)
+    thread.start()
+    deadline = time.time() + 10
+    while Agent(path).status() is None:
+        assert time.time() < deadline and thread.is_alive()
+        time.sleep(0.01)
+    return thread
+
+
+def test_password_from_agent_while_it_runs(agent_path) -> None:
+    _serve(agent_path, ttl=60)
+    assert 0 < Agent(agent_path).status() <= 60
+    assert get_secret(Crypto.DAR_KEY_NAME) == "from-agent"
+    assert get_secret("unknown") is None
+    assert Crypto().dar_password == "from-agent"
+
+
+def test_password_from_keyring_once_agent_expires(agent_path) -> None:
+    thread = _serve(agent_path, ttl=0.5)
+    assert Crypto().dar_password == "from-agent"
+    thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert not os.path.exists(agent_path)
+    assert Agent(agent_path).status() is None
+    assert get_secret(Crypto.DAR_KEY_NAME) is None
+    assert Crypto().dar_password == "from-keyring"
+
+
+def test_password_from_keyring_when_agent_is_stopped(agent_path) -> None:
+    thread = _serve(agent_path, ttl=60)
+    assert Agent(agent_path).stop()
+    thread.join(timeout=10)
+    assert Crypto().dar_password == "from-keyring"
+
+
+def test_password_from_keyring_with_a_stale_socket(agent_path) -> None:
+    # Left behind by an agent that was killed
+    with open(agent_path, "w"):
+        pass
+    assert get_secret(Crypto.DAR_KEY_NAME) is None
+    assert Crypto().dar_password == "from-keyring"
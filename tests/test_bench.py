@@ -0,0 +1,52 @@
+import json
+import random
+import pytest
+from trust_boundary_hooks import bench
+from trust_boundary_hooks.bench import BenchConfig, build_repository, generate_symbols, report
+
+TINY = BenchConfig(commits=3, files=8, file_size=512, changes_per_commit=2, staged_files=2, symbols=20, jobs=1)
+
+
+@pytest.fixture
+def tiny_repository(git_env, tmp_path) -> str:
+    path = str(tmp_path / "repository")
+    build_repository(path, TINY)
+    return path
+
+
+def _symbols() -> tuple:
+    return generate_symbols(TINY.symbols, TINY.regex_ratio, random.Random(TINY.seed))
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_case_runs_and_reports_memory(tiny_repository, jobs: int) -> None:
+    result = bench._measure(tiny_repository, _symbols(), jobs, "pre_push_hook", scanned_bytes=1024)
+    assert result.name == "pre_push_hook"
+    assert result.wall_seconds > 0 and result.mb_per_second > 0
+    assert result.peak_rss_kb > 0
+    # git, and with more than one job the pool's workers
+    assert result.children_peak_rss_kb > 0
+
+
+def test_report_includes_worker_memory(capsys) -> None:
+    results = [bench.BenchResult(name="scan", wall_seconds=2.0, scanned_bytes=1024 * 1024, peak_rss_kb=2048, children_peak_rss_kb=4096)]
+    report(results, as_json=True)
+    assert json.loads(capsys.readouterr().out) == [{
+        "name": "scan", "wall_seconds": 2.0, "scanned_bytes": 1024 * 1024, "peak_rss_kb": 2048,
+        "children_peak_rss_kb": 4096, "mb_per_second": 0.5,
+    }]
+    report(results)
+    assert capsys.readouterr().out.splitlines()[1].split()[-2:] == ["2.0", "4.0"]
+
+
+def test_case_exiting_before_reporting_fails(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(bench, "_POLL_SECONDS", 0.1)
+    # The case's process dies before it can report, as one killed for running out of memory would
+    missing = str(tmp_path / "missing")
+    with pytest.raises(RuntimeError, match="exited with code 1 before reporting"):
+        bench._measure(missing, _symbols(), 1, "scan", scanned_bytes=0)
+
+
+def test_failing_case_reports_its_error(tiny_repository) -> None:
+    with pytest.raises(RuntimeError, match="failed: ValueError: Unknown benchmark case 'nothing'"):
+        bench._measure(tiny_repository, _symbols(), 1, "nothing", scanned_bytes=0)
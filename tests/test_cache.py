@@ -0,0 +1,34 @@
+import os
+from trust_boundary_hooks.cache import ScanCache
+
+
+def _count(cache: ScanCache) -> int:
+    return cache._connect().execute("SELECT COUNT(*) FROM clean").fetchone()[0]
+
+
+def test_mark_clean_and_lookup(tmp_path) -> None:
+    cache = ScanCache(path=os.path.join(tmp_path, "cache"), digest="d1")
+    cache.mark_clean(["a", "b"])
+    assert cache.unknown_objects(["a", "b", "c"]) == ["c"]
+    other = ScanCache(path=os.path.join(tmp_path, "cache"), digest="d2")
+    assert other.unknown_objects(["a"]) == ["a"]
+
+
+def test_evicts_least_recently_used(tmp_path) -> None:
+    cache = ScanCache(path=os.path.join(tmp_path, "cache"), digest="d", max_entries=10)
+    cache.mark_clean(f"o{i}" for i in range(10))
+    assert cache.is_clean("o0")
+    cache._connect().execute("UPDATE clean SET last_used = last_used - 10 WHERE object != 'o0'")
+    cache.mark_clean(f"n{i}" for i in range(5))
+    assert _count(cache) == 10
+    assert cache.is_clean("o0")
+    assert cache.unknown_objects([f"o{i}" for i in range(1, 5)]) == [f"o{i}" for i in range(1, 5)]
+
+
+def test_counts_entries_once_per_interval(tmp_path) -> None:
+    cache = ScanCache(path=os.path.join(tmp_path, "cache"), digest="d", max_entries=1000)
+    interval = 1000 // ScanCache.EVICTION_CHECKS
+    for i in range(1500):
+        cache.mark_clean([f"o{i}"])
+        assert _count(cache) <= 1000 + interval
+    assert _count(cache) >= 1000
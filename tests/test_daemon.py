@@ -0,0 +1,106 @@
+import os
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+from typing import Iterator, Tuple
+import pytest
+from trust_boundary_hooks import daemon
+from trust_boundary_hooks.crypto import Crypto
+from trust_boundary_hooks.daemon import Daemon, run_in_daemon
+from trust_boundary_hooks.template import Template
+
+
+@pytest.fixture
+def socket_dir() -> Iterator[str]:
+    # Unix socket paths are short, too short for pytest's temporary directories
+    path = tempfile.mkdtemp(prefix="tbh")
+    yield path
+    shutil.rmtree(path)
+
+
+@pytest.fixture
+def bad_symbols(home) -> None:
+    with open(Template().bad_symbols_path, "w") as f:
+        f.write(Crypto().encrypt("codename\nproject\\s+falcon\n"))
+
+
+@pytest.fixture
+def running_daemon(bad_symbols, socket_dir, monkeypatch) -> Iterator[str]:
+    path = os.path.join(socket_dir, "daemon.sock")
+    monkeypatch.setenv("TBH_DAEMON_SOCK", path)
+    Daemon(path).start()
+    yield path
+    Daemon(path).stop()
+    deadline = time.time() + 10
+    while os.path.exists(path) and time.time() < deadline:
+        time.sleep(0.05)
+
+
+def _run_hook(*args: str, in_process: bool, **env: str) -> Tuple[int, str]:
+    """ Runs a hook as git does, with its output and errors written to one pipe """
+    env = dict(os.environ, **env)
+    env.pop("TBH_NO_DAEMON", None)
+    if in_process:
+        env["TBH_NO_DAEMON"] = "1"
+    result = subprocess.run(list(args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, timeout=60)
+    return result.returncode, result.stdout.decode('utf-8')
+
+
+@pytest.mark.parametrize("message", ["A clean change", "Mention the codename", "Project  Falcon\n\nand codename"])
+def test_commit_msg_hook_same_in_daemon(running_daemon, tmp_path, message: str) -> None:
+    message_file = tmp_path / "COMMIT_EDITMSG"
+    message_file.write_text(message)
+    in_process = _run_hook("tbh-hook-commit-msg", str(message_file), in_process=True)
+    assert _run_hook("tbh-hook-commit-msg", str(message_file), in_process=False) == in_process
+    assert in_process[0] == (0 if message == "A clean change" else 1)
+
+
+@pytest.mark.parametrize("files", [{"clean.txt": "nothing\n"}, {"notes.txt": "a\ncodename\n", "codename.txt": "b\n"}])
+def test_pre_commit_hook_same_in_daemon(running_daemon, repo, files: dict) -> None:
+    repo.write(files)
+    repo.git("add", "-A")
+    in_process = _run_hook("tbh-hook-pre-commit", "--verbose", in_process=True)
+    assert _run_hook("tbh-hook-pre-commit", "--verbose", in_process=False) == in_process
+    assert in_process[0] == (1 if "codename.txt" in files else 0)
+
+
+def test_hook_runs_in_daemon(running_daemon, tmp_path) -> None:
+    message_file = tmp_path / "COMMIT_EDITMSG"
+    message_file.write_text("Mention the codename")
+    # The daemon has the bad symbols loaded already, so the hook doesn't need the keyring
+    no_keyring = {"PYTHON_KEYRING_BACKEND": "keyring.backends.fail.Keyring"}
+    exit_code, output = _run_hook("tbh-hook-commit-msg", str(message_file), in_process=False, **no_keyring)
+    assert exit_code == 1
+    assert "Detections: 'codename'" in output
+    assert "Detections: 'codename'" not in _run_hook("tbh-hook-commit-msg", str(message_file), in_process=True, **no_keyring)[1]
+
+
+def test_hook_runs_in_process_without_daemon(bad_symbols, tmp_path, socket_dir, monkeypatch) -> None:
+    monkeypatch.setenv("TBH_DAEMON_SOCK", os.path.join(socket_dir, "none.sock"))
+    message_file = tmp_path / "COMMIT_EDITMSG"
+    message_file.write_text("Mention the codename")
+    exit_code, output = _run_hook("tbh-hook-commit-msg", str(message_file), in_process=False)
+    assert exit_code == 1
+    assert "Detections: 'codename'" in output
+
+
+def test_wedged_daemon_is_given_up_on(socket_dir, monkeypatch, caplog) -> None:
+    path = os.path.join(socket_dir, "wedged.sock")
+    monkeypatch.setenv("TBH_DAEMON_SOCK", path)
+    monkeypatch.delenv("TBH_NO_DAEMON", raising=False)
+    monkeypatch.setattr(daemon, "RESPONSE_TIMEOUT", 0.2)
+    # Listening, so connecting succeeds, but never answering
+    umask = os.umask(0o177)
+    try:
+        wedged = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        wedged.bind(path)
+    finally:
+        os.umask(umask)
+    with wedged:
+        wedged.listen(1)
+        started = time.time()
+        assert run_in_daemon("tbh-hook-commit-msg", "tbh-hook-commit-msg", ["message"]) is None
+        assert time.time() - started < 5
+    assert "running it in process" in caplog.text
@@ -0,0 +1,86 @@
+import os
+import pytest
+from conftest import GitRepo
+from trust_boundary_hooks.cache import ScanCache
+from trust_boundary_hooks.fleet import FleetScan, find_repositories
+from trust_boundary_hooks.ops import Operations
+from trust_boundary_hooks.scan import Scanner
+
+
+@pytest.fixture
+def clones(make_repo, tmp_path) -> tuple:
+    """ Two clones of one repository, the second with a commit of its own """
+    upstream = make_repo("upstream")
+    upstream.commit({"README": "start\n"}, "Start")
+    upstream.commit({"notes.txt": "a codename here\n"}, "Add notes")
+    paths = []
+    for name in ("one", "two"):
+        paths.append(str(tmp_path / name))
+        upstream.git("clone", "-q", upstream.path, paths[-1])
+    GitRepo(paths[1]).commit({"more.txt": "project falcon\n"}, "Add more")
+    return paths[0], paths[1]
+
+
+def _fleet_scan(tmp_path, repos: list, history_mode: str) -> FleetScan:
+    scanner = Scanner(symbols=("codename", "project\\s+falcon"))
+    cache = ScanCache(path=str(tmp_path / f"cache-{history_mode}"), digest=scanner.digest)
+    fleet = FleetScan(repos, jobs=1, scanner=scanner, cache=cache, history_mode=history_mode)
+    fleet.scan()
+    return fleet
+
+
+@pytest.mark.parametrize("history_mode", Operations.HISTORY_MODES)
+def test_shared_history_scanned_once_reported_for_each_clone(clones, tmp_path, history_mode: str) -> None:
+    one, two = clones
+    fleet = _fleet_scan(tmp_path, [one, two], history_mode)
+
+    summaries = {s.repo: s for s in fleet.summaries}
+    assert summaries[one].scanned == summaries[one].listed
+    # Only what the second clone adds is scanned in it
+    assert 0 < summaries[two].scanned < summaries[two].listed
+    assert summaries[two].listed - summaries[two].scanned == summaries[one].listed
+
+    contexts = [r.context for r in fleet._scanner.scan_runs]
+    assert len([c for c in contexts if c.endswith(f" in {one}, {two}")]) == 1
+    assert len([c for c in contexts if c.endswith(f" in {two}")]) == 1
+    assert len(contexts) == 2
+    assert summaries[one].detections == 1
+    assert summaries[two].detections == 2
+
+
+def test_clean_history_not_scanned_again(clones, tmp_path) -> None:
+    one, two = clones
+    fleet = _fleet_scan(tmp_path, [one], Operations.HISTORY_LOG)
+    assert fleet.summaries[0].scanned == 2
+    fleet = _fleet_scan(tmp_path, [one, two], Operations.HISTORY_LOG)
+    # The commit adding notes.txt had a detection, so only it and the second clone's own are scanned
+    assert [s.scanned for s in fleet.summaries] == [1, 1]
+
+
+def test_working_trees_scanned_in_each_clone(clones, tmp_path) -> None:
+    one, two = clones
+    with open(os.path.join(one, "untracked.txt"), "w") as f:
+        f.write("codename\n")
+    fleet = _fleet_scan(tmp_path, [one, two], Operations.HISTORY_LOG)
+    assert f"FileContent(untracked.txt) in {one}" in [r.context for r in fleet._scanner.scan_runs]
+    assert [s.detections for s in fleet.summaries] == [2, 2]
+
+
+def test_find_repositories(make_repo, tmp_path) -> None:
+    root = tmp_path / "root"
+    first = make_repo("root/a")
+    make_repo("root/a/nested")
+    second = make_repo("root/group/b")
+    bare = make_repo("root/bare.git", bare=True)
+    os.makedirs(root / "plain" / "dir")
+    os.symlink(second.path, tmp_path / "link")
+    listed = make_repo("elsewhere")
+
+    assert find_repositories([str(root)]) == [first.path, bare.path, second.path]
+
+    list_file = tmp_path / "repos.txt"
+    list_file.write_text(f"# Repositories\n\n{listed.path}\n{tmp_path / 'link'}\n{root / 'a' / 'nested'}\n")
+    # Each repository once, whichever way it is reached; nested repositories only when listed
+    assert find_repositories([str(root), str(list_file)]) == [
+        first.path, bare.path, second.path, listed.path, str(root / "a" / "nested"),
+    ]
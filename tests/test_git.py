@@ -0,0 +1,120 @@
+import subprocess
+import pytest
+from trust_boundary_hooks import git
+
+
+def test_log_records_of_large_commits_overlap(repo) -> None:
+    small = repo.commit({"small.txt": "small\n"})
+    large = repo.commit({"large.txt": "".join(f"line {i}\n" for i in range(200))})
+    records = list(git.iter_log_records([small, large], chunk_size=500, overlap=100))
+
+    by_commit = {}
+    for record in records:
+        text = by_commit.get(record.commit, "")
+        assert record.start <= len(text)
+        assert text[record.start:] == record.text[:len(text) - record.start]
+        by_commit[record.commit] = text[:record.start] + record.text
+    for commit in (small, large):
+        assert by_commit[commit].rstrip("\n") == repo.git("log", "-p", "--no-walk", commit)
+    assert [r.start for r in records if r.commit == small] == [0]
+    assert len([r for r in records if r.commit == large]) > 2
+
+
+def test_staged_changes(repo) -> None:
+    repo.commit({"gone.txt": "old\n", "moved.txt": "keep\nme\n", "edited.txt": "one\ntwo\nthree\n"})
+    repo.git("rm", "-q", "gone.txt")
+    repo.git("mv", "moved.txt", "new name.txt")
+    repo.write({
+        "edited.txt": "one\n2\nthree\nfour\n",
+        "line\nbreak.txt": "x\n",
+        "tab\té.txt": "é codename\n",
+        "data.bin": b"\0\1codename",
+    })
+    repo.git("add", "-A")
+    changes = {c.path: c for c in git.staged_changes()}
+
+    # Deletions are left out, renames are the new path added whole
+    assert sorted(changes) == ["data.bin", "edited.txt", "line\nbreak.txt", "new name.txt", "tab\té.txt"]
+    assert changes["new name.txt"].hunks == [git.Hunk(start=1, lines=[b"keep", b"me"])]
+    assert changes["edited.txt"].hunks == [git.Hunk(start=2, lines=[b"2"]), git.Hunk(start=4, lines=[b"four"])]
+    assert changes["line\nbreak.txt"].hunks == [git.Hunk(start=1, lines=[b"x"])]
+    assert changes["tab\té.txt"].hunks == [git.Hunk(start=1, lines=["é codename".encode('utf-8')])]
+    assert changes["data.bin"].binary and changes["data.bin"].hunks == []
+    assert not any(c.binary for p, c in changes.items() if p != "data.bin")
+    for path, change in changes.items():
+        assert change.blob == repo.git("rev-parse", f":{path}")
+    assert [f.path for f in git.staged_files()] == [c.path for c in git.staged_changes()]
+
+
+PATCH = (
+    "commit 1111\n"
+    "\n"
+    "    Add codename\n"
+    "\n"
+    "diff --git a/codename.txt b/codename.txt\n"
+    "new file mode 100644\n"
+    "--- /dev/null\n"
+    "+++ b/codename.txt\n"
+    "@@ -0,0 +1,2 @@\n"
+    "+first\n"
+    "+codename\n"
+    "diff --git a/codename.bin b/codename.bin\n"
+    "Binary files /dev/null and b/codename.bin differ\n"
+)
+
+
+@pytest.mark.parametrize("line, start, location", [
+    ("    Add codename", 0, (None, None)),
+    ("diff --git a/codename.txt b/codename.txt", 0, ("codename.txt", None)),
+    ("diff --git a/codename.txt b/codename.txt", 13, ("codename.txt", None)),
+    ("+++ b/codename.txt", 0, ("codename.txt", None)),
+    ("+++ b/codename.txt", 6, ("codename.txt", None)),
+    ("+codename", 1, ("codename.txt", 2)),
+    ("diff --git a/codename.bin b/codename.bin", 0, ("codename.bin", None)),
+    ("Binary files /dev/null and b/codename.bin differ", 29, ("codename.bin", None)),
+])
+def test_patch_location(line: str, start: int, location: tuple) -> None:
+    assert git.patch_location(PATCH, PATCH.index(line + "\n") + start) == location
+
+
+def test_patch_location_in_chunk_starting_at_header() -> None:
+    chunk = PATCH[PATCH.index("diff --git a/codename.bin"):]
+    assert git.patch_location(chunk, 0) == ("codename.bin", None)
+    assert git.patch_location(chunk, chunk.index("codename")) == ("codename.bin", None)
+
+
+def test_rev_list_objects(repo) -> None:
+    first = repo.commit({"a.txt": "same\n", "dir/b c.txt": "b\n"})
+    second = repo.commit({"copy.txt": "same\n"})
+    objects = git.rev_list_objects([second])
+    shas = [o.sha for o in objects]
+    assert len(shas) == len(set(shas))
+    paths = {o.sha: o.path for o in objects}
+    assert paths[second] == paths[first] == paths[repo.git("rev-parse", f"{second}^{{tree}}")] == ""
+    assert paths[repo.git("rev-parse", f"{first}:dir")] == "dir"
+    assert paths[repo.git("rev-parse", f"{first}:dir/b c.txt")] == "dir/b c.txt"
+    # A blob reachable by two paths is listed once, by the first
+    assert paths[repo.git("rev-parse", f"{second}:copy.txt")] in ("a.txt", "copy.txt")
+    assert [o.sha for o in git.rev_list_objects([second, f"^{first}"])] == [second, repo.git("rev-parse", f"{second}^{{tree}}")]
+
+
+@pytest.mark.parametrize("batch", [1, git.FIND_OBJECTS_BATCH])
+def test_introducing_commits(repo, monkeypatch, batch: int) -> None:
+    monkeypatch.setattr(git, "FIND_OBJECTS_BATCH", batch)
+    added = repo.commit({"secret.txt": "codename\n", "dir/x.txt": "x\n"})
+    repo.commit({"other.txt": "other\n"})
+    repo.git("rm", "-q", "secret.txt")
+    removed = repo.commit({}, "Remove")
+    added_again = repo.commit({"again.txt": "codename\n"})
+    blob = repo.git("rev-parse", f"{added}:secret.txt")
+    tree = repo.git("rev-parse", f"{added}:dir")
+    root = repo.git("rev-parse", f"{removed}^{{tree}}")
+    missing = "1" * 40
+
+    introduced = git.introducing_commits([blob, tree, blob, root, missing], ["--all"])
+    assert sorted(introduced[blob]) == sorted([added, removed, added_again])
+    assert introduced[tree] == [added]
+    assert introduced[root] == [removed]
+    assert missing not in introduced
+    # Limited to the history of the revisions
+    assert git.introducing_commits([blob], [removed]) == {blob: [removed, added]}
@@ -0,0 +1,56 @@
+import pytest
+from trust_boundary_hooks import lint
+from trust_boundary_hooks.lint import MAX_GROWTH_EXPONENT, adversarial_inputs, lint_symbol, lint_symbols
+
+
+@pytest.mark.parametrize("symbol", [r"(a+)+b", r"(x|xx)+y", r"(\w+\s?)+$"])
+def test_catastrophic_backtracking_is_reported(monkeypatch, symbol: str) -> None:
+    # They run to the timeout, so keep it short
+    monkeypatch.setattr(lint, "LINT_TIMEOUT", 0.2)
+    result = lint_symbol(symbol)
+    assert result.timed_out and not result.ok
+    assert "catastrophic backtracking" in result.problem
+
+
+@pytest.mark.parametrize("symbol", [r"\s*x\s*$", r"[a-z]+_secret"])
+def test_quadratic_growth_is_reported(symbol: str) -> None:
+    result = lint_symbol(symbol)
+    assert not result.timed_out and not result.ok
+    assert result.exponent > MAX_GROWTH_EXPONENT
+    assert "grows with input length" in result.problem
+
+
+@pytest.mark.parametrize("symbol", [
+    r"project\s+falcon",
+    r"code-?name",
+    r"foo(bar|baz)",
+    r"\bcodename\b",
+    r"[0-9]{4}-[0-9]{4}",
+    r"secret_[a-z]{3,8}",
+])
+def test_safe_patterns_are_not_reported(symbol: str) -> None:
+    # Timing noise must not make a safe pattern fail, so each is tried a few times
+    for _ in range(5):
+        result = lint_symbol(symbol)
+        assert result.ok, result.problem
+        assert result.problem == ""
+
+
+def test_uncompilable_pattern_is_reported() -> None:
+    result = lint_symbol("(unclosed")
+    assert not result.ok
+    assert result.problem.startswith("does not compile")
+
+
+def test_corpora_are_searched() -> None:
+    assert lint_symbol(r"project\s+falcon", corpora=["some text\n" * 10000]).corpus_seconds > 0
+
+
+def test_only_regexes_are_linted() -> None:
+    assert [r.symbol for r in lint_symbols(("codename", r"project\s+falcon", "plain words"))] == [r"project\s+falcon"]
+
+
+def test_adversarial_inputs_fail_to_match_at_the_end() -> None:
+    inputs = adversarial_inputs(r"(\w+\s?)+$", 16)
+    assert "a" * 16 + "\0" in inputs
+    assert all(len(value) == 17 and value.endswith("\0") for value in inputs)
@@ -0,0 +1,197 @@
+import os
+import time
+import logging
+import pytest
+from trust_boundary_hooks import errors, git
+from trust_boundary_hooks.cache import ScanCache
+from trust_boundary_hooks.crypto import Crypto
+from trust_boundary_hooks.ops import RACY_WINDOW_NS, STAT_CACHE_NAME, Operations, PushRef, parse_push_refs, scan_log_shard
+from trust_boundary_hooks.scan import DEFAULT_MAX_DETECTIONS, FirstDetection, Scanner
+from trust_boundary_hooks.symbol_index import SymbolIndex
+from trust_boundary_hooks.template import Template
+
+
+def _operations(tmp_path, history_mode: str, symbols: tuple, scopes: tuple = None) -> Operations:
+    scanner = Scanner(index=SymbolIndex.build(symbols, scopes))
+    cache = ScanCache(path=os.path.join(tmp_path, f"cache-{history_mode}"), digest=scanner.digest)
+    return Operations(jobs=1, scanner=scanner, cache=cache, history_mode=history_mode)
+
+
+def _history_detections(tmp_path, history_mode: str, symbols: tuple, scopes: tuple = None) -> tuple:
+    operations = _operations(tmp_path, history_mode, symbols, scopes)
+    operations.scan_git_history()
+    return operations._scanner.detections
+
+
+@pytest.mark.parametrize("files, message", [
+    ({"notes.txt": "a codename here\n"}, "Add notes"),
+    ({"codename.txt": "nothing\n"}, "Add a file"),
+    ({"notes.txt": "nothing\n"}, "Mention the codename"),
+])
+def test_history_modes_find_history_scoped_symbols(repo, tmp_path, files: dict, message: str) -> None:
+    repo.commit({"README": "start\n"}, "Start")
+    repo.commit(files, message)
+    symbols = ("codename", "nobody")
+    scopes = (("history", ), ("metadata", ))
+    log = _history_detections(tmp_path, Operations.HISTORY_LOG, symbols, scopes)
+    objects = _history_detections(tmp_path, Operations.HISTORY_OBJECTS, symbols, scopes)
+    assert log == objects == ("codename", )
+
+
+def test_objects_mode_searches_blobs_found_clean_as_files(repo, tmp_path) -> None:
+    repo.commit({"notes.txt": "a codename here\n"})
+    blob = repo.git("rev-parse", "HEAD:notes.txt")
+    operations = _operations(tmp_path, Operations.HISTORY_OBJECTS, ("codename", ), (("history", ), ))
+    # As a file, the blob isn't searched for symbols limited to history
+    operations._cache.mark_clean([blob])
+    operations.scan_git_history()
+    assert operations._scanner.detections == ("codename", )
+
+
+def test_objects_mode_reports_introducing_commits(repo, tmp_path) -> None:
+    added = repo.commit({"notes.txt": "a codename here\n", "codename/readme.txt": "clean\n"}, "Add notes")
+    copied = repo.commit({"copy.txt": "a codename here\n"}, "Copy notes")
+    message = repo.commit({"clean.txt": "clean\n"}, "Mention the codename")
+    blob = repo.git("rev-parse", f"{added}:notes.txt")
+    roots = {c: repo.git("rev-parse", f"{c}^{{tree}}") for c in (added, copied, message)}
+
+    operations = _operations(tmp_path, Operations.HISTORY_OBJECTS, ("codename", ))
+    operations.scan_git_history()
+    contexts = {r.context for r in operations._scanner.scan_runs}
+    # The blob is found once, though two commits add it
+    assert {c for c in contexts if c.startswith("GitBlob(")} in (
+        {f"GitBlob(notes.txt {blob} introduced in {copied} {added})"},
+        {f"GitBlob(copy.txt {blob} introduced in {copied} {added})"},
+    )
+    # Each root tree has the "codename" directory in it
+    for commit, root in roots.items():
+        assert f"GitTree(/ {root} introduced in {commit})" in contexts
+    assert f"GitCommit({message})" in contexts
+    assert len(contexts) == 5
+
+
+def test_objects_mode_logs_bytes_read(repo, tmp_path, caplog) -> None:
+    repo.commit({"notes.txt": "clean\n", "dir/more.txt": "more\n"})
+    repo.commit({"notes.txt": "changed\n"})
+    objects = git.rev_list_objects(["--all"])
+    size = sum(int(repo.git("cat-file", "-s", o.sha)) for o in objects)
+
+    caplog.set_level(logging.DEBUG, logger="trust_boundary_hooks.ops")
+    _operations(tmp_path, Operations.HISTORY_OBJECTS, ("codename", )).scan_git_history()
+    assert f"History size = {size} bytes in {len(objects)} object(s)" in caplog.text
+
+
+NULL_SHA = "0" * 40
+
+
+def test_parse_push_refs() -> None:
+    refs = parse_push_refs(["refs/heads/main 1111 refs/heads/main 2222\n", "\n", f"(delete) {NULL_SHA} refs/heads/old 3333\n"])
+    assert refs == [
+        PushRef("refs/heads/main", "1111", "refs/heads/main", "2222"),
+        PushRef("(delete)", NULL_SHA, "refs/heads/old", "3333"),
+    ]
+    assert not refs[0].is_deletion and not refs[0].is_new_branch
+    assert refs[1].is_deletion
+    with pytest.raises(RuntimeError):
+        parse_push_refs(["refs/heads/main 1111 refs/heads/main"])
+
+
+def _push_ref(local_sha: str, remote_sha: str) -> PushRef:
+    return PushRef("refs/heads/main", local_sha, "refs/heads/main", remote_sha)
+
+
+def test_push_revisions(repo, tmp_path) -> None:
+    first = repo.commit({"a.txt": "a\n"})
+    second = repo.commit({"b.txt": "b\n"})
+    operations = _operations(tmp_path, Operations.HISTORY_LOG, ("codename", ))
+    # An update of a branch the remote has
+    assert operations._push_revisions([_push_ref(second, first)]) == [second, f"^{first}"]
+    # A new branch, or one whose remote commit isn't here: only commits on no remote branch
+    assert operations._push_revisions([_push_ref(second, NULL_SHA)]) == [second, "--not", "--remotes"]
+    assert operations._push_revisions([_push_ref(second, "1" * 40)]) == [second, "--not", "--remotes"]
+    # A deletion pushes nothing
+    assert operations._push_revisions([_push_ref(NULL_SHA, first)]) == []
+    assert operations._push_revisions([_push_ref(NULL_SHA, first), _push_ref(second, first)]) == [second, f"^{first}"]
+
+
+@pytest.mark.parametrize("full", [False, True])
+def test_pre_push_scans_only_pushed_commits(repo, tmp_path, full: bool) -> None:
+    pushed_before = repo.commit({"a.txt": "a codename\n"})
+    pushing = repo.commit({"b.txt": "b\n"})
+    operations = _operations(tmp_path, Operations.HISTORY_LOG, ("codename", ))
+    if full:
+        with pytest.raises(errors.BadSymbolsDetectedError):
+            operations.pre_push_hook([_push_ref(pushing, pushed_before)], full=True)
+    else:
+        operations.pre_push_hook([_push_ref(pushing, pushed_before)])
+
+
+def test_log_shard_reports_matches_in_chunk_overlaps_once(repo, tmp_path, monkeypatch) -> None:
+    commit = repo.commit({"large.txt": "".join(f"line {i} codename\n" for i in range(1, 201))})
+    iter_log_records = git.iter_log_records
+    monkeypatch.setattr(git, "iter_log_records", lambda commits: iter_log_records(commits, chunk_size=500, overlap=200))
+    scanner = Scanner(symbols=("codename", ))
+    result = scan_log_shard(scanner, None, [commit])
+    assert [d.sha for d in result.found] == [commit]
+    detections = result.found[0].detections
+    assert len(detections) == 200
+    # Matches in a chunk cut off from the file's header have no location (see git.patch_location)
+    lines = [d.line for d in detections if d.line is not None]
+    assert len(lines) == len(set(lines))
+
+
+def _rewrite_keeping_stat(path: str, content: str) -> None:
+    """ Changes a file in place, leaving its size, mtime and inode as they were """
+    st = os.stat(path)
+    with open(path, "r+") as f:
+        assert len(content) == st.st_size
+        f.write(content)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def _scan_untracked(tmp_path) -> tuple:
+    operations = _operations(tmp_path, Operations.HISTORY_LOG, ("codename", ))
+    operations.scan_untracked_files()
+    return operations._scanner.detections
+
+
+def test_untracked_file_changed_within_mtime_window_is_scanned(repo, tmp_path) -> None:
+    repo.write({"build.log": "harmless\n"})
+    # Just written, so a change later within the same mtime tick would leave its stat data the same
+    assert _scan_untracked(tmp_path) == ()
+    _rewrite_keeping_stat("build.log", "codename\n")
+    assert _scan_untracked(tmp_path) == ("codename", )
+
+
+def test_untracked_file_unchanged_since_clean_is_not_read(repo, tmp_path) -> None:
+    repo.write({"build.log": "harmless\n"})
+    old = time.time_ns() - 2 * RACY_WINDOW_NS
+    os.utime("build.log", ns=(old, old))
+    assert _scan_untracked(tmp_path) == ()
+    # The stat data is all that is looked at
+    _rewrite_keeping_stat("build.log", "codename\n")
+    assert _scan_untracked(tmp_path) == ()
+    os.utime("build.log", ns=(old, old + 1))
+    assert _scan_untracked(tmp_path) == ("codename", )
+
+
+def test_stat_cache_closed_when_scan_stops(repo, tmp_path, monkeypatch) -> None:
+    repo.write({"a.txt": "codename\n", "b.txt": "codename\n"})
+    closed = []
+    monkeypatch.setattr(ScanCache, "close", lambda cache: closed.append(cache.path))
+    scanner = Scanner(symbols=("codename", ), fail_fast=True)
+    operations = Operations(jobs=1, scanner=scanner, cache=ScanCache(path=str(tmp_path / "cache"), digest=scanner.digest))
+    with pytest.raises(FirstDetection):
+        operations.scan_untracked_files()
+    assert closed == [os.path.join(repo.path, ".git", STAT_CACHE_NAME)]
+
+
+
+@pytest.mark.parametrize("max_detections, kept", [(None, DEFAULT_MAX_DETECTIONS), (5, 5), (0, 1500)])
+def test_max_detections_zero_keeps_all(home, tmp_path, max_detections: int, kept: int) -> None:
+    with open(Template().bad_symbols_path, "w") as f:
+        f.write(Crypto().encrypt("codename\n"))
+    operations = Operations(cache=ScanCache(path=str(tmp_path / "cache"), digest=""), max_detections=max_detections)
+    with pytest.raises(errors.BadSymbolsDetectedError):
+        operations.commit_message_hook("codename " * 1500)
+    assert sum(len(run.detections) for run in operations._scanner.scan_runs) == kept
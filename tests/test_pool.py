@@ -0,0 +1,103 @@
+import os
+import pytest
+from trust_boundary_hooks.cache import ScanCache
+from trust_boundary_hooks.ops import BlobScanTask, Operations, _scan_blob_task
+from trust_boundary_hooks.pool import job_count, scan_map, shards
+from trust_boundary_hooks.scan import Scanner, scanning
+
+
+def test_job_count() -> None:
+    assert job_count(jobs=4, tasks=100, tasks_per_job=32) == 4
+    # Never more processes than tasks, nor fewer than one
+    assert job_count(jobs=4, tasks=2, tasks_per_job=32) == 2
+    assert job_count(jobs=4, tasks=0, tasks_per_job=32) == 1
+    assert job_count(jobs=None, tasks=10, tasks_per_job=32) == 1
+    assert job_count(jobs=None, tasks=10 ** 6, tasks_per_job=32) == (os.cpu_count() or 1)
+
+
+@pytest.mark.parametrize("jobs", [1, 2, 3, 8])
+@pytest.mark.parametrize("count", [0, 1, 7, 100])
+def test_shards_keep_every_task_in_order(jobs: int, count: int) -> None:
+    tasks = list(range(count))
+    split = shards(tasks, jobs)
+    assert [t for shard in split for t in shard] == tasks
+    assert all(split)
+    if jobs == 1:
+        assert len(split) <= 1
+
+
+def _scanner(fail_fast: bool = False) -> Scanner:
+    return Scanner(symbols=("codename", "project\\s+falcon"), fail_fast=fail_fast)
+
+
+def test_scan_map_results_in_task_order(tmp_path) -> None:
+    tasks = [
+        BlobScanTask(name=f"file{i}.txt", blob=f"{i:040x}", content=f"{i}\n{'codename' if i % 3 else 'clean'}\n".encode())
+        for i in range(50)
+    ]
+    results = {}
+    for jobs in (1, 3):
+        scanner = _scanner()
+        cache = ScanCache(path=str(tmp_path / f"cache-{jobs}"), digest=scanner.digest)
+        results[jobs] = list(scan_map(_scan_blob_task, tasks, jobs=jobs, scanner=scanner, cache=cache))
+    assert results[1] == results[3]
+    assert [r.name for r in results[1]] == [t.name for t in tasks]
+    assert [r.clean for r in results[1]] == [i % 3 == 0 for i in range(50)]
+
+
+def _operations(tmp_path, jobs: int, history_mode: str = Operations.HISTORY_LOG, fail_fast: bool = False) -> Operations:
+    scanner = _scanner(fail_fast=fail_fast)
+    cache = ScanCache(path=str(tmp_path / f"cache-{history_mode}-{jobs}-{fail_fast}"), digest=scanner.digest)
+    return Operations(jobs=jobs, scanner=scanner, cache=cache, history_mode=history_mode)
+
+
+def _history(repo) -> None:
+    for i in range(30):
+        found = {f"notes{i}.txt": f"codename {i}\n"} if i % 4 == 1 else {}
+        repo.commit(dict(found, **{f"file{i}.txt": f"{i}\n"}), "Project Falcon" if i == 10 else f"Change {i}")
+
+
+@pytest.mark.parametrize("history_mode", Operations.HISTORY_MODES)
+def test_history_detections_same_for_any_jobs(repo, tmp_path, history_mode: str) -> None:
+    _history(repo)
+    runs = {}
+    for jobs in (1, 4):
+        operations = _operations(tmp_path, jobs, history_mode)
+        operations.scan_git_history()
+        runs[jobs] = operations._scanner.scan_runs
+    assert runs[1] == runs[4]
+    assert len(runs[1]) == 9
+
+
+def test_file_detections_same_for_any_jobs(repo, tmp_path) -> None:
+    repo.write({f"file{i}.txt": f"{i}\n{'codename' if i % 3 else 'clean'}\n" for i in range(100)})
+    files = sorted(f for f in os.listdir(repo.path) if f.endswith(".txt"))
+    runs = {}
+    for jobs in (1, 4):
+        operations = _operations(tmp_path, jobs)
+        operations._scan_files(files)
+        runs[jobs] = operations._scanner.scan_runs
+    assert runs[1] == runs[4]
+    assert len(runs[1]) == 66
+
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_fail_fast_stops_at_the_first_file(repo, tmp_path, jobs: int) -> None:
+    repo.write({f"file{i:03}.txt": "codename\n" for i in range(200)})
+    files = sorted(f for f in os.listdir(repo.path) if f.endswith(".txt"))
+    operations = _operations(tmp_path, jobs, fail_fast=True)
+    with scanning():
+        operations._scan_files(files)
+    assert [r.context for r in operations._scanner.scan_runs] == ["FileContent(file000.txt)"]
+
+
+@pytest.mark.parametrize("history_mode", Operations.HISTORY_MODES)
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_fail_fast_stops_at_the_first_shard_found(repo, tmp_path, history_mode: str, jobs: int) -> None:
+    _history(repo)
+    operations = _operations(tmp_path, jobs, history_mode, fail_fast=True)
+    with scanning():
+        operations.scan_git_history()
+    assert len(operations._scanner.scan_runs) == 1
+    # Nothing after the first detection is recorded as clean
+    assert len(operations._cache.unknown_objects([repo.git("rev-parse", "HEAD~29")])) == 1
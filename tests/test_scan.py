@@ -0,0 +1,112 @@
+import signal
+import threading
+import pytest
+from trust_boundary_hooks import errors, scan
+from trust_boundary_hooks.cache import ScanCache
+from trust_boundary_hooks.ops import Operations, _search_content
+from trust_boundary_hooks.scan import BYTES_CHUNK_SIZE, Scanner, decode_text
+
+
+@pytest.mark.parametrize("encoding", ["utf-16-le", "utf-16-be"])
+def test_decode_utf16_without_bom(encoding: str) -> None:
+    assert decode_text("the codename\nis here".encode(encoding)) == "the codename\nis here"
+
+
+@pytest.mark.parametrize("encoding", ["utf-8-sig", "utf-16", "utf-32"])
+def test_decode_with_bom(encoding: str) -> None:
+    assert decode_text("the codename\nis here".encode(encoding)) == "the codename\nis here"
+
+
+def test_decode_utf8_with_nuls() -> None:
+    assert decode_text(b"some text\0with a nul") == "some text\0with a nul"
+
+
+@pytest.mark.parametrize("encoding", ["utf-8", "utf-16", "utf-16-le", "utf-16-be"])
+@pytest.mark.parametrize("symbols", [("codename", "other"), ("code\\s*name", "other")])
+def test_search_bytes_finds_encoded_symbol(encoding: str, symbols: tuple) -> None:
+    scanner = Scanner(symbols=symbols)
+    detections = scanner.search_bytes("the CodeName is here".encode(encoding))
+    assert [d.match for d in detections] == ["CodeName"]
+    assert scanner.search_bytes("nothing to see here".encode(encoding)) == ()
+
+
+@pytest.mark.parametrize("encoding", ["utf-16-le", "utf-16-be"])
+def test_search_bytes_finds_symbol_in_large_utf16_without_bom(encoding: str) -> None:
+    # Large content is searched as bytes before it is decoded
+    text = "x" * BYTES_CHUNK_SIZE + " codename"
+    detections = Scanner(symbols=("codename", )).search_bytes(text.encode(encoding))
+    assert [d.match for d in detections] == ["codename"]
+
+
+@pytest.mark.parametrize("encoding", ["utf-8-sig", "utf-16", "utf-32"])
+@pytest.mark.parametrize("size", [0, BYTES_CHUNK_SIZE])
+def test_search_content_finds_symbol_after_bom(encoding: str, size: int) -> None:
+    # Large content is searched as bytes before it is decoded, which mustn't pass UTF-32 content
+    text = "x" * size + " the CodeName"
+    detections = _search_content(Scanner(symbols=("codename", "other")), "file", text.encode(encoding))
+    assert [d.match for d in detections] == ["CodeName"]
+
+
+def test_search_content_finds_symbol_in_undecodable_content() -> None:
+    detections = _search_content(Scanner(symbols=("codename", )), "file", "café codename".encode("latin-1"))
+    assert [d.match for d in detections] == ["codename"]
+
+
+def test_search_bytes_decodes_once(monkeypatch) -> None:
+    calls = []
+    decode = scan.decode_text
+    monkeypatch.setattr(scan, "decode_text", lambda content: calls.append(content) or decode(content))
+    assert Scanner(symbols=("codename", )).search_bytes("café codename".encode("latin-1")) is None
+    assert len(calls) == 1
+
+
+def test_locate_reports_lines() -> None:
+    detections = Scanner(symbols=("codename", )).locate("first\nthe codename\nand codename")
+    assert [(d.offset, d.line) for d in detections] == [(10, 2), (23, 3)]
+
+
+def test_scan_string_reports_no_location() -> None:
+    scanner = Scanner(symbols=("codename", ))
+    scanner.scan_string(context="FileName(codename.txt)", value="codename.txt", scope="filename")
+    assert [d.location for run in scanner.scan_runs for d in run.detections] == [""]
+
+
+# Catastrophic backtracking on a run of "a"s with no "b" after it
+PATHOLOGICAL = "(a+)+b"
+
+
+def test_pathological_symbol_exceeds_scan_budget() -> None:
+    with pytest.raises(errors.ScanBudgetExceededError, match="0.05 second scan budget"):
+        Scanner(symbols=(PATHOLOGICAL, ), budget=0.05).locate("a" * 40)
+
+
+def test_hook_fails_when_scan_budget_exceeded(tmp_path) -> None:
+    scanner = Scanner(symbols=(PATHOLOGICAL, ), budget=0.05)
+    operations = Operations(scanner=scanner, cache=ScanCache(path=str(tmp_path / "cache"), digest=scanner.digest))
+    with pytest.raises(errors.ScanBudgetExceededError):
+        operations.commit_message_hook("a" * 40)
+
+
+def test_scan_budget_restores_previous_alarm_handler() -> None:
+    def handler(signum, frame) -> None:
+        pass
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    try:
+        scanner = Scanner(symbols=("codename", PATHOLOGICAL), budget=0.05)
+        assert [d.match for d in scanner.locate("the codename")] == ["codename"]
+        assert signal.getsignal(signal.SIGALRM) is handler
+        with pytest.raises(errors.ScanBudgetExceededError):
+            scanner.locate("a" * 40)
+        assert signal.getsignal(signal.SIGALRM) is handler
+        assert signal.getitimer(signal.ITIMER_REAL) == (0.0, 0.0)
+    finally:
+        signal.signal(signal.SIGALRM, previous)
+
+
+def test_no_scan_budget_outside_main_thread() -> None:
+    results = []
+    thread = threading.Thread(target=lambda: results.append(Scanner(symbols=("codename", ), budget=0.05).locate("codename")))
+    thread.start()
+    thread.join()
+    assert [d.match for d in results[0]] == ["codename"]
@@ -0,0 +1,18 @@
+import pytest
+from trust_boundary_hooks.startup import DEFAULT_BUDGET_MS, DEFERRED_PACKAGES, profile_hook_imports
+
+
+@pytest.fixture(scope="module")
+def profile():
+    return profile_hook_imports()
+
+
+@pytest.mark.parametrize("package", DEFERRED_PACKAGES)
+def test_hooks_defer_package(profile, package: str) -> None:
+    assert package not in profile.packages, f"Hooks import '{package}' up front"
+
+
+def test_hook_imports_within_budget(profile) -> None:
+    # The quickest of a few runs, so a busy machine doesn't fail the test
+    import_ms = min([profile.import_ms] + [profile_hook_imports().import_ms for _ in range(2)])
+    assert import_ms <= DEFAULT_BUDGET_MS, f"Hook imports take {import_ms:.0f}ms, over the {DEFAULT_BUDGET_MS}ms budget"
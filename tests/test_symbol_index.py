@@ -0,0 +1,112 @@
+import struct
+import pytest
+from trust_boundary_hooks import scan
+from trust_boundary_hooks.crypto import Crypto
+from trust_boundary_hooks.scan import SCOPES, load_symbol_index
+from trust_boundary_hooks.symbol_index import (
+    ALL_PATTERNS,
+    SIDECAR_MAGIC,
+    SIDECAR_VERSION,
+    SymbolIndex,
+    read_sidecar,
+    source_digest,
+    write_sidecar,
+)
+from trust_boundary_hooks.template import Template
+
+
+def _round_trip(index: SymbolIndex) -> SymbolIndex:
+    return SymbolIndex.from_bytes(index.to_bytes())
+
+
+def test_round_trip_keeps_patterns() -> None:
+    index = SymbolIndex.build(("codename", "straße", "project\\s+falcon"))
+    loaded = _round_trip(index)
+    assert loaded.symbols == index.symbols
+    assert loaded.byte_overlap == index.byte_overlap
+    for name in ALL_PATTERNS:
+        pattern, loaded_pattern = index.pattern(name), loaded.pattern(name)
+        assert (pattern is None) == (loaded_pattern is None)
+        if pattern is not None:
+            assert (loaded_pattern.pattern, loaded_pattern.flags) == (pattern.pattern, pattern.flags)
+
+
+def test_round_trip_keeps_scoped_indexes() -> None:
+    symbols = ("everywhere", "author", "word")
+    scopes = (SCOPES, ("metadata", ), ("content", "filename"))
+    loaded = _round_trip(SymbolIndex.build(symbols, scopes))
+    assert loaded.scopes == scopes
+    assert loaded.for_context("metadata").symbols == ("everywhere", "author")
+    assert loaded.for_context("content").symbols == ("everywhere", "word")
+    assert loaded.for_context("filename") is loaded.for_context("content")
+    assert loaded.for_context("history") is loaded
+    assert loaded.for_context(None) is loaded
+
+
+def test_round_trip_of_bytes_patterns() -> None:
+    loaded = _round_trip(SymbolIndex.build(("codename", )))
+    assert loaded.pattern("utf16").search("codename".encode("utf-16-le"))
+
+
+def _write_bad_symbols(content: str) -> None:
+    with open(Template().bad_symbols_path, "w") as f:
+        f.write(Crypto().encrypt(content))
+
+
+def _bad_symbols_digest() -> bytes:
+    with open(Template().bad_symbols_path, "rb") as f:
+        return source_digest(f.read())
+
+
+@pytest.fixture
+def fresh_load(home, monkeypatch) -> None:
+    # Nothing kept from loads by other tests
+    monkeypatch.setattr(scan, "_loaded", None)
+
+
+def test_sidecar_is_used_for_the_same_list(fresh_load) -> None:
+    _write_bad_symbols("codename\n")
+    # Only the sidecar has this symbol, so loading it shows the list wasn't parsed
+    write_sidecar(Template().symbol_index_path, _bad_symbols_digest(), SymbolIndex.build(("from-sidecar", )))
+    assert load_symbol_index().symbols == ("from-sidecar", )
+
+
+def test_sidecar_is_rebuilt_when_the_list_changes(fresh_load, monkeypatch) -> None:
+    _write_bad_symbols("codename\n")
+    assert load_symbol_index().symbols == ("codename", )
+    _write_bad_symbols("codename\nproject\n")
+    # As a new hook process would
+    monkeypatch.setattr(scan, "_loaded", None)
+    assert load_symbol_index().symbols == ("codename", "project")
+    assert read_sidecar(Template().symbol_index_path, _bad_symbols_digest()).symbols == ("codename", "project")
+
+
+def _stale(data: bytes) -> bytes:
+    return data[:len(SIDECAR_MAGIC) + 2] + bytes(32) + data[len(SIDECAR_MAGIC) + 2 + 32:]
+
+
+def _old_version(data: bytes) -> bytes:
+    return data[:len(SIDECAR_MAGIC)] + struct.pack(">H", SIDECAR_VERSION - 1) + data[len(SIDECAR_MAGIC) + 2:]
+
+
+def _tampered(data: bytes) -> bytes:
+    return data[:-1] + bytes([data[-1] ^ 1])
+
+
+def _truncated(data: bytes) -> bytes:
+    return data[:10]
+
+
+@pytest.mark.parametrize("spoil", [_stale, _old_version, _tampered, _truncated])
+def test_spoiled_sidecar_is_rebuilt(fresh_load, spoil) -> None:
+    _write_bad_symbols("codename\n")
+    path = Template().symbol_index_path
+    write_sidecar(path, _bad_symbols_digest(), SymbolIndex.build(("from-sidecar", )))
+    with open(path, "rb") as f:
+        data = spoil(f.read())
+    with open(path, "wb") as f:
+        f.write(data)
+
+    assert read_sidecar(path, _bad_symbols_digest()) is None
+    assert load_symbol_index().symbols == ("codename", )
+    assert read_sidecar(path, _bad_symbols_digest()).symbols == ("codename", )
@@ -0,0 +1,98 @@
+import re
+import random
+import pytest
+from trust_boundary_hooks.scan import Scanner
+from trust_boundary_hooks.symbols import classify_symbols
+
+
+# Random lists of symbols, and text to search, are drawn from these, so symbols overlap and share prefixes.
+# The non-ASCII letters include those `re.IGNORECASE` equates with an ASCII letter (İ and ı with i, K with
+# k, ſ with s), which the ASCII automaton spells out as alternatives.
+LETTERS = "abcikstABCIKST"
+FOLD_LETTERS = "İıKſ"
+OTHER_LETTERS = "äÄßσΣ"
+TEXT_CHARACTERS = LETTERS + FOLD_LETTERS + OTHER_LETTERS + "0123456789 .-\n\t"
+
+SEEDS = range(1000)
+
+
+def _word(rng: random.Random, letters: str) -> str:
+    return "".join(rng.choice(letters) for _ in range(rng.randint(1, 6)))
+
+
+def _regex(rng: random.Random, words: list) -> str:
+    a, b = rng.choice(words), rng.choice(words)
+    return rng.choice([
+        f"{re.escape(a)}\\s+{re.escape(b)}",
+        f"{re.escape(a)}[0-9]{{2}}",
+        f"{re.escape(a)}.{re.escape(b)}",
+        f"(?:{re.escape(a)}|{re.escape(b)})x",
+        f"\\b{re.escape(a)}\\b",
+        f"{re.escape(a)}-?{re.escape(b)}",
+    ])
+
+
+def _symbols(rng: random.Random) -> tuple:
+    letters = LETTERS + (FOLD_LETTERS if rng.random() < 0.5 else "") + (OTHER_LETTERS if rng.random() < 0.3 else "")
+    words = [_word(rng, letters) for _ in range(rng.randint(1, 12))]
+    # Words extending and cut short from others, so the trie has shared prefixes and pruned branches
+    words += [w + _word(rng, letters) for w in rng.sample(words, k=min(3, len(words)))]
+    words += [w[:rng.randint(1, len(w))] for w in rng.sample(words, k=min(3, len(words)))]
+    regexes = [_regex(rng, words) for _ in range(rng.randint(0, 3))] if rng.random() < 0.5 else []
+    symbols = words + regexes
+    rng.shuffle(symbols)
+    return tuple(dict.fromkeys(symbols))
+
+
+def _vary_case(rng: random.Random, value: str) -> str:
+    folds = {"i": "İıI", "k": "KK", "s": "ſS"}
+    return "".join(rng.choice(folds.get(c.lower(), c.swapcase() + c)) for c in value)
+
+
+def _text(rng: random.Random, symbols: tuple) -> str:
+    parts = []
+    literals, _ = classify_symbols(symbols)
+    for _ in range(rng.randint(0, 20)):
+        parts.append("".join(rng.choice(TEXT_CHARACTERS) for _ in range(rng.randint(0, 12))))
+        if literals and rng.random() < 0.5:
+            parts.append(_vary_case(rng, rng.choice(literals)))
+    return "".join(parts)
+
+
+def _expected(symbols: tuple, text: str) -> list:
+    # The single alternation of every symbol, which the prefilters stand in front of
+    return list(re.compile("|".join(symbols), re.IGNORECASE).finditer(text))
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_search_matches_single_alternation(seed: int) -> None:
+    rng = random.Random(seed)
+    symbols = _symbols(rng)
+    scanner = Scanner(symbols=symbols, max_detections=None)
+    for _ in range(10):
+        text = _text(rng, symbols)
+        expected = _expected(symbols, text)
+        assert scanner.search(text) == tuple(sorted({m.group() for m in expected})), (symbols, text)
+        assert [(d.match, d.offset) for d in scanner.locate(text)] == [(m.group(), m.start()) for m in expected]
+
+
+@pytest.mark.parametrize("symbol, text", [
+    ("kit", "KIT"),
+    ("kit", "KİT"),
+    ("kit", "kıt"),
+    ("session", "ſeſſion"),
+    ("straße", "STRAßE"),
+    ("σσ", "Σσ"),
+])
+def test_search_folds_case_as_ignorecase(symbol: str, text: str) -> None:
+    assert re.search(symbol, text, re.IGNORECASE)
+    assert Scanner(symbols=(symbol, "unrelated")).search(f"x {text} x") == (re.search(symbol, text, re.IGNORECASE).group(), )
+
+
+def test_search_overlapping_prefixes() -> None:
+    # The first symbol listed that matches at a position wins, as in the single alternation
+    scanner = Scanner(symbols=("abc", "ab", "abcd", "bcd"))
+    assert scanner.search("xabcdx") == ("abc", )
+    assert scanner.search("xabdx") == ("ab", )
+    assert scanner.search("xbcdx") == ("bcd", )
+    assert scanner.search("xacx") == ()
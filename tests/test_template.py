@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import subprocess
+from typing import Dict, List, Optional, Tuple
+import minio
+import pytest
+from trust_boundary_hooks import errors
+from trust_boundary_hooks.crypto import Crypto
+from trust_boundary_hooks.scan import load_bad_symbols
+from trust_boundary_hooks.template import REFRESH_TTL_KEY, Template
+
+
+class FakeResponse:
+
+    def __init__(self, content: str, etag: str) -> None:
+        self._content = content
+        self.headers = {"ETag": f'"{etag}"'}
+
+    def read(self) -> bytes:
+        return self._content.encode('utf-8')
+
+    def close(self) -> None:
+        pass
+
+    def release_conn(self) -> None:
+        pass
+
+
+class FakeStat:
+
+    def __init__(self, etag: str) -> None:
+        self.etag = etag
+
+
+class FakeS3:
+    """ Objects of a stand-in for Minio servers, by host, bucket and object name """
+
+    def __init__(self) -> None:
+        self.objects: Dict[Tuple[str, str, str], str] = {}
+        self.down = set()
+        self.requests: List[Tuple[str, str, str, str]] = []
+        self.hosts: List[str] = []
+
+    def put(self, host: str, bucket: str, name: str, content: str) -> None:
+        self.objects[(host, bucket, name)] = content
+
+    def etag(self, key: Tuple[str, str, str]) -> str:
+        return f"etag-{abs(hash(self.objects[key]))}"
+
+    def client(self, host: str, **kwargs) -> "FakeMinio":
+        self.hosts.append(host)
+        return FakeMinio(self, host)
+
+
+class FakeMinio:
+
+    def __init__(self, s3: FakeS3, host: str) -> None:
+        self._s3 = s3
+        self._host = host
+
+    def _key(self, request: str, bucket_name: str, object_name: str) -> Tuple[str, str, str]:
+        self._s3.requests.append((request, self._host, bucket_name, object_name))
+        if self._host in self._s3.down:
+            raise ConnectionRefusedError(f"{self._host} refused the connection")
+        return self._host, bucket_name, object_name
+
+    def stat_object(self, bucket_name: str, object_name: str) -> FakeStat:
+        return FakeStat(self._s3.etag(self._key("stat", bucket_name, object_name)))
+
+    def get_object(self, bucket_name: str, object_name: str) -> FakeResponse:
+        key = self._key("get", bucket_name, object_name)
+        return FakeResponse(self._s3.objects[key], self._s3.etag(key))
+
+
+@pytest.fixture
+def s3(monkeypatch, home) -> FakeS3:
+    s3 = FakeS3()
+    monkeypatch.setattr(minio, "Minio", s3.client)
+    return s3
+
+
+def _configure(sources: Optional[List[Dict[str, str]]] = None, **config) -> None:
+    config = dict(dict(access_key="access", endpoint="http://a.test"), **config)
+    if sources is not None:
+        config["sources"] = sources
+    with open(Template().minio_configuration_path, "w") as f:
+        json.dump(config, f)
+
+
+def _bad_symbols_file() -> str:
+    with open(Template().bad_symbols_path, "r") as f:
+        return f.read()
+
+
+def _two_sources(s3: FakeS3) -> None:
+    s3.put("a.test", "team-a", "symbols.txt", "codename\n")
+    s3.put("b.test", "team-b", "symbols.txt", "#scope: metadata\nsomeone\n")
+    _configure(sources=[
+        {"bucket": "team-a", "object": "symbols.txt"},
+        {"endpoint": "http://b.test", "bucket": "team-b", "object": "symbols.txt"},
+    ])
+
+
+def test_sources_are_merged_with_source_tags(s3) -> None:
+    _two_sources(s3)
+    Template().update_bad_symbols()
+    assert Crypto().decrypt(_bad_symbols_file()) == (
+        "#source: http://a.test/team-a/symbols.txt\ncodename\n"
+        "#source: http://b.test/team-b/symbols.txt\n#scope: metadata\nsomeone\n"
+    )
+    assert load_bad_symbols() == ("codename", "someone")
+    assert sorted(s3.hosts) == ["a.test", "b.test"]
+
+
+def test_failed_source_keeps_its_earlier_symbols(s3) -> None:
+    _two_sources(s3)
+    Template().update_bad_symbols()
+    s3.put("a.test", "team-a", "symbols.txt", "codename\nproject\n")
+    s3.down.add("b.test")
+    with pytest.raises(errors.BadSymbolSourcesError, match="http://b.test/team-b/symbols.txt"):
+        Template().update_bad_symbols()
+    assert load_bad_symbols() == ("codename", "project", "someone")
+    assert "#source: http://b.test/team-b/symbols.txt\n#scope: metadata\nsomeone\n" in Crypto().decrypt(_bad_symbols_file())
+
+
+def test_failed_source_without_earlier_symbols_leaves_the_rest(s3) -> None:
+    _two_sources(s3)
+    s3.down.add("b.test")
+    with pytest.raises(errors.BadSymbolSourcesError):
+        Template().update_bad_symbols()
+    assert Crypto().decrypt(_bad_symbols_file()) == "#source: http://a.test/team-a/symbols.txt\ncodename\n"
+
+
+def test_every_source_failing_keeps_the_list(s3) -> None:
+    _two_sources(s3)
+    Template().update_bad_symbols()
+    before = _bad_symbols_file()
+    s3.down.update(("a.test", "b.test"))
+    with pytest.raises(ConnectionRefusedError):
+        Template().update_bad_symbols()
+    assert _bad_symbols_file() == before
+
+
+def test_bad_ca_path_is_a_config_error(s3, home) -> None:
+    _configure(endpoint="https://a.test", bucket="team-a", object="symbols.txt", ca_path=os.path.join(home, "missing.pem"))
+    with pytest.raises(errors.MinioConfigError, match="bad CA path"):
+        Template().update_bad_symbols()
+    assert s3.hosts == []
+
+
+def test_unchanged_etag_does_not_rewrite_the_list(s3) -> None:
+    s3.put("a.test", "team-a", "symbols.txt", "codename\n")
+    _configure(bucket="team-a", object="symbols.txt")
+    Template().update_bad_symbols()
+    before = _bad_symbols_file()
+    s3.requests.clear()
+    Template().update_bad_symbols()
+    # Encrypting again would give a different ciphertext
+    assert _bad_symbols_file() == before
+    assert s3.requests == [("stat", "a.test", "team-a", "symbols.txt")]
+
+    s3.put("a.test", "team-a", "symbols.txt", "codename\nproject\n")
+    Template().update_bad_symbols()
+    assert load_bad_symbols() == ("codename", "project")
+
+
+def test_force_downloads_an_unchanged_list(s3) -> None:
+    s3.put("a.test", "team-a", "symbols.txt", "codename\n")
+    _configure(bucket="team-a", object="symbols.txt")
+    Template().update_bad_symbols()
+    s3.requests.clear()
+    Template().update_bad_symbols(force=True)
+    assert [r[0] for r in s3.requests] == ["get"]
+
+
+class _Started:
+    """ Stands in for starting the background refresh, recording what would have run """
+
+    def __init__(self) -> None:
+        self.commands = []
+
+    def __call__(self, command, **kwargs) -> None:
+        self.commands.append(command)
+
+
+@pytest.mark.parametrize("checked_ago, started", [(120, True), (30, False)])
+def test_refresh_starts_once_the_ttl_expires(monkeypatch, s3, checked_ago: int, started: bool) -> None:
+    _configure(bucket="team-a", object="symbols.txt", **{REFRESH_TTL_KEY: 60})
+    template = Template()
+    template._write_refresh_state({"checked": time.time() - checked_ago})
+    popen = _Started()
+    monkeypatch.setattr(subprocess, "Popen", popen)
+    assert template.refresh_in_background() is started
+    assert [command[1:] for command in popen.commands] == ([["refresh"]] if started else [])
+    # Not started again until another TTL has passed
+    assert template.refresh_in_background() is False
+
+
+def test_no_refresh_without_a_ttl(monkeypatch, s3) -> None:
+    _configure(bucket="team-a", object="symbols.txt")
+    popen = _Started()
+    monkeypatch.setattr(subprocess, "Popen", popen)
+    assert Template().refresh_in_background() is False
+    assert popen.commands == []
+
+
+def test_failed_background_refresh_keeps_the_list_and_logs(monkeypatch, s3) -> None:
+    s3.put("a.test", "team-a", "symbols.txt", "codename\n")
+    _configure(bucket="team-a", object="symbols.txt")
+    template = Template()
+    template.update_bad_symbols()
+    before = _bad_symbols_file()
+
+    # The refresh process can't use the fake servers; a broken config makes it fail before reaching any
+    _configure(sources=[{"bucket": "", "object": "symbols.txt"}], **{REFRESH_TTL_KEY: 60})
+    template._write_refresh_state({"checked": time.time() - 120})
+    monkeypatch.setenv("PYTHON_KEYRING_BACKEND", "keyring.backends.fail.Keyring")
+    started = []
+    popen = subprocess.Popen
+    monkeypatch.setattr(subprocess, "Popen", lambda *args, **kwargs: started.append(popen(*args, **kwargs)))
+    assert template.refresh_in_background()
+    assert started[0].wait(timeout=60) != 0
+
+    assert _bad_symbols_file() == before
+    with open(template.refresh_log_path, "r") as f:
+        assert "empty key 'sources[0].bucket'" in f.read()
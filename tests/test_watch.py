@@ -0,0 +1,134 @@
+import os
+from typing import Iterator
+import pytest
+from trust_boundary_hooks import errors, watch
+from trust_boundary_hooks.cache import ScanCache, git_blob_sha
+from trust_boundary_hooks.crypto import Crypto
+from trust_boundary_hooks.scan import Scanner
+from trust_boundary_hooks.template import Template
+from trust_boundary_hooks.watch import (
+    IN_CLOSE_WRITE,
+    IN_CREATE,
+    IN_IGNORED,
+    IN_ISDIR,
+    IN_MOVED_TO,
+    IN_Q_OVERFLOW,
+    InotifyEvent,
+    Watcher,
+)
+
+
+@pytest.fixture
+def bad_symbols(home) -> None:
+    with open(Template().bad_symbols_path, "w") as f:
+        f.write(Crypto().encrypt("codename\n"))
+
+
+@pytest.fixture
+def watcher(repo) -> Iterator[Watcher]:
+    repo.commit({"tracked.txt": "tracked\n", ".gitignore": "build/\n*.log\n"})
+    watcher = Watcher(repo.path)
+    watcher._ignored_directories = watch._ignored_directories(repo.path)
+    watcher._watch_tree(repo.path)
+    yield watcher
+    watcher._inotify.close()
+
+
+def _wd(watcher: Watcher, path: str) -> int:
+    return {directory: wd for wd, directory in watcher._directories.items()}[path]
+
+
+def test_saved_and_moved_files_are_rescanned(watcher, repo) -> None:
+    root = _wd(watcher, repo.path)
+    events = [
+        InotifyEvent(wd=root, mask=IN_CLOSE_WRITE, name="saved.txt"),
+        InotifyEvent(wd=root, mask=IN_MOVED_TO, name="moved.txt"),
+        # Scanned once written and closed, not while being written
+        InotifyEvent(wd=root, mask=IN_CREATE, name="created.txt"),
+        InotifyEvent(wd=root + 1000, mask=IN_CLOSE_WRITE, name="unwatched.txt"),
+    ]
+    assert watcher._changes(events) == {os.path.join(repo.path, "saved.txt"), os.path.join(repo.path, "moved.txt")}
+
+
+def test_new_directories_are_watched_and_their_files_rescanned(watcher, repo) -> None:
+    repo.write({"new/inner/a.txt": "a\n", "build/out.txt": "out\n"})
+    root = _wd(watcher, repo.path)
+    changed = watcher._changes([
+        InotifyEvent(wd=root, mask=IN_CREATE | IN_ISDIR, name="new"),
+        InotifyEvent(wd=root, mask=IN_CREATE | IN_ISDIR, name="build"),
+        InotifyEvent(wd=root, mask=IN_CREATE | IN_ISDIR, name=".git"),
+    ])
+    assert changed == {os.path.join(repo.path, "new", "inner", "a.txt")}
+    assert {os.path.join(repo.path, "new"), os.path.join(repo.path, "new", "inner")} <= set(watcher._directories.values())
+    # Ignored directories are left unwatched
+    assert os.path.join(repo.path, "build") not in watcher._directories.values()
+    assert os.path.join(repo.path, "build") in watcher._ignored_directories
+
+
+def test_removed_directories_are_forgotten(watcher, repo) -> None:
+    repo.write({"dir/a.txt": "a\n"})
+    watcher._watch_tree(os.path.join(repo.path, "dir"))
+    wd = _wd(watcher, os.path.join(repo.path, "dir"))
+    assert watcher._changes([InotifyEvent(wd=wd, mask=IN_IGNORED, name="")]) == set()
+    assert wd not in watcher._directories
+    assert watcher._changes([InotifyEvent(wd=wd, mask=IN_CLOSE_WRITE, name="a.txt")]) == set()
+
+
+def test_missed_changes_rescan_every_changed_file(watcher, repo) -> None:
+    repo.write({"tracked.txt": "changed\n", "untracked.txt": "new\n", "ignored.log": "log\n"})
+    changed = watcher._changes([InotifyEvent(wd=-1, mask=IN_Q_OVERFLOW, name="")])
+    assert changed == {os.path.join(repo.path, "tracked.txt"), os.path.join(repo.path, "untracked.txt")}
+
+
+def test_inotify_events_are_rescanned(watcher, repo) -> None:
+    repo.write({"saved.txt": "saved\n", "dir/inner.txt": "inner\n"})
+    changed = set()
+    for _ in range(10):
+        events = watcher._inotify.read(timeout=0.5)
+        if not events:
+            break
+        changed |= watcher._changes(events)
+    assert changed == {os.path.join(repo.path, "saved.txt"), os.path.join(repo.path, "dir", "inner.txt")}
+
+
+def _no_inotify() -> None:
+    raise errors.WatchUnavailableError("inotify is not available on this platform")
+
+
+@pytest.fixture
+def polling_watcher(repo, monkeypatch) -> Watcher:
+    monkeypatch.setattr(watch, "Inotify", _no_inotify)
+    repo.commit({"tracked.txt": "tracked\n", ".gitignore": "*.log\n"})
+    return Watcher(repo.path)
+
+
+def test_polling_without_inotify(polling_watcher, repo) -> None:
+    assert polling_watcher._inotify is None
+    stats = {}
+    repo.write({"untracked.txt": "new\n", "ignored.log": "log\n"})
+    assert polling_watcher._poll(stats) == {os.path.join(repo.path, "untracked.txt")}
+    assert polling_watcher._poll(stats) == set()
+
+    repo.write({"untracked.txt": "changed\n", "tracked.txt": "changed\n"})
+    assert polling_watcher._poll(stats) == {os.path.join(repo.path, "untracked.txt"), os.path.join(repo.path, "tracked.txt")}
+    # Changed back to what the index has, so nothing left to scan
+    repo.write({"tracked.txt": "tracked\n"})
+    assert polling_watcher._poll(stats) == set()
+
+
+def test_watch_by_polling_scans_changes(polling_watcher, repo, bad_symbols, monkeypatch) -> None:
+    repo.write({"first.txt": "clean\n"})
+    changes = [{"second.txt": "clean too\n"}, {"third.txt": "a codename\n"}]
+
+    def _sleep(seconds: float) -> None:
+        if not changes:
+            raise KeyboardInterrupt()
+        repo.write(changes.pop(0))
+
+    monkeypatch.setattr(watch.time, "sleep", _sleep)
+    with pytest.raises(KeyboardInterrupt):
+        polling_watcher.watch()
+
+    cache = ScanCache(path=Template().scan_cache_path, digest=Scanner().digest)
+    clean = [git_blob_sha(b"clean\n"), git_blob_sha(b"clean too\n")]
+    assert cache.unknown_objects(clean + [git_blob_sha(b"a codename\n")]) == [git_blob_sha(b"a codename\n")]
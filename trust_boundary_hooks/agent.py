@@ -0,0 +1,156 @@
+import os
+import sys
+import time
+import logging
+import threading
+import socketserver
+import subprocess
+from pathlib import Path
+from typing import Dict, Optional
+from . import errors
+from .unix_socket import PrivateUnixStreamServer, connect
+
+
+log = logging.getLogger(__name__)
+
+# Overrides where the agent listens (and where hooks look for it)
+AGENT_SOCKET_ENV = "TBH_AGENT_SOCK"
+
+DEFAULT_TTL = 8 * 60 * 60
+
+# Hooks give up on an unresponsive agent quickly and use the keyring instead
+CLIENT_TIMEOUT = 1.0
+
+_MAX_REQUEST = 1024
+
+
+def socket_path() -> str:
+    if os.environ.get(AGENT_SOCKET_ENV):
+        return os.environ[AGENT_SOCKET_ENV]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, "tbh-agent.sock")
+    return os.path.expanduser("~/.tbh_agent.sock")
+
+
+def _request(path: str, request: str, timeout: float = CLIENT_TIMEOUT) -> Optional[str]:
+    """ Sends one request line to the agent, returning its response, or None if there is no usable agent """
+    client = connect(path, timeout)
+    if client is None:
+        return None
+    try:
+        with client:
+            client.sendall(f"{request}\n".encode('utf-8'))
+            response = b""
+            while not response.endswith(b"\n"):
+                data = client.recv(4096)
+                if not data:
+                    break
+                response += data
+    except OSError as e:
+        log.debug(f"Agent at '{path}' unavailable ({e})")
+        return None
+    return response.decode('utf-8').rstrip("\n")
+
+
+def get_secret(name: str) -> Optional[str]:
+    """ The named secret held by a running agent, or None """
+    response = _request(socket_path(), f"GET {name}")
+    if response is None or not response.startswith("OK "):
+        return None
+    return response[len("OK "):]
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    server: "_AgentServer"
+
+    def handle(self) -> None:
+        command, _, argument = self.rfile.readline(_MAX_REQUEST).decode('utf-8').strip().partition(" ")
+        if command == "GET" and argument in self.server.secrets:
+            self.wfile.write(f"OK {self.server.secrets[argument]}\n".encode('utf-8'))
+        elif command == "PING":
+            self.wfile.write(f"OK {int(self.server.expires - time.time())}\n".encode('utf-8'))
+        elif command == "STOP":
+            self.wfile.write(b"OK\n")
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+        else:
+            self.wfile.write(b"ERR\n")
+
+
+class _AgentServer(PrivateUnixStreamServer):
+
+    def __init__(self, path: str, secrets: Dict[str, str], ttl: float) -> None:
+        self.secrets = secrets
+        self.expires = time.time() + ttl
+        super().__init__(path, _Handler)
+
+
+class Agent:
+    """ Holds secrets from the keyring in memory for a while, handing them out over a Unix socket only the
+    current user can connect to, so hooks don't each make a (possibly slow, possibly prompting) keyring call
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._path = path or socket_path()
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def status(self) -> Optional[int]:
+        """ Seconds until a running agent expires, or None if none is running """
+        response = _request(self._path, "PING")
+        if response is None or not response.startswith("OK "):
+            return None
+        return int(response[len("OK "):])
+
+    def serve(self, secrets: Dict[str, str], ttl: float) -> None:
+        """ Serves the secrets until the TTL passes or the agent is stopped """
+        if self.status() is not None:
+            raise errors.AgentAlreadyRunningError(f"An agent is already listening on '{self._path}'")
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+        server = _AgentServer(self._path, secrets, ttl)
+        timer = threading.Timer(ttl, server.shutdown)
+        timer.daemon = True
+        timer.start()
+        log.info(f"Agent listening on '{self._path}' for {ttl:.0f} second(s)")
+        try:
+            server.serve_forever()
+        finally:
+            timer.cancel()
+            server.server_close()
+            secrets.clear()
+            try:
+                os.unlink(self._path)
+            except FileNotFoundError:
+                pass
+        log.info("Agent stopped")
+
+    def start(self, secrets: Dict[str, str], ttl: float) -> None:
+        """ Serves the secrets from a detached process, which is handed them through a pipe """
+        if self.status() is not None:
+            raise errors.AgentAlreadyRunningError(f"An agent is already listening on '{self._path}'")
+        utils_path = os.path.join(Path(sys.executable).parent.absolute(), "tbh-utils")
+        proc = subprocess.Popen(
+            [utils_path, "agent", "start", "--foreground", "--secrets-on-stdin", "--ttl", str(ttl), "--socket", self._path],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        proc.stdin.write("".join(f"{name} {value}\n" for name, value in secrets.items()).encode('utf-8'))
+        proc.stdin.close()
+
+        # Wait for it to listen, so hooks run straight afterwards already find it
+        deadline = time.time() + 10
+        while self.status() is None:
+            if proc.poll() is not None or time.time() > deadline:
+                raise errors.AgentStartError(f"Agent failed to start on '{self._path}'")
+            time.sleep(0.05)
+        log.info(f"Agent started on '{self._path}' for {ttl:.0f} second(s)")
+
+    def stop(self) -> bool:
+        return _request(self._path, "STOP") == "OK"
@@ -0,0 +1,308 @@
+import os
+import json
+import time
+import random
+import logging
+import resource
+import tempfile
+import subprocess
+from queue import Empty
+from typing import List, NamedTuple, Optional, Tuple
+
+
+log = logging.getLogger(__name__)
+
+# Synthetic content never contains these letters, and every generated symbol does, so scans find nothing
+# and always do their full amount of work
+_CONTENT_LETTERS = "abcdefghijklmnoprstuvwy"
+_SYMBOL_MARKER = "q"
+
+_AUTHOR_NAME = "Bench Author"
+_AUTHOR_EMAIL = "bench@example.com"
+
+# Seconds between checks that a case's process is still running while waiting for its result
+_POLL_SECONDS = 1.0
+
+
+class BenchConfig(NamedTuple):
+
+    commits: int = 100
+    files: int = 200
+    file_size: int = 4096
+    changes_per_commit: int = 10
+    binary_ratio: float = 0.1
+    staged_files: int = 50
+    symbols: int = 1000
+    regex_ratio: float = 0.05
+    jobs: Optional[int] = None
+    seed: int = 0
+
+
+class BenchResult(NamedTuple):
+
+    name: str
+    wall_seconds: float
+    scanned_bytes: int
+    # Of the process running the case, and of the largest of its worker (and git) processes
+    peak_rss_kb: int
+    children_peak_rss_kb: int
+
+    @property
+    def mb_per_second(self) -> float:
+        return self.scanned_bytes / (1024 * 1024) / self.wall_seconds if self.wall_seconds else 0.0
+
+
+def generate_symbols(count: int, regex_ratio: float, rng: random.Random) -> Tuple[str, ...]:
+    """ Plain words and regexes, in the given mix, none of which match the synthetic content """
+    symbols = []
+    for i in range(count):
+        word = "".join(rng.choice(_CONTENT_LETTERS) for _ in range(rng.randint(5, 10)))
+        if rng.random() < regex_ratio:
+            symbols.append(rf"{word}{_SYMBOL_MARKER}{{2}}\s*\d+")
+        else:
+            symbols.append(f"{word}{_SYMBOL_MARKER}{i}")
+    return tuple(symbols)
+
+
+class _ContentGenerator:
+
+    def __init__(self, config: BenchConfig) -> None:
+        self._config = config
+        self._rng = random.Random(config.seed)
+        self._vocabulary = [
+            "".join(self._rng.choice(_CONTENT_LETTERS) for _ in range(self._rng.randint(2, 10)))
+            for _ in range(5000)
+        ]
+
+    def text(self, size: int) -> bytes:
+        lines = []
+        length = 0
+        while length < size:
+            line = " ".join(self._rng.choices(self._vocabulary, k=12)) + "\n"
+            lines.append(line)
+            length += len(line)
+        return "".join(lines).encode('ascii')[:size]
+
+    def binary(self, size: int) -> bytes:
+        return self._rng.getrandbits(8 * size).to_bytes(size, "little") if size else b""
+
+    def file(self) -> bytes:
+        if self._rng.random() < self._config.binary_ratio:
+            return self.binary(self._config.file_size)
+        return self.text(self._config.file_size)
+
+    def path(self, i: int) -> str:
+        return f"dir{i % 17}/{self._rng.choice(self._vocabulary)}_{i}.txt"
+
+    def sample(self, population: List[str], k: int) -> List[str]:
+        return self._rng.sample(population, min(k, len(population)))
+
+
+def build_repository(path: str, config: BenchConfig) -> int:
+    """ Creates a synthetic repository at `path` with `git fast-import`, returning the bytes of file content
+    in its history
+    """
+    generator = _ContentGenerator(config)
+    subprocess.check_call(["git", "init", "-q", "-b", "main", path])
+    paths = [generator.path(i) for i in range(config.files)]
+
+    content_bytes = 0
+    proc = subprocess.Popen(["git", "fast-import", "--quiet"], cwd=path, stdin=subprocess.PIPE)
+    for c in range(config.commits):
+        message = generator.text(200)
+        changed = paths if c == 0 else generator.sample(paths, config.changes_per_commit)
+        proc.stdin.write(b"commit refs/heads/main\n")
+        proc.stdin.write(f"author {_AUTHOR_NAME} <{_AUTHOR_EMAIL}> {1600000000 + c} +0000\n".encode('ascii'))
+        proc.stdin.write(f"committer {_AUTHOR_NAME} <{_AUTHOR_EMAIL}> {1600000000 + c} +0000\n".encode('ascii'))
+        proc.stdin.write(b"data %d\n%s\n" % (len(message), message))
+        for p in changed:
+            content = generator.file()
+            content_bytes += len(content)
+            proc.stdin.write(f"M 100644 inline {p}\n".encode('utf-8'))
+            proc.stdin.write(b"data %d\n%s\n" % (len(content), content))
+    proc.stdin.close()
+    if proc.wait():
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+    subprocess.check_call(["git", "checkout", "-q", "-f", "main"], cwd=path)
+    return content_bytes
+
+
+def stage_changes(path: str, config: BenchConfig) -> int:
+    """ Rewrites and stages some tracked files, returning the bytes staged """
+    generator = _ContentGenerator(config._replace(seed=config.seed + 1))
+    tracked = subprocess.check_output(["git", "ls-files"], cwd=path).decode('utf-8').splitlines()
+    staged = generator.sample(tracked, config.staged_files)
+    staged_bytes = 0
+    for p in staged:
+        content = generator.file()
+        staged_bytes += len(content)
+        with open(os.path.join(path, p), "wb") as f:
+            f.write(content)
+    subprocess.check_call(["git", "add", "--"] + staged, cwd=path)
+    return staged_bytes
+
+
+# Where the bare repository keeps the commit being "pushed" to it: a pseudo ref, which `--all` leaves out, so
+# its objects are present but new to the repository, as they are in git's quarantine during a real push
+_INCOMING_REF = "BENCH_INCOMING"
+
+
+def build_bare_repository(path: str, repository: str, config: BenchConfig) -> int:
+    """ Creates a bare repository at `path` with the first half of the synthetic history, and the rest waiting
+    to be received as if pushed, returning the bytes of file content new to it
+    """
+    # No hooks of its own, and none of the client's run for these pushes
+    subprocess.check_call(["git", "init", "-q", "--bare", "--template=", "-b", "main", path])
+    held_back = (config.commits + 1) // 2
+    refspecs = [f"main:refs/bench/{_INCOMING_REF}"]
+    if held_back < config.commits:
+        refspecs.append(f"main~{held_back}:refs/heads/main")
+    subprocess.check_call(["git", "push", "-q", "--no-verify", path] + refspecs, cwd=repository)
+    subprocess.check_call(["git", "update-ref", _INCOMING_REF, f"refs/bench/{_INCOMING_REF}"], cwd=path)
+    subprocess.check_call(["git", "update-ref", "-d", f"refs/bench/{_INCOMING_REF}"], cwd=path)
+
+    objects = subprocess.check_output(["git", "rev-list", "--objects", _INCOMING_REF, "--not", "--all"], cwd=path)
+    sizes = subprocess.check_output(
+        ["git", "cat-file", "--batch-check=%(objecttype) %(objectsize)"],
+        cwd=path,
+        input=b"\n".join(line.split(b" ", 1)[0] for line in objects.splitlines()) + b"\n",
+    )
+    return sum(int(size) for kind, size in (line.split() for line in sizes.splitlines()) if kind == b"blob")
+
+
+# Cases run against history, for each way of scanning it
+_HISTORY_MODES = {"pre_push_hook": "log", "pre_push_hook_objects": "objects", "pre_receive_hook": "objects"}
+
+
+def _run_case(repository: str, symbols: Tuple[str, ...], jobs: Optional[int], case: str, queue) -> None:
+    # Runs in a fresh process, so peak RSS is that of this case alone
+    os.chdir(repository)
+    os.environ["GIT_AUTHOR_NAME"] = _AUTHOR_NAME
+    os.environ["GIT_AUTHOR_EMAIL"] = _AUTHOR_EMAIL
+    try:
+        wall = _time_case(symbols, jobs, case)
+    except Exception as e:
+        queue.put((None, f"{type(e).__name__}: {e}"))
+        raise
+    # Worker processes have all been waited for by now, so are included in RUSAGE_CHILDREN
+    queue.put((wall, (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )))
+
+
+def _time_case(symbols: Tuple[str, ...], jobs: Optional[int], case: str) -> float:
+    from .ops import Operations, PushRef, ReceiveRef
+    from .scan import Scanner
+    from .cache import ScanCache
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        t1 = time.time()
+        scanner = Scanner(symbols=symbols)
+        operations = Operations(
+            jobs=jobs,
+            scanner=scanner,
+            cache=ScanCache(path=os.path.join(cache_dir, "cache"), digest=scanner.digest),
+            history_mode=_HISTORY_MODES.get(case, "log"),
+        )
+        if case == "commit_message_hook":
+            operations.commit_message_hook(message="A typical commit message\n\nWith a short body.\n")
+        elif case == "pre_commit_hook":
+            operations.pre_commit_hook()
+        elif case == "pre_commit_hook_full":
+            operations.pre_commit_hook(full=True)
+        elif case == "pre_receive_hook":
+            main = subprocess.run(["git", "rev-parse", "--verify", "-q", "refs/heads/main"], stdout=subprocess.PIPE)
+            old = main.stdout.decode('ascii').strip() or "0" * 40
+            new = subprocess.check_output(["git", "rev-parse", _INCOMING_REF]).decode('ascii').strip()
+            operations.pre_receive_hook(receive_refs=[ReceiveRef(old, new, "refs/heads/main")])
+        elif case in _HISTORY_MODES:
+            head = subprocess.check_output(["git", "rev-parse", "HEAD"]).decode('ascii').strip()
+            operations.pre_push_hook(push_refs=[PushRef("refs/heads/main", head, "refs/heads/main", "0" * 40)])
+        elif case == "scan":
+            operations.scan_git_history()
+            operations.scan_untracked_files()
+            operations.scan_cached_files()
+            operations.assert_no_errors()
+        else:
+            raise ValueError(f"Unknown benchmark case '{case}'")
+        return time.time() - t1
+
+
+def _measure(repository: str, symbols: Tuple[str, ...], jobs: Optional[int], case: str, scanned_bytes: int) -> BenchResult:
+    import multiprocessing
+
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run_case, args=(repository, symbols, jobs, case, queue))
+    process.start()
+    while True:
+        try:
+            wall, outcome = queue.get(timeout=_POLL_SECONDS)
+            break
+        except Empty:
+            if process.is_alive():
+                continue
+        # Killed (e.g. out of memory) before reporting, unless it reported just before exiting
+        try:
+            wall, outcome = queue.get(timeout=_POLL_SECONDS)
+            break
+        except Empty:
+            raise RuntimeError(f"Benchmark case '{case}' exited with code {process.exitcode} before reporting") from None
+    process.join()
+    if wall is None:
+        raise RuntimeError(f"Benchmark case '{case}' failed: {outcome}")
+    peak_rss_kb, children_peak_rss_kb = outcome
+    return BenchResult(
+        name=case,
+        wall_seconds=wall,
+        scanned_bytes=scanned_bytes,
+        peak_rss_kb=peak_rss_kb,
+        children_peak_rss_kb=children_peak_rss_kb,
+    )
+
+
+def run_benchmarks(config: BenchConfig, directory: Optional[str] = None) -> List[BenchResult]:
+    """ Builds a synthetic repository and symbol list and times each hook and the full scan against them
+
+    The pre-receive hook is timed in a bare repository receiving the second half of the history.
+
+    Every case starts from a fresh process and an empty scan cache. Nothing touches the real bad symbols
+    file, scan cache or keyring.
+    """
+    with tempfile.TemporaryDirectory(dir=directory) as root:
+        repository = os.path.join(root, "repository")
+        log.info(f"Building repository with {config.commits} commit(s) of {config.files} file(s)")
+        history_bytes = build_repository(repository, config)
+        staged_bytes = stage_changes(repository, config)
+        bare_repository = os.path.join(root, "bare.git")
+        received_bytes = build_bare_repository(bare_repository, repository, config)
+        symbols = generate_symbols(config.symbols, config.regex_ratio, random.Random(config.seed))
+
+        cases: List[Tuple[str, str, int]] = [
+            ("commit_message_hook", repository, 64),
+            ("pre_commit_hook", repository, staged_bytes),
+            ("pre_commit_hook_full", repository, staged_bytes),
+            ("pre_push_hook", repository, history_bytes),
+            ("pre_push_hook_objects", repository, history_bytes),
+            ("pre_receive_hook", bare_repository, received_bytes),
+            ("scan", repository, history_bytes + staged_bytes),
+        ]
+        results = []
+        for case, path, scanned_bytes in cases:
+            log.info(f"Running '{case}'")
+            results.append(_measure(path, symbols, config.jobs, case, scanned_bytes))
+        return results
+
+
+def report(results: List[BenchResult], as_json: bool = False) -> None:
+    if as_json:
+        print(json.dumps([dict(r._asdict(), mb_per_second=r.mb_per_second) for r in results], indent=4))
+        return
+    print(f"{'case':<22}{'wall (s)':>10}{'MB':>10}{'MB/s':>10}{'peak RSS (MB)':>15}{'children (MB)':>15}")
+    for r in results:
+        print(
+            f"{r.name:<22}{r.wall_seconds:>10.3f}{r.scanned_bytes / (1024 * 1024):>10.2f}"
+            f"{r.mb_per_second:>10.2f}{r.peak_rss_kb / 1024:>15.1f}{r.children_peak_rss_kb / 1024:>15.1f}"
+        )
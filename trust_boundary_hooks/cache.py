@@ -0,0 +1,167 @@
+import os
+import hashlib
+import sqlite3
+import logging
+import time
+from typing import Iterable, List, Set, Tuple
+from . import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+class ScanCache:
+    """ Persistent record of git objects (blobs and commits) known to be free of bad symbols
+
+    Entries are keyed by object SHA and the digest of the bad symbol list they were scanned against, so a
+    changed list never reuses old results. The store is a SQLite database, which serialises concurrent
+    hooks, and is trimmed to `max_entries` by evicting the least recently used entries. Entries are counted
+    once every `max_entries // EVICTION_CHECKS` inserts, rather than on every insert, so it may briefly hold
+    that many more.
+
+    Any failure to use the cache is logged and treated as a cache miss - it only ever saves work. With
+    `rescan`, nothing is reported clean, so everything is scanned again, but results are still recorded.
+    """
+
+    DEFAULT_MAX_ENTRIES = 1000000
+    EVICTION_CHECKS = 100
+    LOCK_TIMEOUT = 30.0
+    _QUERY_BATCH = 500
+
+    def __init__(self, path: str, digest: str, max_entries: int = DEFAULT_MAX_ENTRIES, rescan: bool = False) -> None:
+        self._path = path
+        self._digest = digest
+        self._max_entries = max_entries
+        self._rescan = rescan
+        self._connection = None
+        self._disabled = False
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def rescan(self) -> bool:
+        return self._rescan
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            connection = sqlite3.connect(self._path, timeout=self.LOCK_TIMEOUT)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS clean ("
+                "digest TEXT NOT NULL, "
+                "object TEXT NOT NULL, "
+                "last_used INTEGER NOT NULL, "
+                "PRIMARY KEY (digest, object))"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS clean_last_used ON clean (last_used)")
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def _failed(self, e: Exception) -> None:
+        log.warning(f"Scan cache '{self._path}' unavailable ({e}), scanning without it")
+        self._disabled = True
+
+    def clean_objects(self, objects: Iterable[str]) -> Set[str]:
+        """ Returns the subset of `objects` already known to be clean, refreshing their LRU position """
+        if self._disabled or self._rescan:
+            return set()
+        objects = list(objects)
+        try:
+            with metrics.timer("cache.lookup"):
+                found = self._lookup(objects)
+        except sqlite3.Error as e:
+            self._failed(e)
+            return set()
+        metrics.count("cache.lookups", len(objects))
+        metrics.count("cache.hits", len(found))
+        log.debug(f"Scan cache hit for {len(found)} of {len(objects)} object(s)")
+        return found
+
+    def _lookup(self, objects: List[str]) -> Set[str]:
+        found: Set[str] = set()
+        connection = self._connect()
+        for i in range(0, len(objects), self._QUERY_BATCH):
+            batch = objects[i:i + self._QUERY_BATCH]
+            rows = connection.execute(
+                f"SELECT object FROM clean WHERE digest = ? AND object IN ({','.join('?' * len(batch))})",
+                [self._digest] + batch,
+            )
+            found.update(r[0] for r in rows)
+        if found:
+            with connection:
+                connection.executemany(
+                    "UPDATE clean SET last_used = ? WHERE digest = ? AND object = ?",
+                    [(int(time.time()), self._digest, o) for o in found],
+                )
+        return found
+
+    def is_clean(self, obj: str) -> bool:
+        return obj in self.clean_objects([obj])
+
+    def unknown_objects(self, objects: List[str]) -> List[str]:
+        """ Returns the objects not known to be clean, preserving order """
+        known = self.clean_objects(objects)
+        return [o for o in objects if o not in known]
+
+    def mark_clean(self, objects: Iterable[str]) -> None:
+        if self._disabled:
+            return
+        now = int(time.time())
+        rows = [(self._digest, o, now) for o in objects]
+        if not rows:
+            return
+        try:
+            with metrics.timer("cache.update"):
+                self._insert(rows)
+        except sqlite3.Error as e:
+            self._failed(e)
+
+    def _insert(self, rows: List[Tuple[str, str, int]]) -> None:
+        connection = self._connect()
+        interval = max(1, self._max_entries // self.EVICTION_CHECKS)
+        with connection:
+            (first_rowid, ) = connection.execute("SELECT COALESCE(MAX(rowid), 0) FROM clean").fetchone()
+            connection.executemany("INSERT OR REPLACE INTO clean VALUES (?, ?, ?)", rows)
+            (last_rowid, ) = connection.execute("SELECT COALESCE(MAX(rowid), 0) FROM clean").fetchone()
+            # Each row inserted (or replaced) takes the next row id, so the whole table, which can be large,
+            # is only counted when this insert passes a multiple of the interval
+            if first_rowid // interval == last_rowid // interval:
+                return
+            (count, ) = connection.execute("SELECT COUNT(*) FROM clean").fetchone()
+            if count > self._max_entries:
+                log.debug(f"Evicting {count - self._max_entries} scan cache entries")
+                connection.execute(
+                    "DELETE FROM clean WHERE rowid IN (SELECT rowid FROM clean ORDER BY last_used LIMIT ?)",
+                    (count - self._max_entries, ),
+                )
+
+    def purge_stale(self) -> None:
+        """ Drops every entry recorded against a bad symbol list other than the current one """
+        try:
+            connection = self._connect()
+            with connection:
+                connection.execute("DELETE FROM clean WHERE digest != ?", (self._digest, ))
+        except sqlite3.Error as e:
+            self._failed(e)
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def stat_key(path: str, st: os.stat_result) -> str:
+    """ Identifies a file's content by where it is and what its metadata says, as git's index does, so an
+    unchanged file can be recognised without being read
+    """
+    return f"stat:{st.st_size}:{st.st_mtime_ns}:{st.st_ino}:{path}"
+
+
+def git_blob_sha(content: bytes) -> str:
+    """ The object id git assigns to `content` when stored as a blob """
+    h = hashlib.sha1(b"blob %d\0" % len(content))
+    h.update(content)
+    return h.hexdigest()
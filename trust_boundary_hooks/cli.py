@@ -1,5 +1,6 @@
 import click
 import logging
+import sys
 from .aliased_group import AliasedGroup
 from . import errors
 
@@ -17,6 +18,8 @@ def _setup_logging(ctx, obj, verbose):
     logging.basicConfig(
         level=logging.DEBUG if verbose else logging.INFO,
         handlers=[handler, ],
+        # A hook run by the daemon replaces the daemon's own logging set up
+        force=True,
     )
 
     if log.isEnabledFor(logging.DEBUG):
@@ -25,6 +28,118 @@ def _setup_logging(ctx, obj, verbose):
     return verbose
 
 
+# noinspection PyUnusedLocal
+def _setup_metrics(ctx, obj, output_format):
+    if output_format:
+        import os
+        from .metrics import METRICS_FILE_ENV, enable_metrics
+        enable_metrics(output_format, path=os.environ.get(METRICS_FILE_ENV))
+    return output_format
+
+
+# noinspection PyUnusedLocal
+def _setup_profile(ctx, obj, path):
+    if path:
+        from .metrics import enable_profile
+        enable_profile(path)
+    return path
+
+
+def _instrumentation_options(f):
+    f = click.option(
+        "--metrics",
+        type=click.Choice(["json"]),
+        envvar="TBH_METRICS",
+        callback=_setup_metrics,
+        expose_value=False,
+        is_eager=True,
+        help="Write per-phase timings and counts for this run to stderr (or append them to $TBH_METRICS_FILE)")(f)
+    f = click.option(
+        "--profile",
+        type=click.Path(dir_okay=False),
+        envvar="TBH_PROFILE",
+        callback=_setup_profile,
+        expose_value=False,
+        is_eager=True,
+        help="Write cProfile stats for this run to this file")(f)
+    return f
+
+
+def _refresh_stale_bad_symbols():
+    from .template import Template
+    Template().refresh_in_background()
+
+
+_history_mode_option = click.option(
+    "--history-mode",
+    type=click.Choice(["log", "objects"]),
+    default="log",
+    envvar="TBH_HISTORY_MODE",
+    show_default=True,
+    help="Scan history as each commit's patch (log) or as each reachable object once (objects)")
+
+
+_scan_budget_option = click.option(
+    "--scan-budget",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    envvar="TBH_SCAN_BUDGET",
+    help="Fail if a single search takes longer than this many seconds, rather than risk hanging")
+
+
+def _detection_options(f):
+    f = click.option(
+        "--fail-fast",
+        is_flag=True,
+        envvar="TBH_FAIL_FAST",
+        help="Stop scanning at the first detection")(f)
+    f = click.option(
+        "--max-detections",
+        type=click.IntRange(min=0),
+        default=1000,
+        envvar="TBH_MAX_DETECTIONS",
+        show_default=True,
+        help="Keep at most this many detections, or 0 to keep them all; any more are only counted")(f)
+    return f
+
+
+_jobs_option = click.option(
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=None,
+    envvar="TBH_JOBS",
+    help="Number of processes used to scan files (default: automatic, based on CPUs and file count)")
+
+
+class _HookCommand(click.Command):
+    """ A hook, which runs in the scanner daemon when one is listening and in this process otherwise """
+
+    # Hooks which read stdin have it read here and passed on to the daemon
+    reads_stdin = False
+
+    def main(self, args=None, prog_name=None, **extra):
+        import os
+        from .daemon import run_in_daemon
+
+        args = sys.argv[1:] if args is None else list(args)
+        prog_name = prog_name or os.path.basename(sys.argv[0])
+        stdin = None
+        if self.reads_stdin:
+            import io
+            stdin = sys.stdin.read()
+            sys.stdin = io.StringIO(stdin)
+
+        exit_code = run_in_daemon(self.name, prog_name, args, stdin=stdin)
+        if exit_code is not None:
+            sys.exit(exit_code)
+        return super().main(args, prog_name, **extra)
+
+
+class _StdinHookCommand(_HookCommand):
+
+    reads_stdin = True
+
+
 @click.command()
 @click.option(
     "--verbose",
@@ -56,7 +171,7 @@ def tbh_setup():
     Template().setup()
 
 
-@click.command()
+@click.command(cls=_HookCommand)
 @click.option(
     "--verbose",
     is_flag=True,
@@ -64,14 +179,26 @@ def tbh_setup():
     expose_value=False,
     is_eager=True,
     help="Enable DEBUG logging level")
-def tbh_hook_pre_commit():
+@_instrumentation_options
+@_jobs_option
+@_scan_budget_option
+@_detection_options
+@click.option(
+    "--full",
+    is_flag=True,
+    envvar="TBH_PRE_COMMIT_FULL",
+    help="Scan the whole of every staged file rather than only the lines added")
+def tbh_hook_pre_commit(jobs, scan_budget, fail_fast, max_detections, full):
     """ Git hook run before commit
     """
     from .ops import Operations
-    Operations().pre_commit_hook()
+    _refresh_stale_bad_symbols()
+    Operations(
+        jobs=jobs, scan_budget=scan_budget, fail_fast=fail_fast, max_detections=max_detections
+    ).pre_commit_hook(full=full)
 
 
-@click.command()
+@click.command(cls=_HookCommand)
 @click.option(
     "--verbose",
     is_flag=True,
@@ -79,18 +206,24 @@ def tbh_hook_pre_commit():
     expose_value=False,
     is_eager=True,
     help="Enable DEBUG logging level")
+@_instrumentation_options
+@_scan_budget_option
+@_detection_options
 @click.argument("commit_message_file")
-def tbh_hook_commit_msg(commit_message_file):
+def tbh_hook_commit_msg(commit_message_file, scan_budget, fail_fast, max_detections):
     """ Git hook run on commit message """
     from .ops import Operations
+    _refresh_stale_bad_symbols()
 
     with open(commit_message_file, "r") as f:
         message = f.read()
 
-    Operations().commit_message_hook(message=message)
+    Operations(
+        scan_budget=scan_budget, fail_fast=fail_fast, max_detections=max_detections
+    ).commit_message_hook(message=message)
 
 
-@click.command()
+@click.command(cls=_StdinHookCommand)
 @click.option(
     "--verbose",
     is_flag=True,
@@ -98,13 +231,62 @@ def tbh_hook_commit_msg(commit_message_file):
     expose_value=False,
     is_eager=True,
     help="Enable DEBUG logging level")
+@_instrumentation_options
+@click.option(
+    "--full",
+    is_flag=True,
+    envvar="TBH_PRE_PUSH_FULL",
+    help="Scan the whole git history rather than only the commits being pushed")
+@_history_mode_option
+@_scan_budget_option
+@_detection_options
 @click.argument("name")
 @click.argument("location")
-def tbh_hook_pre_push(name, location):
-    """ Git hook run before push """
-    from .ops import Operations
+def tbh_hook_pre_push(name, location, full, history_mode, scan_budget, fail_fast, max_detections):
+    """ Git hook run before push
+
+    Git passes `<local ref> <local sha> <remote ref> <remote sha>` lines on stdin.
+    """
+    from .ops import Operations, parse_push_refs
+    _refresh_stale_bad_symbols()
+
+    push_refs = parse_push_refs(sys.stdin.read().splitlines())
+    Operations(
+        history_mode=history_mode, scan_budget=scan_budget, fail_fast=fail_fast, max_detections=max_detections
+    ).pre_push_hook(push_refs=push_refs, full=full)
+
+
+@click.command(cls=_StdinHookCommand)
+@click.option(
+    "--verbose",
+    is_flag=True,
+    callback=_setup_logging,
+    expose_value=False,
+    is_eager=True,
+    help="Enable DEBUG logging level")
+@_instrumentation_options
+@_jobs_option
+@click.option(
+    "--history-mode",
+    type=click.Choice(["log", "objects"]),
+    default="objects",
+    envvar="TBH_HISTORY_MODE",
+    show_default=True,
+    help="Scan pushed history as each commit's patch (log) or as each new object once (objects)")
+@_scan_budget_option
+@_detection_options
+def tbh_hook_pre_receive(jobs, history_mode, scan_budget, fail_fast, max_detections):
+    """ Git hook run by a (server side) repository before accepting a push
+
+    Git passes `<old sha> <new sha> <ref>` lines on stdin. Only objects new to the repository are scanned.
+    """
+    from .ops import Operations, parse_receive_refs
+    _refresh_stale_bad_symbols()
 
-    Operations().pre_push_hook()
+    receive_refs = parse_receive_refs(sys.stdin.read().splitlines())
+    Operations(
+        jobs=jobs, history_mode=history_mode, scan_budget=scan_budget, fail_fast=fail_fast, max_detections=max_detections
+    ).pre_receive_hook(receive_refs=receive_refs)
 
 
 @click.group(cls=AliasedGroup, invoke_without_command=True)
@@ -115,6 +297,7 @@ def tbh_hook_pre_push(name, location):
     expose_value=False,
     is_eager=True,
     help="Enable DEBUG logging level")
+@_instrumentation_options
 @click.pass_context
 def tbh_utils(ctx):
     """ tbh-utils
@@ -128,25 +311,280 @@ def tbh_utils(ctx):
 
 
 @tbh_utils.command("refresh")
-def update_bad_symbols():
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Download the bad symbols even if the object's ETag is unchanged")
+def update_bad_symbols(force):
     """ Refresh the bad symbol list from Minio object store
     """
     from .template import Template
-    Template().update_bad_symbols()
+    Template().update_bad_symbols(force=force)
 
 
 @tbh_utils.command("scan")
-def scan():
+@_jobs_option
+@_history_mode_option
+@_scan_budget_option
+@_detection_options
+@click.option(
+    "--repos",
+    type=click.Path(exists=True),
+    multiple=True,
+    help="Scan every git repository under this directory, or listed one per line in this file, rather than "
+         "the current one (repeatable)")
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Scan everything again, ignoring results cached from earlier scans (new results are still cached)")
+def scan(jobs, history_mode, scan_budget, fail_fast, max_detections, repos, no_cache):
     """ Scan git history and untracked files
+
+    With --repos, many repositories are scanned at once, with history shared between them scanned only once.
     """
+    from .scan import Scanner, scanning
+    scanner = Scanner(budget=scan_budget, max_detections=max_detections, fail_fast=fail_fast)
+    if repos:
+        from .fleet import FleetScan, find_repositories
+        found = find_repositories(repos)
+        if not found:
+            raise click.ClickException("No git repositories found")
+        fleet = FleetScan(found, jobs=jobs, scanner=scanner, history_mode=history_mode, rescan=no_cache)
+        with scanning():
+            fleet.scan()
+        fleet.assert_no_errors()
+        return
+
     from .ops import Operations
-    operations = Operations()
-    operations.scan_git_history()
-    operations.scan_untracked_files()
-    operations.scan_cached_files()
+    operations = Operations(jobs=jobs, history_mode=history_mode, scanner=scanner, rescan=no_cache)
+    with scanning():
+        operations.scan_git_history()
+        operations.scan_untracked_files()
+        operations.scan_cached_files()
     operations.assert_no_errors()
 
 
+@tbh_utils.group("agent", cls=AliasedGroup)
+def agent():
+    """ Hold the local encryption key in memory so hooks skip the keyring
+    """
+
+
+@agent.command("start")
+@click.option(
+    "--ttl",
+    type=click.FloatRange(min=1),
+    default=8 * 60 * 60,
+    envvar="TBH_AGENT_TTL",
+    show_default=True,
+    help="Seconds to hold the key for")
+@click.option("--socket", "socket_path", type=click.Path(dir_okay=False), help="Socket to listen on")
+@click.option("--foreground", is_flag=True, help="Serve from this process rather than a detached one")
+@click.option("--secrets-on-stdin", is_flag=True, hidden=True)
+def agent_start(ttl, socket_path, foreground, secrets_on_stdin):
+    """ Start an agent listening on a Unix socket only you can use
+
+    The key is read from the keyring once, here, and handed out to hooks until the TTL passes. Hooks fall
+    back to the keyring whenever no agent is running.
+    """
+    from .agent import Agent
+    from .crypto import Crypto
+
+    if secrets_on_stdin:
+        secrets = dict(line.split(" ", 1) for line in sys.stdin.read().splitlines() if line)
+    else:
+        password = Crypto().dar_password
+        if not password:
+            raise click.ClickException("No key in the keyring yet, run tbh-setup first")
+        secrets = {Crypto.DAR_KEY_NAME: password}
+
+    if foreground:
+        Agent(socket_path).serve(secrets=secrets, ttl=ttl)
+    else:
+        Agent(socket_path).start(secrets=secrets, ttl=ttl)
+
+
+@agent.command("stop")
+@click.option("--socket", "socket_path", type=click.Path(dir_okay=False), help="Socket the agent listens on")
+def agent_stop(socket_path):
+    """ Stop a running agent """
+    from .agent import Agent
+    a = Agent(socket_path)
+    if a.stop():
+        log.info(f"Stopped agent on '{a.path}'")
+    else:
+        log.info(f"No agent running on '{a.path}'")
+
+
+@agent.command("status")
+@click.option("--socket", "socket_path", type=click.Path(dir_okay=False), help="Socket the agent listens on")
+def agent_status(socket_path):
+    """ Show whether an agent is running """
+    from .agent import Agent
+    a = Agent(socket_path)
+    remaining = a.status()
+    if remaining is None:
+        print(f"No agent running on '{a.path}'")
+    else:
+        print(f"Agent running on '{a.path}', expiring in {remaining} second(s)")
+
+
+def _hooks():
+    return {hook.name: hook for hook in (tbh_hook_pre_commit, tbh_hook_commit_msg, tbh_hook_pre_push, tbh_hook_pre_receive)}
+
+
+@tbh_utils.group("daemon", cls=AliasedGroup)
+def daemon():
+    """ Keep the bad symbols loaded in a long running process that hooks hand their scans to
+    """
+
+
+@daemon.command("start")
+@click.option("--socket", "socket_path", type=click.Path(dir_okay=False), help="Socket to listen on")
+@click.option("--foreground", is_flag=True, help="Serve from this process rather than a detached one")
+def daemon_start(socket_path, foreground):
+    """ Start a daemon listening on a Unix socket only you can use
+
+    Hooks run in a process forked from the daemon, with the bad symbols already loaded, and behave exactly as
+    they would otherwise. The bad symbols are loaded again whenever their file changes. Hooks run in their own
+    process whenever no daemon is running, or when TBH_NO_DAEMON is set.
+    """
+    from .daemon import Daemon
+
+    if foreground:
+        Daemon(socket_path).serve(hooks=_hooks())
+    else:
+        Daemon(socket_path).start()
+
+
+@daemon.command("stop")
+@click.option("--socket", "socket_path", type=click.Path(dir_okay=False), help="Socket the daemon listens on")
+def daemon_stop(socket_path):
+    """ Stop a running daemon """
+    from .daemon import Daemon
+    d = Daemon(socket_path)
+    if d.stop():
+        log.info(f"Stopped daemon on '{d.path}'")
+    else:
+        log.info(f"No daemon running on '{d.path}'")
+
+
+@daemon.command("status")
+@click.option("--socket", "socket_path", type=click.Path(dir_okay=False), help="Socket the daemon listens on")
+def daemon_status(socket_path):
+    """ Show whether a daemon is running """
+    from .daemon import Daemon
+    d = Daemon(socket_path)
+    status = d.status()
+    if status is None:
+        print(f"No daemon running on '{d.path}'")
+    else:
+        print(f"Daemon running on '{d.path}' (pid {status['pid']}), with {status['symbols']} bad symbol(s) loaded")
+
+
+@tbh_utils.command("watch")
+@click.option(
+    "--path",
+    type=click.Path(file_okay=False, exists=True),
+    default=".",
+    help="Working tree to watch (default: the current directory)")
+def watch(path):
+    """ Scan files as they are saved, so the pre-commit hook finds them already scanned
+
+    Runs until interrupted.
+    """
+    from .watch import Watcher
+    try:
+        Watcher(path).watch()
+    except KeyboardInterrupt:
+        log.info("Stopped watching")
+
+
+@tbh_utils.command("startup")
+@click.option(
+    "--budget-ms",
+    type=float,
+    default=None,
+    help="Fail if importing the hook modules takes longer than this")
+def check_startup(budget_ms):
+    """ Measure hook start up (import) time against a budget
+    """
+    from .startup import DEFAULT_BUDGET_MS, check_hook_imports
+    failures = check_hook_imports(budget_ms=DEFAULT_BUDGET_MS if budget_ms is None else budget_ms)
+    for failure in failures:
+        log.error(failure)
+    if failures:
+        raise errors.StartupBudgetExceededError("Hook start up is over budget!")
+
+
+@tbh_utils.command("bench")
+@click.option("--commits", type=click.IntRange(min=1), default=100, show_default=True, help="Commits in the synthetic history")
+@click.option("--files", type=click.IntRange(min=1), default=200, show_default=True, help="Files in the synthetic tree")
+@click.option("--file-size", type=click.IntRange(min=0), default=4096, show_default=True, help="Bytes per file")
+@click.option("--changes-per-commit", type=click.IntRange(min=1), default=10, show_default=True, help="Files rewritten by each commit after the first")
+@click.option("--binary-ratio", type=click.FloatRange(0, 1), default=0.1, show_default=True, help="Fraction of files with binary content")
+@click.option("--staged-files", type=click.IntRange(min=0), default=50, show_default=True, help="Files staged for the pre-commit hook")
+@click.option("--symbols", type=click.IntRange(min=1), default=1000, show_default=True, help="Bad symbols to generate")
+@click.option("--regex-ratio", type=click.FloatRange(0, 1), default=0.05, show_default=True, help="Fraction of symbols that are regexes")
+@click.option("--seed", type=int, default=0, show_default=True, help="Random seed for the synthetic data")
+@click.option("--directory", type=click.Path(file_okay=False, exists=True), default=None, help="Where to build the synthetic repository")
+@click.option("--json", "as_json", is_flag=True, help="Report results as JSON")
+@_jobs_option
+def bench(directory, as_json, **kwargs):
+    """ Benchmark the hooks and scan against a synthetic repository
+    """
+    from .bench import BenchConfig, report, run_benchmarks
+    report(run_benchmarks(BenchConfig(**kwargs), directory=directory), as_json=as_json)
+
+
+@tbh_utils.command("lint-symbols")
+@click.option(
+    "--file",
+    "symbols_file",
+    type=click.Path(dir_okay=False, exists=True),
+    default=None,
+    help="Plain text bad symbols list to check, e.g. before uploading it (default: the current list)")
+@click.option(
+    "--corpus",
+    type=click.Path(dir_okay=False, exists=True),
+    multiple=True,
+    help="File of real content to also time each regex against (repeatable)")
+def lint_symbols(symbols_file, corpus):
+    """ Check bad symbol regexes for catastrophic backtracking
+
+    Each regex is timed on its own against input built to make it backtrack, at growing lengths, and against
+    any corpus files given. Regexes that time out, whose search time grows faster than linearly or that don't
+    compile are reported.
+    """
+    from .lint import MAX_GROWTH_EXPONENT, lint_symbols
+    from .scan import load_bad_symbols, parse_bad_symbols
+
+    if symbols_file:
+        with open(symbols_file, "r") as f:
+            symbols = parse_bad_symbols(f.read())
+    else:
+        symbols = load_bad_symbols()
+
+    corpora = []
+    for path in corpus:
+        with open(path, "rb") as f:
+            corpora.append(f.read().decode('utf-8', errors='replace'))
+
+    results = lint_symbols(symbols, corpora)
+    problems = [result for result in results if not result.ok]
+    for result in results:
+        growth = "-" if result.exponent is None else f"{result.exponent:.2f}"
+        print(
+            f"{'FAIL' if not result.ok else 'ok':4}  growth {growth:>5}  worst {result.worst_seconds * 1000:9.3f}ms  "
+            f"corpora {result.corpus_seconds * 1000:9.3f}ms  {result.symbol}"
+        )
+    log.info(f"Checked {len(results)} regex(es) among {len(symbols)} bad symbol(s), growth limit {MAX_GROWTH_EXPONENT}")
+    for result in problems:
+        log.error(f"Bad symbol '{result.symbol}' {result.problem}")
+    if problems:
+        raise errors.BadSymbolsLintError(f"{len(problems)} bad symbol regex(es) could stall scans!")
+
+
 @tbh_utils.command("bad-symbols")
 def print_bad_symbols():
     """ Display the contents of the bad symbols file
@@ -165,5 +603,9 @@ def scan():
     from .template import Template
     t = Template()
     print(f"Bad symbols file: '{t.bad_symbols_path}'")
+    print(f"Bad symbols index file: '{t.symbol_index_path}'")
     print(f"Global template directory: '{t.global_template_path}'")
     print(f"Minio Configuration file: '{t.minio_configuration_path}'")
+    print(f"Scan cache file: '{t.scan_cache_path}'")
+    print(f"Bad symbols refresh state file: '{t.refresh_state_path}'")
+    print(f"Background refresh log: '{t.refresh_log_path}'")
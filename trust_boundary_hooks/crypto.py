@@ -1,10 +1,10 @@
-import keyring
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 import base64
 import logging
 from typing import Any, Optional
 import getpass
+from . import metrics
 
 log = logging.getLogger(__name__)
 
@@ -20,10 +20,14 @@ class Crypto:
 
     @property
     def minio_secret_key(self) -> str:
-        key = keyring.get_password(
-            service_name=self.SERVICE_NAME,
-            username=self.MINIO_SECRET_KEY_NAME,
-        )
+        # Imported when needed, as hooks mostly get their key from the agent
+        import keyring
+
+        with metrics.timer("crypto.keyring"):
+            key = keyring.get_password(
+                service_name=self.SERVICE_NAME,
+                username=self.MINIO_SECRET_KEY_NAME,
+            )
         if not key:
             key = getpass.getpass(prompt="Enter the MINIO secret key: ")
             assert key
@@ -35,6 +39,8 @@ class Crypto:
         return key
 
     def _generate_password(self) -> str:
+        import keyring
+
         # Generate a new key...
         log.warning("Generating DAR credentials in keyring")
         key = get_random_bytes(16)
@@ -51,11 +57,25 @@ class Crypto:
         assert password
         return password
 
+    @property
+    def dar_password(self) -> Optional[str]:
+        """ The key for the local encrypted files: from a running agent if there is one, else the keyring """
+        from .agent import get_secret
+
+        with metrics.timer("crypto.agent"):
+            password = get_secret(self.DAR_KEY_NAME)
+        if password is not None:
+            return password
+        import keyring
+
+        with metrics.timer("crypto.keyring"):
+            return keyring.get_password(
+                service_name=self.SERVICE_NAME,
+                username=self.DAR_KEY_NAME,
+            )
+
     def _create_cipher(self, nonce: Optional[bytes] = None) -> Any:
-        password = keyring.get_password(
-            service_name=self.SERVICE_NAME,
-            username=self.DAR_KEY_NAME,
-        )
+        password = self.dar_password
         if (password is None) and (nonce is None):
             password = self._generate_password()
         if not password:
@@ -64,20 +84,27 @@ class Crypto:
         key = base64.b64decode(password.encode('ascii'))
         return AES.new(key, AES.MODE_GCM, nonce=nonce)
 
-    def encrypt(self, value: str) -> str:
+    def encrypt_bytes(self, value: bytes) -> bytes:
         cipher = self._create_cipher()
-        ciphertext, tag = cipher.encrypt_and_digest(value.encode('utf-8'))
-        output = cipher.nonce + tag + ciphertext
+        with metrics.timer("crypto.encrypt"):
+            ciphertext, tag = cipher.encrypt_and_digest(value)
+        return cipher.nonce + tag + ciphertext
+
+    def decrypt_bytes(self, value: bytes) -> bytes:
+        nonce = value[:16]
+        tag = value[16:32]
+        ciphertext = value[32:]
+        cipher = self._create_cipher(nonce=nonce)
+        with metrics.timer("crypto.decrypt"):
+            return cipher.decrypt_and_verify(ciphertext, tag)
+
+    def encrypt(self, value: str) -> str:
+        output = self.encrypt_bytes(value.encode('utf-8'))
         encoded_output = base64.b64encode(output).decode('ascii')
         return encoded_output
 
     def decrypt(self, value: str) -> str:
         bin_value = base64.b64decode(value.encode('ascii'))
-        nonce = bin_value[:16]
-        tag = bin_value[16:32]
-        ciphertext = bin_value[32:]
-        cipher = self._create_cipher(nonce=nonce)
-        data = cipher.decrypt_and_verify(ciphertext, tag)
-        return data.decode('utf-8')
+        return self.decrypt_bytes(bin_value).decode('utf-8')
 
 
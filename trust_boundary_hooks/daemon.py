@@ -0,0 +1,415 @@
+import io
+import os
+import sys
+import json
+import time
+import select
+import signal
+import socket
+import struct
+import logging
+import threading
+import traceback
+import socketserver
+import subprocess
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+from . import errors
+from .unix_socket import PrivateUnixStreamServer, connect
+
+
+log = logging.getLogger(__name__)
+
+# Overrides where the daemon listens (and where hooks look for it)
+DAEMON_SOCKET_ENV = "TBH_DAEMON_SOCK"
+
+# Set to run hooks in process even when a daemon is listening
+NO_DAEMON_ENV = "TBH_NO_DAEMON"
+
+# Hooks give up connecting to an unresponsive daemon quickly and scan in process instead
+CLIENT_TIMEOUT = 1.0
+
+# A hook run by the daemon sends a heartbeat this often while it has no output to send, and is given up on
+# (and run in process instead) when nothing at all arrives for RESPONSE_TIMEOUT
+HEARTBEAT_INTERVAL = 1.0
+RESPONSE_TIMEOUT = 10.0
+
+# Seconds between checks of the bad symbols file for changes
+RELOAD_INTERVAL = 0.5
+
+_LENGTH = struct.Struct(">I")
+
+# True in the daemon's own processes, whose hooks must run rather than delegate back to the daemon
+_serving = False
+
+
+def socket_path() -> str:
+    if os.environ.get(DAEMON_SOCKET_ENV):
+        return os.environ[DAEMON_SOCKET_ENV]
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, "tbh-daemon.sock")
+    return os.path.expanduser("~/.tbh_daemon.sock")
+
+
+def _send(connection: socket.socket, message: Dict[str, Any]) -> None:
+    data = json.dumps(message).encode('utf-8')
+    connection.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def _receive_exactly(connection: socket.socket, size: int) -> Optional[bytes]:
+    data = b""
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def _receive(connection: socket.socket) -> Optional[Dict[str, Any]]:
+    """ One length prefixed JSON message, or None if the other end hung up first """
+    header = _receive_exactly(connection, _LENGTH.size)
+    if header is None:
+        return None
+    (length, ) = _LENGTH.unpack(header)
+    data = _receive_exactly(connection, length)
+    return None if data is None else json.loads(data.decode('utf-8'))
+
+
+def _request(path: str, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """ Sends one request to the daemon, returning its response, or None if there is no usable daemon """
+    client = connect(path, CLIENT_TIMEOUT)
+    if client is None:
+        return None
+    try:
+        with client:
+            _send(client, message)
+            return _receive(client)
+    except (OSError, ValueError) as e:
+        log.debug(f"Daemon at '{path}' unavailable ({e})")
+        return None
+
+
+def run_in_daemon(name: str, prog_name: str, args: List[str], stdin: Optional[str] = None) -> Optional[int]:
+    """ Runs the named hook in a daemon, writing its output here as it comes, and returns its exit code
+
+    Returns None when no daemon is listening, or it stops responding, so the hook can run in process.
+    """
+    if _serving or os.environ.get(NO_DAEMON_ENV):
+        return None
+    path = socket_path()
+    client = connect(path, CLIENT_TIMEOUT)
+    if client is None:
+        return None
+    streams = {"stdout": sys.stdout, "stderr": sys.stderr}
+    try:
+        with client:
+            _send(client, {
+                "command": "RUN",
+                "hook": name,
+                "prog_name": prog_name,
+                "args": args,
+                "cwd": os.getcwd(),
+                "env": dict(os.environ),
+                "stdin": stdin,
+                "color": sys.stderr.isatty(),
+                "line_buffered": sys.stdout.line_buffering,
+            })
+            # A hook can scan for a long time, e.g. a whole history, but is never quiet for long
+            client.settimeout(RESPONSE_TIMEOUT)
+            while True:
+                message = _receive(client)
+                if message is None or "error" in message:
+                    break
+                if "exit_code" in message:
+                    return message["exit_code"]
+                if "stream" in message:
+                    # Output is carried as Latin-1, which maps every byte to one character
+                    stream = streams[message["stream"]]
+                    stream.buffer.write(message["data"].encode('latin-1'))
+                    stream.flush()
+    except (OSError, ValueError) as e:
+        log.debug(f"Daemon at '{path}' unavailable ({e})")
+    log.warning(f"Daemon at '{path}' did not finish running the hook, running it in process")
+    return None
+
+
+def _exit_code(e: SystemExit) -> int:
+    if e.code is None or isinstance(e.code, int):
+        return e.code or 0
+    print(e.code, file=sys.stderr)
+    return 1
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    """ Handles one request, in a process forked from the daemon for it """
+
+    server: "_DaemonServer"
+
+    def handle(self) -> None:
+        request = _receive(self.request)
+        if request is None:
+            return
+        command = request.get("command")
+        if command == "PING":
+            _send(self.request, {"pid": os.getppid(), "symbols": self.server.symbol_count, "started": self.server.started})
+        elif command == "STOP":
+            _send(self.request, {"stopped": True})
+            os.kill(os.getppid(), signal.SIGTERM)
+        elif command == "RUN" and request.get("hook") in self.server.hooks:
+            self._run(request)
+        else:
+            _send(self.request, {"error": f"Unknown request '{command}'"})
+
+    def _run(self, request: Dict[str, Any]) -> None:
+        """ Runs a hook as if in the hook's own process, sending its output as it is written, then its exit
+        code
+        """
+        global _serving
+        from . import metrics
+
+        _serving = True
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.chdir(request["cwd"])
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = [request["prog_name"]] + request["args"]
+        sys.stdin = io.StringIO(request["stdin"] or "")
+        # Only this run's work is reported, not the daemon's loading of the bad symbols
+        metrics.metrics.reset()
+
+        hook = self.server.hooks[request["hook"]]
+        with _ForwardedOutput(self.request) as output:
+            # Buffered as the hook's own process would be, so its output comes out in the same order
+            sys.stdout = output.text_stream("stdout", line_buffering=request.get("line_buffered", False))
+            sys.stderr = output.text_stream("stderr", line_buffering=True)
+            exit_code = 0
+            try:
+                hook.main(request["args"], prog_name=request["prog_name"], color=request["color"])
+            except SystemExit as e:
+                exit_code = _exit_code(e)
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                metrics.run_exit_handlers()
+                sys.stdout.flush()
+                sys.stderr.flush()
+        _send(self.request, {"exit_code": exit_code})
+
+
+class _StreamWriter(io.RawIOBase):
+
+    def __init__(self, output: "_ForwardedOutput", stream: str) -> None:
+        super().__init__()
+        self._output = output
+        self._stream = stream
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._output.send(self._stream, bytes(data))
+        return len(data)
+
+
+class _ForwardedOutput:
+    """ Sends what a hook run by the daemon writes to the client, as one stream of messages tagged with the
+    stream written to, in the order written
+
+    The hook's own output is sent as it is flushed. Output of its subprocesses (written to file descriptors 1
+    and 2) is read from pipes, and sent before any later output of the hook's own. A heartbeat is sent
+    whenever there is no output for a while, so the client can tell a quiet hook from a wedged daemon.
+    """
+
+    def __init__(self, connection: socket.socket) -> None:
+        self._connection = connection
+        self._lock = threading.Lock()
+        self._pipes: Dict[int, str] = {}
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._forward, daemon=True)
+
+    def __enter__(self) -> "_ForwardedOutput":
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, stream in ((1, "stdout"), (2, "stderr")):
+            read_fd, write_fd = os.pipe()
+            os.dup2(write_fd, fd)
+            os.close(write_fd)
+            os.set_blocking(read_fd, False)
+            self._pipes[read_fd] = stream
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        # Closing the pipes' write ends lets whatever is left in them be read
+        null_fd = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(null_fd, 1)
+        os.dup2(null_fd, 2)
+        os.close(null_fd)
+        self._done.set()
+        self._thread.join()
+
+    def text_stream(self, stream: str, line_buffering: bool) -> io.TextIOWrapper:
+        return io.TextIOWrapper(
+            io.BufferedWriter(_StreamWriter(self, stream)),
+            encoding=sys.stdout.encoding,
+            errors=sys.stdout.errors,
+            line_buffering=line_buffering,
+        )
+
+    def send(self, stream: str, data: bytes) -> None:
+        with self._lock:
+            self._send_piped()
+            self._send(stream, data)
+
+    def _send(self, stream: str, data: bytes) -> None:
+        if data:
+            _send(self._connection, {"stream": stream, "data": data.decode('latin-1')})
+
+    def _send_piped(self) -> bool:
+        """ Sends whatever is waiting in the pipes, returning False once they are all closed """
+        for read_fd, stream in list(self._pipes.items()):
+            while True:
+                try:
+                    data = os.read(read_fd, 65536)
+                except BlockingIOError:
+                    break
+                if not data:
+                    os.close(read_fd)
+                    del self._pipes[read_fd]
+                    break
+                self._send(stream, data)
+        return bool(self._pipes)
+
+    def _forward(self) -> None:
+        try:
+            while True:
+                with self._lock:
+                    if not self._send_piped():
+                        return
+                    pipes = list(self._pipes)
+                readable, _, _ = select.select(pipes, [], [], HEARTBEAT_INTERVAL)
+                if not readable:
+                    if self._done.is_set():
+                        # Held open by a process outliving the hook
+                        return
+                    with self._lock:
+                        _send(self._connection, {"heartbeat": True})
+        except OSError as e:
+            log.debug(f"Unable to send output to the hook ({e})")
+
+
+class _DaemonServer(socketserver.ForkingMixIn, PrivateUnixStreamServer):
+
+    def __init__(self, path: str, hooks: Dict[str, Any]) -> None:
+        self.hooks = hooks
+        self.started = time.time()
+        self.symbol_count = 0
+        self._bad_symbols_stat: Optional[Tuple[int, int, int]] = None
+        super().__init__(path, _Handler)
+
+    def service_actions(self) -> None:
+        super().service_actions()
+        self.reload()
+
+    def reload(self) -> None:
+        """ Loads the bad symbols again if their file has changed since they were last loaded
+
+        Requests are served by processes forked from this one, which find the index already loaded (and all
+        its regexes compiled) and only read and hash the bad symbols file to check it is still current.
+        """
+        from .scan import load_symbol_index
+        from .template import Template
+
+        path = Template().bad_symbols_path
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        bad_symbols_stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if bad_symbols_stat == self._bad_symbols_stat:
+            return
+        try:
+            index = load_symbol_index().precompile()
+        except Exception as e:
+            # Hooks load the bad symbols themselves until the file can be loaded here
+            log.warning(f"Unable to load bad symbols '{path}' ({e})")
+            return
+        self._bad_symbols_stat = bad_symbols_stat
+        self.symbol_count = len(index.symbols)
+        log.info(f"Loaded {self.symbol_count} bad symbol(s) from '{path}'")
+
+
+class Daemon:
+    """ Keeps the bad symbols loaded, and their regexes compiled, in a long running process which hooks hand
+    their work to over a Unix socket only the current user can connect to
+
+    Each hook runs in a process forked from the daemon, with the hook's arguments, working directory,
+    environment and stdin, so it behaves exactly as it would in its own process; its output, as it is
+    written, and exit code are handed back to the hook.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self._path = path or socket_path()
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    def status(self) -> Optional[Dict[str, Any]]:
+        """ The process id of a running daemon, the number of bad symbols it has loaded and when it started,
+        or None if none is running
+        """
+        response = _request(self._path, {"command": "PING"})
+        if response is None or "pid" not in response:
+            return None
+        return response
+
+    def serve(self, hooks: Dict[str, Any]) -> None:
+        """ Serves the hooks, by name, until the daemon is stopped """
+        if self.status() is not None:
+            raise errors.DaemonAlreadyRunningError(f"A daemon is already listening on '{self._path}'")
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+
+        server = _DaemonServer(self._path, hooks)
+        # Stopped by a signal, as a request is handled in a child process which can't shut the server down
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        server.reload()
+        log.info(f"Daemon listening on '{self._path}'")
+        try:
+            server.serve_forever(poll_interval=RELOAD_INTERVAL)
+        finally:
+            server.server_close()
+            try:
+                os.unlink(self._path)
+            except FileNotFoundError:
+                pass
+            log.info("Daemon stopped")
+
+    def start(self) -> None:
+        """ Serves from a detached process """
+        if self.status() is not None:
+            raise errors.DaemonAlreadyRunningError(f"A daemon is already listening on '{self._path}'")
+        utils_path = os.path.join(Path(sys.executable).parent.absolute(), "tbh-utils")
+        proc = subprocess.Popen(
+            [utils_path, "daemon", "start", "--foreground", "--socket", self._path],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+        # Wait for it to listen, so hooks run straight afterwards already use it
+        deadline = time.time() + 30
+        while self.status() is None:
+            if proc.poll() is not None or time.time() > deadline:
+                raise errors.DaemonStartError(f"Daemon failed to start on '{self._path}'")
+            time.sleep(0.05)
+        log.info(f"Daemon started on '{self._path}'")
+
+    def stop(self) -> bool:
+        response = _request(self._path, {"command": "STOP"})
+        return response is not None and response.get("stopped", False)
@@ -21,5 +21,41 @@ class MinioObjectMissingError(TBHBaseError):
     pass
 
 
+class BadSymbolSourcesError(TBHBaseError):
+    pass
+
+
 class BadSymbolsDetectedError(TBHBaseError):
     pass
+
+
+class StartupBudgetExceededError(TBHBaseError):
+    pass
+
+
+class AgentAlreadyRunningError(TBHBaseError):
+    pass
+
+
+class AgentStartError(TBHBaseError):
+    pass
+
+
+class DaemonAlreadyRunningError(TBHBaseError):
+    pass
+
+
+class DaemonStartError(TBHBaseError):
+    pass
+
+
+class ScanBudgetExceededError(TBHBaseError):
+    pass
+
+
+class BadSymbolsLintError(TBHBaseError):
+    pass
+
+
+class WatchUnavailableError(TBHBaseError):
+    pass
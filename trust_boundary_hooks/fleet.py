@@ -0,0 +1,269 @@
+import os
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
+from . import errors
+from . import git
+from . import metrics
+from .cache import ScanCache
+from .ops import (
+    HistoryDetection,
+    HistoryShardScan,
+    Operations,
+    history_context,
+    history_object_key,
+    kept_count,
+    scan_log_shard,
+    scan_object_shard,
+)
+from .pool import job_count, scan_map
+from .scan import Detection, Scanner
+from .template import Template
+
+
+log = logging.getLogger(__name__)
+
+# A commit, or an object with the path it was reached by
+HistoryTask = Union[str, git.ReachableObject]
+
+_REVISIONS = ["--all"]
+
+
+def _is_bare_repository(files: List[str], dirs: List[str]) -> bool:
+    return "HEAD" in files and "objects" in dirs and "refs" in dirs
+
+
+def find_repositories(locations: Iterable[str]) -> List[str]:
+    """ Git repositories found under each directory, or listed one per line in each file
+
+    Directories are searched recursively, but not inside the repositories found. Each repository is returned
+    once, in the order found.
+    """
+    found = []
+    for location in locations:
+        if os.path.isfile(location):
+            with open(location, "r") as f:
+                for line in f:
+                    path = line.strip()
+                    if path and not path.startswith("#"):
+                        found.append(os.path.expanduser(path))
+            continue
+        for root, dirs, files in os.walk(location):
+            if ".git" in dirs or ".git" in files or _is_bare_repository(files, dirs):
+                found.append(root)
+                dirs.clear()
+            else:
+                dirs.sort()
+
+    repos = []
+    seen = set()
+    for repo in found:
+        real_path = os.path.realpath(repo)
+        if real_path not in seen:
+            seen.add(real_path)
+            repos.append(os.path.abspath(repo))
+    return repos
+
+
+@contextmanager
+def _in_directory(path: str) -> Iterator[None]:
+    # Worker processes each have their own working directory; without workers it is restored afterwards
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def _task_sha(task: HistoryTask) -> str:
+    return task if isinstance(task, str) else task.sha
+
+
+class RepositoryShard(NamedTuple):
+
+    repo: str
+    history_mode: str
+    tasks: List[HistoryTask]
+
+
+class WorkingTreeScan(NamedTuple):
+
+    repo: str
+    files: int
+    found: List[Tuple[str, Tuple[Detection, ...]]]
+
+
+def scan_repository_shard(scanner: Scanner, cache: ScanCache, shard: RepositoryShard) -> HistoryShardScan:
+    with _in_directory(shard.repo):
+        if shard.history_mode == Operations.HISTORY_OBJECTS:
+            return scan_object_shard(scanner, cache, shard.tasks)
+        return scan_log_shard(scanner, cache, shard.tasks)
+
+
+def scan_working_tree(scanner: Scanner, cache: ScanCache, repo: str) -> WorkingTreeScan:
+    """ Scans a repository's untracked and cached files, as `tbh-utils scan` does """
+    # A Scanner of its own, sharing the compiled index, so only this repository's results are collected
+    repo_scanner = Scanner(index=scanner.index, budget=scanner.budget, max_detections=scanner.max_detections)
+    with _in_directory(repo):
+        operations = Operations(jobs=1, scanner=repo_scanner, cache=cache)
+        untracked = operations.untracked_files
+        operations.scan_untracked_files()
+        operations.scan_cached_files()
+    return WorkingTreeScan(
+        repo=repo,
+        files=len(untracked),
+        found=[(run.context, run.detections) for run in repo_scanner.scan_runs if run.detections],
+    )
+
+
+class RepositorySummary(NamedTuple):
+
+    repo: str
+    # Commits (or objects) in the repository's history
+    listed: int
+    # Those not already listed by a repository before it, which it scanned
+    scanned: int
+    detections: int
+
+
+class FleetScan:
+    """ Scans many repositories at once, with one Scanner, sharing work between them
+
+    Commits and objects are identified by their content, so those shared by several repositories (e.g.
+    clones and forks of one upstream) are scanned once, in the first repository listing them. Histories are
+    listed concurrently, and the history and working trees of every repository are scanned by one pool of
+    worker processes.
+    """
+
+    def __init__(
+            self,
+            repos: List[str],
+            jobs: Optional[int] = None,
+            scanner: Optional[Scanner] = None,
+            cache: Optional[ScanCache] = None,
+            history_mode: str = Operations.HISTORY_LOG,
+            rescan: bool = False,
+    ) -> None:
+        if history_mode not in Operations.HISTORY_MODES:
+            raise ValueError(f"Unknown history mode '{history_mode}'")
+        self._repos = repos
+        self._jobs = jobs
+        self._history_mode = history_mode
+        self._scanner = scanner or Scanner()
+        self._cache = cache or ScanCache(path=Template().scan_cache_path, digest=self._scanner.digest, rescan=rescan)
+        self._summaries: List[RepositorySummary] = []
+
+    @property
+    def summaries(self) -> List[RepositorySummary]:
+        return self._summaries
+
+    def _list_history(self, repo: str) -> List[HistoryTask]:
+        if self._history_mode == Operations.HISTORY_OBJECTS:
+            return git.rev_list_objects(_REVISIONS, cwd=repo)
+        return git.rev_list(_REVISIONS, cwd=repo)
+
+    def _list_histories(self) -> List[List[HistoryTask]]:
+        from concurrent.futures import ThreadPoolExecutor
+
+        # Listing is spent waiting on git, so threads are enough to run it concurrently
+        with metrics.timer("git.rev_list"), ThreadPoolExecutor(max_workers=self._jobs or os.cpu_count() or 1) as executor:
+            return list(executor.map(self._list_history, self._repos))
+
+    def _repositories_with(self, objects: List[str]) -> Dict[str, List[str]]:
+        """ The repositories having each object, checked with one git process per repository """
+        having: Dict[str, List[str]] = {}
+        for repo in self._repos:
+            for obj in git.existing_objects(objects, cwd=repo):
+                having.setdefault(obj, []).append(repo)
+        return having
+
+    def scan(self) -> None:
+        log.info(f"Scanning {len(self._repos)} repositories ({self._history_mode})")
+        t1 = time.time()
+        listings = self._list_histories()
+
+        # Each commit or object is scanned in the first repository listing it, unless already known clean
+        first_seen: Dict[str, int] = {}
+        owned: List[List[HistoryTask]] = [[] for _ in self._repos]
+        for i, tasks in enumerate(listings):
+            for task in tasks:
+                sha = _task_sha(task)
+                if sha not in first_seen:
+                    first_seen[sha] = i
+                    owned[i].append(task)
+        if self._history_mode == Operations.HISTORY_OBJECTS:
+            keys = {sha: history_object_key(self._scanner, sha) for sha in first_seen}
+        else:
+            keys = {sha: sha for sha in first_seen}
+        unscanned = set(self._cache.unknown_objects(list(keys.values())))
+        owned = [[task for task in tasks if keys[_task_sha(task)] in unscanned] for tasks in owned]
+        listed = sum(len(tasks) for tasks in listings)
+        log.info(f"{len(unscanned)} of {len(first_seen)} distinct object(s) to scan, of {listed} listed")
+
+        per_job = Operations.OBJECTS_PER_JOB if self._history_mode == Operations.HISTORY_OBJECTS else Operations.COMMITS_PER_JOB
+        shards = [
+            RepositoryShard(repo=repo, history_mode=self._history_mode, tasks=tasks[i:i + per_job])
+            for repo, tasks in zip(self._repos, owned)
+            for i in range(0, len(tasks), per_job)
+        ]
+        jobs = job_count(jobs=self._jobs, tasks=len(unscanned), tasks_per_job=per_job)
+        found: List[Tuple[str, HistoryDetection]] = []
+        clean: List[str] = []
+        unconfirmed: List[str] = []
+        for shard, result in zip(shards, scan_map(scan_repository_shard, shards, jobs=jobs, scanner=self._scanner, cache=self._cache)):
+            found.extend((shard.repo, d) for d in result.found)
+            clean.extend(result.clean)
+            unconfirmed.extend(result.unconfirmed)
+            if found and self._scanner.fail_fast:
+                break
+        if not found:
+            clean.extend(unconfirmed)
+        self._cache.mark_clean(clean)
+
+        # Blobs and trees are looked up in the repository they were scanned in, for those detections kept
+        traced: Dict[str, List[str]] = {}
+        for repo, d in found[:kept_count([d for _, d in found], self._scanner.max_detections)]:
+            if d.kind in ("blob", "tree"):
+                traced.setdefault(repo, []).append(d.sha)
+        introduced = {repo: git.introducing_commits(shas, _REVISIONS, cwd=repo) for repo, shas in traced.items()}
+
+        having = self._repositories_with(list(dict.fromkeys(d.sha for _, d in found))) if found else {}
+        detections: Dict[str, int] = {repo: 0 for repo in self._repos}
+        for repo, d in found:
+            # Reported once, with every repository that has the object
+            repos = having.get(d.sha) or [repo]
+            context = f"{history_context(d, introduced.get(repo, {}))} in {', '.join(repos)}"
+            self._scanner.record(context=context, detections=d.detections)
+            for r in repos:
+                detections[r] += 1
+
+        working_trees = [repo for repo in self._repos if not git.is_bare_repository(repo)]
+        files = 0
+        jobs = job_count(jobs=self._jobs, tasks=len(working_trees), tasks_per_job=1)
+        for result in scan_map(scan_working_tree, working_trees, jobs=jobs, scanner=self._scanner, cache=self._cache):
+            files += result.files
+            for context, found_detections in result.found:
+                self._scanner.record(context=f"{context} in {result.repo}", detections=found_detections)
+                detections[result.repo] += 1
+
+        self._summaries = [
+            RepositorySummary(repo=repo, listed=len(tasks), scanned=len(owned_tasks), detections=detections[repo])
+            for repo, tasks, owned_tasks in zip(self._repos, listings, owned)
+        ]
+        unit = "object" if self._history_mode == Operations.HISTORY_OBJECTS else "commit"
+        for s in self._summaries:
+            log.info(f"{s.repo}: {s.listed} {unit}(s), {s.scanned} scanned here, {s.detections} detection(s)")
+        log.info(
+            f"Scanned {len(self._repos)} repositories in {time.time() - t1:.1f}s: {listed} {unit}(s) listed, "
+            f"{len(first_seen)} distinct, {len(unscanned)} scanned, {files} untracked file(s), "
+            f"{sum(1 for s in self._summaries if s.detections)} repositories with detections"
+        )
+
+    def assert_no_errors(self) -> None:
+        if self._scanner.detections:
+            log.error(f"Detection of {len(self._scanner.detections)} bad symbol(s)!")
+            self._scanner.display_detections()
+            raise errors.BadSymbolsDetectedError("Bad symbols detected in scanned repositories!")
+        log.info("No bad symbols detected")
@@ -0,0 +1,393 @@
+import re
+import subprocess
+import logging
+import threading
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+
+log = logging.getLogger(__name__)
+
+# Upper bound on the amount of `git log -p` output held in memory for a single commit
+LOG_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Trailing output carried over between chunks of a single commit so matches spanning a cut are still found
+LOG_CHUNK_OVERLAP = 64 * 1024
+
+# Objects looked for by each `git log --find-object` pass over history
+FIND_OBJECTS_BATCH = 500
+
+
+class LogRecord(NamedTuple):
+
+    commit: str
+    text: str
+    # Characters of the commit's output ahead of the text: non-zero for the second and later chunks of a large
+    # commit, whose text starts with the end of the chunk before
+    start: int = 0
+
+
+class ReachableObject(NamedTuple):
+
+    sha: str
+    # Path the object was first reached by: empty for commits and root trees
+    path: str
+
+
+class StagedFile(NamedTuple):
+
+    path: str
+    blob: str
+
+
+class Hunk(NamedTuple):
+
+    # Line number, in the staged file, of the first added line
+    start: int
+    # Added lines, without their "+" prefix or line ending
+    lines: List[bytes]
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.lines) - 1
+
+
+class StagedChange(NamedTuple):
+
+    path: str
+    blob: str
+    hunks: List[Hunk]
+    # True when git has no line diff for the file, e.g. binary content
+    binary: bool
+
+
+# Index entries for submodules record a commit, not file content
+_GITLINK_MODE = "160000"
+
+_STAGED_DIFF = ["git", "diff", "--cached", "--raw", "--no-abbrev", "--no-renames", "-z", "--diff-filter=AM"]
+
+_HUNK_HEADER = re.compile(rb"^@@ -\S+ \+(\d+)(?:,\d+)? @@")
+
+_PATCH_HUNK_HEADER = re.compile(r"@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@")
+
+
+def _decode(lines: List[bytes]) -> str:
+    return b"".join(lines).decode('utf-8', errors='replace')
+
+
+def rev_list(revisions: List[str], cwd: Optional[str] = None) -> List[str]:
+    output = subprocess.check_output(["git", "rev-list"] + revisions, cwd=cwd).decode('ascii')
+    return output.split()
+
+
+def rev_list_objects(revisions: List[str], cwd: Optional[str] = None) -> List[ReachableObject]:
+    """ Every object reachable from the revisions, each listed once """
+    output = subprocess.check_output(["git", "rev-list", "--objects"] + revisions, cwd=cwd)
+    objects = []
+    for line in output.splitlines():
+        sha, _, path = line.partition(b" ")
+        objects.append(ReachableObject(sha=sha.decode('ascii'), path=path.decode('utf-8', errors='surrogateescape')))
+    return objects
+
+
+def git_dir() -> str:
+    return subprocess.check_output(["git", "rev-parse", "--absolute-git-dir"]).decode('utf-8').strip()
+
+
+def existing_objects(objects: Iterable[str], cwd: Optional[str] = None) -> Set[str]:
+    """ The objects the repository has, checked by one git process for all of them """
+    objects = list(objects)
+    if not objects:
+        return set()
+    output = subprocess.run(
+        ["git", "cat-file", "--batch-check=%(objectname)"],
+        cwd=cwd,
+        input="".join(f"{obj}\n" for obj in objects).encode('ascii'),
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.decode('ascii')
+    # Missing objects are reported as "<object> missing"
+    return {line for line in output.splitlines() if " " not in line}
+
+
+def is_bare_repository(path: str) -> bool:
+    output = subprocess.check_output(["git", "rev-parse", "--is-bare-repository"], cwd=path)
+    return output.strip() == b"true"
+
+
+def tree_entry_names(content: bytes) -> List[str]:
+    """ Names of the entries of a tree object """
+    # Each entry is "<mode> <name>\0<20 byte sha>"
+    names = []
+    start = 0
+    while start < len(content):
+        space = content.index(b" ", start)
+        end = content.index(b"\0", space)
+        names.append(content[space + 1:end].decode('utf-8', errors='replace'))
+        start = end + 21
+    return names
+
+
+def introducing_commits(objects: List[str], revisions: List[str], cwd: Optional[str] = None) -> Dict[str, List[str]]:
+    """ Commits among the revisions which add (or remove) each of the blobs or trees, by object, or for a
+    root tree the commits it is the tree of
+
+    History is walked once for many objects at a time, rather than once per object.
+    """
+    introduced: Dict[str, List[str]] = {}
+    wanted = set(objects)
+    unique = list(dict.fromkeys(objects))
+    for i in range(0, len(unique), FIND_OBJECTS_BATCH):
+        batch = unique[i:i + FIND_OBJECTS_BATCH]
+        output = subprocess.check_output(
+            ["git", "log", "-t", "--no-renames", "--no-abbrev", "--raw", "--format=commit %H"]
+            + [f"--find-object={obj}" for obj in batch]
+            + revisions,
+            cwd=cwd,
+        ).decode('utf-8', errors='replace')
+        commit = None
+        for line in output.splitlines():
+            if line.startswith("commit "):
+                commit = line[len("commit "):]
+            elif line.startswith(":") and commit is not None:
+                # ":<old mode> <new mode> <old object> <new object> <status>\t<path>"
+                for obj in line.split("\t", 1)[0].split()[2:4]:
+                    if obj in wanted and commit not in introduced.get(obj, []):
+                        introduced.setdefault(obj, []).append(commit)
+
+    # Root trees are in no diff, they are introduced by the commits they are the tree of
+    roots = wanted.difference(introduced)
+    if roots:
+        output = subprocess.check_output(["git", "log", "--format=%H %T"] + revisions, cwd=cwd).decode('ascii')
+        for line in output.splitlines():
+            commit, tree = line.split()
+            if tree in roots:
+                introduced.setdefault(tree, []).append(commit)
+    return introduced
+
+
+def iter_log_records(
+        commits: List[str],
+        chunk_size: int = LOG_CHUNK_SIZE,
+        overlap: int = LOG_CHUNK_OVERLAP,
+) -> Iterator[LogRecord]:
+    """ Stream `git log -p` output for the given commits one commit at a time
+
+    Output is read through a pipe and cut on commit boundaries, so memory use is bounded by the largest
+    commit rather than the whole history. Commits larger than `chunk_size` are cut on line boundaries,
+    with up to `overlap` bytes of trailing lines repeated at the start of the next chunk (so a match in
+    those lines is found in both chunks, at the same position in the commit's output).
+    """
+    proc = subprocess.Popen(
+        ["git", "--no-pager", "log", "-p", "--no-walk", "--stdin"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+    )
+    try:
+        # git reads all of stdin before it produces any output
+        proc.stdin.write("".join(f"{c}\n" for c in commits).encode('ascii'))
+        proc.stdin.close()
+
+        commit = ""
+        lines: List[bytes] = []
+        size = 0
+        start = 0
+        # Only the overlap carried from a previous chunk has nothing new to scan
+        fresh = False
+        for line in proc.stdout:
+            if line.startswith(b"commit "):
+                if fresh:
+                    yield LogRecord(commit=commit, text=_decode(lines), start=start)
+                commit = line.split()[1].decode('ascii')
+                lines = []
+                size = 0
+                start = 0
+
+            lines.append(line)
+            size += len(line)
+            fresh = True
+            if size > chunk_size:
+                text = _decode(lines)
+                yield LogRecord(commit=commit, text=text, start=start)
+                carried: List[bytes] = []
+                carried_size = 0
+                for previous in reversed(lines):
+                    if carried_size + len(previous) > overlap:
+                        break
+                    carried.append(previous)
+                    carried_size += len(previous)
+                carried.reverse()
+                # Cut at line ends, lines decoded apart are as long as decoded together
+                start += len(text) - len(_decode(carried))
+                lines = carried
+                size = carried_size
+                fresh = False
+
+        if fresh:
+            yield LogRecord(commit=commit, text=_decode(lines), start=start)
+
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+
+
+def patch_location(patch: str, offset: int) -> Tuple[Optional[str], Optional[int]]:
+    """ The file, and the line in it, at `offset` into `git log -p` output
+
+    The line is in the new version of the file, or the old one for a removed line. Either is None where the
+    offset is not in a file's patch (e.g. in the commit message), or in a patch cut off from its header.
+    """
+    # Up to the end of the offset's line, so that a match on a header line itself is in that header's file
+    line_end = patch.find("\n", offset)
+    if line_end == -1:
+        line_end = len(patch)
+    header = patch.rfind("\ndiff --git ", 0, line_end)
+    if header == -1:
+        if not patch.startswith("diff --git "):
+            return None, None
+        # A chunk starting at a file's header
+        header = 0
+    hunk = patch.rfind("\n@@ ", header, offset)
+
+    path = None
+    file_headers_end = line_end if hunk == -1 else hunk
+    for prefix, strip in (("\n+++ ", "b/"), ("\n--- ", "a/")):
+        start = patch.find(prefix, header, file_headers_end)
+        if start != -1:
+            name = patch[start + len(prefix):patch.find("\n", start + 1)]
+            if name.startswith(strip):
+                path = name[len(strip):]
+                break
+    if path is None:
+        # e.g. binary files, or a change of mode only
+        path = patch[header:patch.find("\n", header + 1)].rpartition(" b/")[2] or None
+    if hunk == -1:
+        return path, None
+
+    match = _PATCH_HUNK_HEADER.match(patch, hunk + 1)
+    if not match:
+        return path, None
+    old_line, new_line = int(match.group(1)), int(match.group(2))
+    line_start = patch.rfind("\n", 0, offset) + 1
+    for line in patch[patch.find("\n", hunk + 1) + 1:line_start].splitlines():
+        if line.startswith("-"):
+            old_line += 1
+        elif line.startswith("+"):
+            new_line += 1
+        else:
+            old_line += 1
+            new_line += 1
+    return path, old_line if patch.startswith("-", line_start) else new_line
+
+
+def _parse_raw(output: bytes) -> List[Tuple[str, StagedFile]]:
+    # Each entry is ":<src mode> <dst mode> <src sha> <dst sha> <status>\0<path>\0"
+    fields = output.split(b"\0")
+    entries = []
+    for meta, path in zip(fields[0::2], fields[1::2]):
+        _, dst_mode, _, dst_sha, _ = meta.decode('ascii').split()
+        entries.append((dst_mode, StagedFile(path=path.decode('utf-8', errors='surrogateescape'), blob=dst_sha)))
+    return entries
+
+
+def staged_files() -> List[StagedFile]:
+    """ Files added or modified in the index, with the id of the staged blob """
+    output = subprocess.check_output(_STAGED_DIFF)
+    return [f for mode, f in _parse_raw(output) if mode != _GITLINK_MODE]
+
+
+def _parse_patch(patch: bytes) -> Tuple[List[Hunk], bool]:
+    """ Returns the hunks of added lines in one file's `-U0` patch, and whether git found it binary """
+    hunks: List[Hunk] = []
+    binary = False
+    for line in patch.split(b"\n"):
+        if line.startswith(b"@@"):
+            match = _HUNK_HEADER.match(line)
+            if not match:
+                raise RuntimeError(f"Unexpected diff hunk header '{line.decode('utf-8', errors='replace')}'")
+            hunks.append(Hunk(start=int(match.group(1)), lines=[]))
+        elif hunks:
+            if line.startswith(b"+"):
+                hunks[-1].lines.append(line[1:])
+        elif line.startswith(b"Binary files "):
+            binary = True
+    return hunks, binary
+
+
+def staged_changes() -> List[StagedChange]:
+    """ Files added or modified in the index, with the lines added to each
+
+    Reads one `git diff --cached -U0` with the raw entries ahead of the patches. git writes the patches in
+    the same order as the raw entries, one `diff --git` header each, so every patch is matched to its path
+    by position rather than by parsing (possibly quoted) paths out of the patch headers.
+    """
+    output = subprocess.check_output(
+        _STAGED_DIFF[:2] + ["--no-color", "--no-ext-diff", "--no-textconv", "-p", "-U0"] + _STAGED_DIFF[2:]
+    )
+    raw, _, patch = output.partition(b"\0\0")
+    entries = _parse_raw(raw)
+    # Each patch starts with its own "diff --git" line
+    patches = [p for p in re.split(rb"^(?=diff --git )", patch, flags=re.MULTILINE) if p]
+    if len(patches) != len(entries):
+        raise RuntimeError(f"git diff gave {len(patches)} patch(es) for {len(entries)} file(s)")
+
+    changes = []
+    for (mode, staged), file_patch in zip(entries, patches):
+        if mode == _GITLINK_MODE:
+            continue
+        hunks, binary = _parse_patch(file_patch)
+        changes.append(StagedChange(path=staged.path, blob=staged.blob, hunks=hunks, binary=binary))
+    return changes
+
+
+def iter_blobs(blobs: Iterable[str]) -> Iterator[Tuple[str, bytes]]:
+    """ Yields (sha, content) for each blob, in order, read through one `git cat-file --batch` process """
+    for sha, _, content in iter_objects(blobs):
+        yield sha, content
+
+
+def iter_objects(objects: Iterable[str]) -> Iterator[Tuple[str, str, bytes]]:
+    """ Yields (sha, type, content) for each object, in order, read through one `git cat-file --batch` process
+
+    Object ids are fed from a separate thread so git's output never backs up behind our input.
+    """
+    proc = subprocess.Popen(["git", "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def _feed() -> None:
+        try:
+            for obj in objects:
+                proc.stdin.write(f"{obj}\n".encode('ascii'))
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    feeder = threading.Thread(target=_feed, daemon=True)
+    feeder.start()
+    try:
+        while True:
+            header = proc.stdout.readline()
+            if not header:
+                break
+            fields = header.split()
+            if len(fields) != 3:
+                raise RuntimeError(f"git cat-file could not read object: {header.decode('utf-8', errors='replace').strip()}")
+            sha, object_type, size = fields
+            content = proc.stdout.read(int(size))
+            proc.stdout.read(1)  # Trailing newline
+            yield sha.decode('ascii'), object_type.decode('ascii'), content
+
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    finally:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        feeder.join()
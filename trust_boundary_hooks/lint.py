@@ -0,0 +1,189 @@
+import re
+import math
+import time
+import logging
+from typing import Iterable, List, NamedTuple, Optional, Pattern, Set, Tuple
+from .scan import time_limit
+from .symbols import classify_symbols
+
+try:
+    from re import _parser
+except ImportError:
+    import sre_parse as _parser
+
+
+log = logging.getLogger(__name__)
+
+# Each regex is searched in adversarial input of these lengths; how its search time grows between the two
+# gives its order, e.g. 1 for linear or 2 for quadratic
+LINT_LENGTHS = (1024, 4096)
+
+# Regexes whose search time grows faster than this power of the input length are reported
+MAX_GROWTH_EXPONENT = 1.5
+
+# Growth is only reported where searching the longest input takes at least this many seconds: faster searches
+# are timed too noisily to tell their growth, and no search that grows quadratically is that fast at that length
+MIN_GROWTH_SECONDS = 0.001
+
+# Seconds a single search may take before its regex is reported as catastrophic
+LINT_TIMEOUT = 1.0
+
+# Each measurement repeats a search until it has taken at least this long, so fast searches time reliably
+_MIN_MEASUREMENT = 0.0005
+
+# Searches are measured up to this many times, keeping the quickest, as other work on the machine easily slows
+# one short measurement down; a measurement taking `_LONG_MEASUREMENT` seconds or more is kept as it is
+_MEASUREMENTS = 3
+_LONG_MEASUREMENT = 0.05
+
+# Characters adversarial input is built from, at most, per regex
+_MAX_ALPHABET = 16
+
+_CATEGORY_CHARACTERS = {
+    "CATEGORY_DIGIT": "1",
+    "CATEGORY_NOT_DIGIT": "a",
+    "CATEGORY_SPACE": " ",
+    "CATEGORY_NOT_SPACE": "a",
+    "CATEGORY_WORD": "a",
+    "CATEGORY_NOT_WORD": " ",
+}
+
+
+class SymbolLint(NamedTuple):
+
+    symbol: str
+    # Power of the input length the regex's search time grows with, where it could be measured
+    exponent: Optional[float]
+    # Slowest single search of adversarial input, in seconds
+    worst_seconds: float
+    # Time searching the corpora given, in seconds
+    corpus_seconds: float
+    timed_out: bool
+    # Why the symbol doesn't compile, if it doesn't
+    error: Optional[str]
+
+    @property
+    def ok(self) -> bool:
+        return not (self.error or self.timed_out or self.grows_too_fast)
+
+    @property
+    def grows_too_fast(self) -> bool:
+        return self.exponent is not None and self.exponent > MAX_GROWTH_EXPONENT and \
+            self.worst_seconds >= MIN_GROWTH_SECONDS
+
+    @property
+    def problem(self) -> str:
+        if self.error:
+            return f"does not compile ({self.error})"
+        if self.timed_out:
+            return f"searching took over {LINT_TIMEOUT:g} second(s), likely catastrophic backtracking"
+        if not self.ok:
+            return f"search time grows with input length to the power {self.exponent:.1f}"
+        return ""
+
+
+def _collect_alphabet(items, alphabet: Set[str]) -> None:
+    # Walks a parsed regex for the characters its atoms match, one representative per class
+    for op, av in items:
+        name = str(op)
+        if name == "LITERAL":
+            alphabet.add(chr(av))
+        elif name == "RANGE":
+            alphabet.update((chr(av[0]), chr(av[1])))
+        elif name == "CATEGORY":
+            alphabet.add(_CATEGORY_CHARACTERS.get(str(av), "a"))
+        elif name in ("ANY", "NOT_LITERAL"):
+            alphabet.add("a")
+        elif name == "IN":
+            _collect_alphabet(av, alphabet)
+        else:
+            for value in av if isinstance(av, (tuple, list)) else (av, ):
+                if isinstance(value, _parser.SubPattern):
+                    _collect_alphabet(value, alphabet)
+                elif isinstance(value, list):
+                    for branch in value:
+                        if isinstance(branch, _parser.SubPattern):
+                            _collect_alphabet(branch, alphabet)
+
+
+def adversarial_inputs(symbol: str, length: int) -> List[str]:
+    """ Input built to make a regex backtrack: runs of the characters it matches, which it fails to match at
+    the very end
+    """
+    alphabet: Set[str] = set()
+    _collect_alphabet(_parser.parse(symbol, re.IGNORECASE), alphabet)
+    characters = sorted(alphabet)[:_MAX_ALPHABET] or ["a"]
+    runs = [c * length for c in characters]
+    runs.append(("".join(characters) * length)[:length])
+    return [run + "\0" for run in runs]
+
+
+def _measure_search(pattern: Pattern, value: str) -> Tuple[float, float]:
+    """ Seconds one search of the value took, and the measurement took in all """
+    repeats = 0
+    t1 = time.perf_counter()
+    while True:
+        with time_limit(LINT_TIMEOUT):
+            pattern.search(value)
+        repeats += 1
+        elapsed = time.perf_counter() - t1
+        if elapsed >= _MIN_MEASUREMENT:
+            return elapsed / repeats, elapsed
+
+
+def _time_search(pattern: Pattern, value: str) -> float:
+    """ Seconds one search of the value takes """
+    best = math.inf
+    for _ in range(_MEASUREMENTS):
+        seconds, elapsed = _measure_search(pattern, value)
+        best = min(best, seconds)
+        if elapsed >= _LONG_MEASUREMENT:
+            break
+    return best
+
+
+def lint_symbol(symbol: str, corpora: Iterable[str] = ()) -> SymbolLint:
+    """ Times a regex symbol on its own, as the Scanner would search with it, against adversarial input of
+    growing length and against the corpora
+    """
+    try:
+        pattern = re.compile(symbol, re.IGNORECASE)
+    except re.error as e:
+        return SymbolLint(symbol=symbol, exponent=None, worst_seconds=0, corpus_seconds=0, timed_out=False, error=str(e))
+
+    times: List[float] = []
+    corpus_seconds = 0.0
+    try:
+        for length in LINT_LENGTHS:
+            times.append(max(_time_search(pattern, value) for value in adversarial_inputs(symbol, length)))
+        for corpus in corpora:
+            t1 = time.perf_counter()
+            with time_limit(LINT_TIMEOUT):
+                for _ in pattern.finditer(corpus):
+                    pass
+            corpus_seconds += time.perf_counter() - t1
+    except TimeoutError:
+        return SymbolLint(
+            symbol=symbol, exponent=None, worst_seconds=LINT_TIMEOUT, corpus_seconds=corpus_seconds, timed_out=True, error=None
+        )
+
+    (short, long), (short_length, long_length) = times[-2:], LINT_LENGTHS[-2:]
+    exponent = math.log(long / short) / math.log(long_length / short_length) if short > 0 else None
+    return SymbolLint(
+        symbol=symbol, exponent=exponent, worst_seconds=max(times), corpus_seconds=corpus_seconds, timed_out=False, error=None
+    )
+
+
+def lint_symbols(symbols: Tuple[str, ...], corpora: Iterable[str] = ()) -> List[SymbolLint]:
+    """ Lints the regexes among the symbols; plain words are matched in linear time, so are left out """
+    corpora = list(corpora)
+    _, regexes = classify_symbols(symbols)
+    results = []
+    for symbol in regexes:
+        result = lint_symbol(symbol, corpora)
+        log.debug(
+            f"Symbol '{symbol}': growth {'-' if result.exponent is None else f'{result.exponent:.2f}'}, "
+            f"worst {result.worst_seconds * 1000:.2f}ms, corpora {result.corpus_seconds * 1000:.2f}ms"
+        )
+        results.append(result)
+    return results
@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, TypeVar
+
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Opt in to writing metrics with `TBH_METRICS=json`; they go to stderr unless `TBH_METRICS_FILE` names a
+# file to append one JSON line per run to. `TBH_PROFILE` names a file to write cProfile stats to.
+METRICS_ENV = "TBH_METRICS"
+METRICS_FILE_ENV = "TBH_METRICS_FILE"
+PROFILE_ENV = "TBH_PROFILE"
+
+METRICS_FORMATS = ("json", )
+
+
+class Metrics:
+    """ Accumulated time per phase and counts of work done, for one process """
+
+    def __init__(self) -> None:
+        self.timings: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        t1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t1)
+
+    def add_time(self, name: str, seconds: float) -> None:
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {"timings": dict(self.timings), "counters": dict(self.counters)}
+
+    def merge(self, snapshot: Dict[str, Dict]) -> None:
+        """ Adds in a snapshot, e.g. one taken in a worker process """
+        for name, seconds in snapshot["timings"].items():
+            self.add_time(name, seconds)
+        for name, n in snapshot["counters"].items():
+            self.count(name, n)
+
+    def reset(self) -> None:
+        self.timings.clear()
+        self.counters.clear()
+
+
+metrics = Metrics()
+
+_exit_handlers: List[Callable[[], None]] = []
+
+
+def timer(name: str):
+    return metrics.timer(name)
+
+
+def count(name: str, n: int = 1) -> None:
+    metrics.count(name, n)
+
+
+def timed_iter(name: str, iterable: Iterable[T]) -> Iterator[T]:
+    """ Iterates, timing only the work of producing each item (e.g. waiting on a subprocess) """
+    iterator = iter(iterable)
+    while True:
+        t1 = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            metrics.add_time(name, time.perf_counter() - t1)
+            return
+        metrics.add_time(name, time.perf_counter() - t1)
+        yield item
+
+
+def _write_metrics(started: float, path: Optional[str]) -> None:
+    record = {
+        "command": os.path.basename(sys.argv[0]),
+        "arguments": sys.argv[1:],
+        "cwd": os.getcwd(),
+        "pid": os.getpid(),
+        "started": started,
+        "wall_seconds": time.time() - started,
+    }
+    record.update(metrics.snapshot())
+    line = json.dumps(record, sort_keys=True)
+    if path:
+        with open(path, "a") as f:
+            f.write(line + "\n")
+    else:
+        print(line, file=sys.stderr)
+
+
+def _at_exit(handler: Callable[[], None]) -> None:
+    _exit_handlers.append(handler)
+    atexit.register(handler)
+
+
+def run_exit_handlers() -> None:
+    """ Writes metrics and profiles now, for a run that ends without the process exiting (e.g. one served
+    by a forked daemon process, which never runs atexit handlers)
+    """
+    while _exit_handlers:
+        handler = _exit_handlers.pop()
+        atexit.unregister(handler)
+        handler()
+
+
+def enable_metrics(output_format: str, path: Optional[str] = None) -> None:
+    """ Writes this run's metrics when the process exits """
+    if output_format not in METRICS_FORMATS:
+        raise ValueError(f"Unknown metrics format '{output_format}'")
+    started = time.time()
+    _at_exit(lambda: _write_metrics(started, path))
+
+
+def enable_profile(path: str) -> None:
+    """ Profiles the rest of this run with cProfile, writing the stats to `path` when the process exits """
+    import cProfile
+
+    profile = cProfile.Profile()
+
+    def _dump() -> None:
+        profile.disable()
+        profile.dump_stats(path)
+        log.debug(f"Profile written to '{path}'")
+
+    _at_exit(_dump)
+    profile.enable()
@@ -1,25 +1,355 @@
-from .scan import Scanner
+from .scan import DEFAULT_MAX_DETECTIONS, Content, Detection, Scanner, scanning
+from .cache import ScanCache, git_blob_sha, stat_key
+from .template import Template
+from .pool import job_count, scan_map, shards
 import subprocess
 import os
-from bs4 import UnicodeDammit
+import mmap
+import time
 import logging
-from typing import List
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, TypeVar
 from . import errors
-import time
+from . import git
+from . import metrics
 
 
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# Files at least this large are memory mapped rather than read
+MMAP_MIN_SIZE = 1024 * 1024
+
+# Per repository record of untracked files found clean, by path and stat data, in the git directory
+STAT_CACHE_NAME = "tbh_stat_cache"
+STAT_CACHE_MAX_ENTRIES = 100000
+
+# A file modified this recently may be modified again without its size or mtime changing (timestamps are
+# only so fine grained), so it is scanned again next time rather than recorded as clean by its stat data
+RACY_WINDOW_NS = 2 * 1000 * 1000 * 1000
+
+
+def _is_null_sha(sha: str) -> bool:
+    return not sha.strip("0")
+
+
+class PushRef(NamedTuple):
+
+    local_ref: str
+    local_sha: str
+    remote_ref: str
+    remote_sha: str
+
+    @property
+    def is_deletion(self) -> bool:
+        return _is_null_sha(self.local_sha)
+
+    @property
+    def is_new_branch(self) -> bool:
+        return _is_null_sha(self.remote_sha)
+
+
+class ReceiveRef(NamedTuple):
+
+    old_sha: str
+    new_sha: str
+    ref: str
+
+    @property
+    def is_deletion(self) -> bool:
+        return _is_null_sha(self.new_sha)
+
+
+class FileScan(NamedTuple):
+
+    name: str
+    name_detections: Tuple[str, ...]
+    # None when the content was not scanned (previously scanned clean, or not decodable as text)
+    content_detections: Optional[Tuple[Detection, ...]]
+    blob: str
+    clean: bool
+
+
+class BlobScanTask(NamedTuple):
+
+    name: str
+    blob: str
+    # None when the blob is already known to be clean
+    content: Optional[Content]
+
+
+def _dammit_decode(name: str, content: Content) -> str:
+    # We use a utility to manage detection and decoding.
+    from bs4 import UnicodeDammit
+
+    with metrics.timer("scan.dammit"):
+        dammit = UnicodeDammit(bytes(content))
+        decoded = dammit.unicode_markup
+    if decoded:
+        log.debug(f"Original Encoding of {name} = {dammit.original_encoding}")
+    else:
+        log.warning(f"Decoding content of '{name}' as text failed")
+    return decoded
+
+
+def _search_content(scanner: Scanner, name: str, content: Content, scope: str = "content") -> Optional[Tuple[Detection, ...]]:
+    """ Searches file content, returning None if it is empty or cannot be decoded as text """
+    if not len(content):
+        return None
+    # Raw content is searched directly where possible, falling back to charset detection
+    detections = scanner.search_bytes(content, scope=scope)
+    if detections is None:
+        decoded = _dammit_decode(name, content)
+        if decoded:
+            detections = scanner.locate(decoded, scope=scope)
+    return detections
+
+
+def scan_blob(scanner: Scanner, task: BlobScanTask) -> FileScan:
+    name_detections = scanner.search(task.name, scope="filename")
+    if task.content is None:
+        log.debug(f"Content of '{task.name}' previously scanned clean")
+        return FileScan(name=task.name, name_detections=name_detections, content_detections=None, blob=task.blob, clean=True)
+
+    content_detections = _search_content(scanner, task.name, task.content)
+    clean = (not len(task.content)) or (content_detections == ())
+    return FileScan(
+        name=task.name,
+        name_detections=name_detections,
+        content_detections=content_detections,
+        blob=task.blob,
+        clean=clean,
+    )
+
+
+def _scan_blob_task(scanner: Scanner, cache: ScanCache, task: BlobScanTask) -> FileScan:
+    """ scan_blob, called as scan_map calls tasks: the task says whether the blob is known clean already """
+    return scan_blob(scanner, task)
+
+
+def _scan_file_content(scanner: Scanner, cache: ScanCache, fn: str, content: Content) -> FileScan:
+    blob = git_blob_sha(content)
+    if cache.is_clean(blob):
+        content = None
+    return scan_blob(scanner, BlobScanTask(name=fn, blob=blob, content=content))
+
+
+def scan_file(scanner: Scanner, cache: ScanCache, fn: str) -> FileScan:
+    log.debug(f"Scanning file '{fn}'")
+    metrics.count("files.read")
+    with open(fn, "rb") as f:
+        if os.fstat(f.fileno()).st_size >= MMAP_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                return _scan_file_content(scanner, cache, fn, content)
+        with metrics.timer("io.read"):
+            content = f.read()
+        return _scan_file_content(scanner, cache, fn, content)
+
+
+class HistoryDetection(NamedTuple):
+
+    # "history" for a commit's patch, else the type of the object
+    kind: str
+    sha: str
+    path: str
+    detections: Tuple[Detection, ...]
+
+
+class HistoryShardScan(NamedTuple):
+
+    found: List[HistoryDetection]
+    # Objects to record as clean in the cache, by their keys in it
+    clean: List[str]
+    # Objects clean in themselves, but only recorded as clean if the whole scan is
+    unconfirmed: List[str]
+    # Characters of text scanned (in `git log -p` output), or bytes of the objects read
+    size: int
+
+
+def scan_log_shard(scanner: Scanner, cache: ScanCache, commits: List[str]) -> HistoryShardScan:
+    """ Scans the `git log -p` output of some commits, through a git process of its own """
+    found: List[HistoryDetection] = []
+    size = 0
+    scanned = set()
+    dirty = set()
+    # Matches in the current commit, by position in its output, as chunks of a large commit overlap
+    seen: Set[Tuple[int, str]] = set()
+    metrics.count("commits.scanned", len(commits))
+    for record in metrics.timed_iter("git.log", git.iter_log_records(commits=commits)):
+        size += len(record.text)
+        scanned.add(record.commit)
+        if not record.start:
+            seen = set()
+        located = []
+        for d in scanner.locate(record.text):
+            if (record.start + d.offset, d.match) in seen:
+                continue
+            seen.add((record.start + d.offset, d.match))
+            path, line = git.patch_location(record.text, d.offset)
+            located.append(d._replace(path=path, line=line, commit=record.commit))
+        if located:
+            if found and found[-1].sha == record.commit:
+                # A later chunk of the same commit
+                found[-1] = found[-1]._replace(detections=found[-1].detections + tuple(located))
+            else:
+                found.append(HistoryDetection(kind="history", sha=record.commit, path="", detections=tuple(located)))
+            dirty.add(record.commit)
+            if scanner.fail_fast:
+                break
+    # Failing fast leaves the commits after the first found unscanned
+    clean = [c for c in commits if c in scanned and c not in dirty]
+    return HistoryShardScan(found=found, clean=clean, unconfirmed=[], size=size)
+
+
+def history_object_key(scanner: Scanner, sha: str) -> str:
+    """ The key an object scanned in history an object at a time is cached by
+
+    Blobs and trees are searched for the symbols limited to history as well as those of file content and
+    names, so when there are any, objects found clean that way are recorded apart from files found clean.
+    """
+    index = scanner.index
+    if index.for_context("history_blob") is index.for_context("content") and \
+            index.for_context("history_tree") is index.for_context("filename"):
+        return sha
+    return f"history:{sha}"
+
+
+def scan_object_shard(scanner: Scanner, cache: ScanCache, objects: List[git.ReachableObject]) -> HistoryShardScan:
+    """ Scans some commit, tree and blob objects, read through a git process of its own """
+    paths = {o.sha: o.path for o in objects}
+    found = []
+    clean = []
+    unconfirmed = []
+    size = 0
+    for sha, object_type, content in metrics.timed_iter("git.cat_file", git.iter_objects(paths)):
+        metrics.count(f"objects.{object_type}")
+        size += len(content)
+        if object_type == "blob":
+            detections = _search_content(scanner, paths[sha], content, scope="history_blob")
+            if detections:
+                detections = tuple(d._replace(path=paths[sha]) for d in detections)
+                found.append(HistoryDetection(kind=object_type, sha=sha, path=paths[sha], detections=detections))
+                if scanner.fail_fast:
+                    break
+            elif detections is not None or not len(content):
+                clean.append(history_object_key(scanner, sha))
+            continue
+
+        if object_type == "commit":
+            detections = tuple(d._replace(commit=sha) for d in scanner.locate(content.decode('utf-8', errors='replace'), scope="history_commit"))
+        elif object_type == "tree":
+            # The tree's path says where; a line in its list of names says nothing more
+            names = "\n".join(git.tree_entry_names(content))
+            detections = tuple(d._replace(offset=None, line=None) for d in scanner.locate(names, scope="history_tree"))
+        else:
+            continue
+        if detections:
+            found.append(HistoryDetection(kind=object_type, sha=sha, path=paths[sha], detections=detections))
+            if scanner.fail_fast:
+                break
+        elif object_type == "tree":
+            clean.append(history_object_key(scanner, sha))
+        elif scanner.index.scopes is None:
+            # A commit in the cache means its whole patch was found clean (see scan_log_shard), which only
+            # follows from its own object being clean when nothing else in the scan was found. With scoped
+            # symbols it doesn't follow at all, as a patch is searched for symbols of every scope, and a
+            # blob only for those of file content.
+            unconfirmed.append(history_object_key(scanner, sha))
+    return HistoryShardScan(found=found, clean=clean, unconfirmed=unconfirmed, size=size)
+
+
+def kept_count(found: List[HistoryDetection], limit: Optional[int]) -> int:
+    """ How many of the detections found, in order, the Scanner keeps any of (see DetectionStore) """
+    count = 0
+    for i, d in enumerate(found):
+        if limit is not None and count >= limit:
+            return i
+        count += len(d.detections)
+    return len(found)
+
+
+def traced_objects(found: List[HistoryDetection], limit: Optional[int]) -> List[str]:
+    """ The blobs and trees to look up the introducing commits of: only those whose detections are kept """
+    return [d.sha for d in found[:kept_count(found, limit)] if d.kind in ("blob", "tree")]
+
+
+def history_context(detection: HistoryDetection, introduced: Dict[str, List[str]]) -> str:
+    """ Describes where in history a detection was made, given the commits introducing the blobs and trees
+    detected (see git.introducing_commits)
+    """
+    if detection.kind == "history":
+        return f"GitHistory({detection.sha})"
+    if detection.kind == "commit":
+        return f"GitCommit({detection.sha})"
+    # Blobs and trees may be reachable from many commits: report those that introduce them
+    commits = " ".join(introduced.get(detection.sha, [])) or "unknown commit"
+    return f"Git{detection.kind.title()}({detection.path or '/'} {detection.sha} introduced in {commits})"
+
+
+def parse_push_refs(lines: Iterable[str]) -> List[PushRef]:
+    """ Parse the `<local ref> <local sha> <remote ref> <remote sha>` lines git passes to pre-push on stdin """
+    refs = []
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) != 4:
+            raise RuntimeError(f"Unexpected pre-push input line '{line}'")
+        refs.append(PushRef(*fields))
+    return refs
+
+
+def parse_receive_refs(lines: Iterable[str]) -> List[ReceiveRef]:
+    """ Parse the `<old sha> <new sha> <ref>` lines git passes to pre-receive on stdin """
+    refs = []
+    for line in lines:
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) != 3:
+            raise RuntimeError(f"Unexpected pre-receive input line '{line}'")
+        refs.append(ReceiveRef(*fields))
+    return refs
+
 
 class Operations:
 
-    def __init__(self) -> None:
-        self._scanner = Scanner()
+    # Files per worker process before parallel scanning is worth starting processes for
+    FILES_PER_JOB = 32
+    # Likewise for scanning history, which also starts a git process per shard
+    COMMITS_PER_JOB = 256
+    OBJECTS_PER_JOB = 1024
+
+    # Ways of scanning history: each commit's `git log -p` output, or each reachable object once
+    HISTORY_LOG = "log"
+    HISTORY_OBJECTS = "objects"
+    HISTORY_MODES = (HISTORY_LOG, HISTORY_OBJECTS)
+
+    def __init__(
+            self,
+            jobs: Optional[int] = None,
+            scanner: Optional[Scanner] = None,
+            cache: Optional[ScanCache] = None,
+            history_mode: str = HISTORY_LOG,
+            scan_budget: Optional[float] = None,
+            rescan: bool = False,
+            max_detections: Optional[int] = None,
+            fail_fast: bool = False,
+    ) -> None:
+        if history_mode not in self.HISTORY_MODES:
+            raise ValueError(f"Unknown history mode '{history_mode}'")
+        self._history_mode = history_mode
+        self._jobs = jobs
+        self._scanner = scanner or Scanner(
+            budget=scan_budget,
+            max_detections=DEFAULT_MAX_DETECTIONS if max_detections is None else max_detections,
+            fail_fast=fail_fast,
+        )
+        self._cache = cache or ScanCache(path=Template().scan_cache_path, digest=self._scanner.digest, rescan=rescan)
 
     @property
     def cached_files(self) -> List[str]:
-        output = subprocess.check_output(['git', 'diff', '--cached', '--name-only', '--diff-filter=ACM']).decode('utf-8')
-        return output.splitlines(keepends=False)
+        return [f.path for f in git.staged_files()]
 
     @property
     def untracked_files(self) -> List[str]:
@@ -28,31 +358,138 @@ class Operations:
 
     def scan_cached_files(self) -> None:
         log.info("Scanning cached files")
-        self._scan_files(files=self.cached_files)
-
-    def _scan_files(self, files: List[str]) -> None:
-        log.info(f"Looking for bad symbols in {len(files)} file(s)...")
-        for fn in files:
-            log.debug(f"Scanning file '{fn}'")
-            self._scanner.scan_string(context=f"FileName({fn})", value=fn)
-            with open(fn, "rb") as f:
-                # We use a utility to manage detection and decoding.
-                raw_content = f.read()
-                decoded = ""
-                if raw_content:
-                    dammit = UnicodeDammit(raw_content)
-                    decoded = dammit.unicode_markup
-                    if decoded:
-                        log.debug(f"Original Encoding of {fn} = {dammit.original_encoding}")
-                    else:
-                        log.warning(f"Decoding content of '{fn}' as text failed")
-
-            if decoded:
-                self._scanner.scan_string(context=f"FileContent({fn})", value=decoded)
+        with metrics.timer("git.diff"):
+            staged = git.staged_files()
+        unscanned = set(self._cache.unknown_objects([f.blob for f in staged]))
+
+        # Scan what is staged, read straight from the object store, rather than the working tree copy
+        def _tasks() -> Iterator[BlobScanTask]:
+            contents = metrics.timed_iter(
+                "git.cat_file",
+                git.iter_blobs([f.blob for f in staged if f.blob in unscanned]),
+            )
+            for f in staged:
+                content = None
+                if f.blob in unscanned:
+                    _, content = next(contents)
+                yield BlobScanTask(name=f.path, blob=f.blob, content=content)
+
+        self._scan_tasks(_scan_blob_task, _tasks(), count=len(staged))
+
+    def scan_staged_changes(self) -> None:
+        """ Scans the lines added in the index, rather than the whole of each staged file
+
+        Detections are reported with their file and line. Files git has no line diff for (binary content)
+        or whose added lines are not UTF-8 are scanned whole, with charset detection as usual.
+        """
+        log.info("Scanning staged changes")
+        with metrics.timer("git.diff"):
+            changes = git.staged_changes()
+        unscanned = set(self._cache.unknown_objects([c.blob for c in changes]))
+
+        whole_files = []
+        for change in changes:
+            if change.blob not in unscanned:
+                self._scanner.scan_string(context=f"FileName({change.path})", value=change.path, scope="filename")
+                log.debug(f"Content of '{change.path}' previously scanned clean")
+            elif change.binary or not self._scan_hunks(change):
+                whole_files.append(change)
+        log.info(f"Looking for bad symbols in {len(changes) - len(whole_files)} file change(s)...")
+
+        if whole_files:
+            def _tasks() -> Iterator[BlobScanTask]:
+                contents = metrics.timed_iter("git.cat_file", git.iter_blobs([c.blob for c in whole_files]))
+                for change, (_, content) in zip(whole_files, contents):
+                    yield BlobScanTask(name=change.path, blob=change.blob, content=content)
+
+            self._scan_tasks(_scan_blob_task, _tasks(), count=len(whole_files))
+
+    def _scan_hunks(self, change: git.StagedChange) -> bool:
+        """ Scans the file name and added lines of a change, returning False if the lines are not UTF-8 """
+        try:
+            hunks = [(hunk, [line.decode('utf-8') for line in hunk.lines]) for hunk in change.hunks]
+        except UnicodeDecodeError:
+            log.debug(f"Added lines of '{change.path}' are not UTF-8, scanning the whole file")
+            return False
+
+        metrics.count("files.scanned")
+        self._scanner.scan_string(context=f"FileName({change.path})", value=change.path, scope="filename")
+        detections: List[Detection] = []
+        for hunk, lines in hunks:
+            # A hunk's lines are consecutive in the staged file, so a match's line in the hunk gives its line
+            # in the file (a match spanning lines is reported at its first)
+            detections.extend(
+                d._replace(offset=None, path=change.path, line=hunk.start + d.line - 1)
+                for d in self._scanner.locate("\n".join(lines), scope="content")
+            )
+        self._scanner.record(context=f"FileContent({change.path})", detections=tuple(detections))
+        return True
+
+    def _scan_files(self, files: List[str]) -> List[str]:
+        return self._scan_tasks(scan_file, files, count=len(files))
+
+    def _scan_tasks(self, func: Callable[[Scanner, ScanCache, T], FileScan], tasks: Iterable[T], count: int) -> List[str]:
+        """ Scans files, returning the names of those found clean, name and content """
+        log.info(f"Looking for bad symbols in {count} file(s)...")
+        jobs = job_count(jobs=self._jobs, tasks=count, tasks_per_job=self.FILES_PER_JOB)
+        clean_blobs = []
+        clean_names = []
+        try:
+            for result in scan_map(func, tasks, jobs=jobs, scanner=self._scanner, cache=self._cache):
+                metrics.count("files.scanned")
+                if result.clean:
+                    clean_blobs.append(result.blob)
+                    if not result.name_detections:
+                        clean_names.append(result.name)
+                self._scanner.record(context=f"FileName({result.name})", detections=result.name_detections)
+                if result.content_detections is not None:
+                    self._scanner.record(context=f"FileContent({result.name})", detections=result.content_detections)
+        finally:
+            # Kept even when failing fast stops the scan part way through
+            self._cache.mark_clean(clean_blobs)
+        return clean_names
+
+    def _stat_cache(self) -> Optional[ScanCache]:
+        try:
+            path = os.path.join(git.git_dir(), STAT_CACHE_NAME)
+        except subprocess.CalledProcessError:
+            return None
+        return ScanCache(path=path, digest=self._scanner.digest, max_entries=STAT_CACHE_MAX_ENTRIES, rescan=self._cache.rescan)
 
     def scan_untracked_files(self) -> None:
+        """ Scans untracked files, skipping those whose stat data shows them unchanged since found clean
+
+        Like git's index, a file's path, size, mtime and inode stand in for its content, so unchanged files
+        (e.g. build outputs) are not even opened.
+        """
         log.info("Scanning untracked files")
-        self._scan_files(files=self.untracked_files)
+        files = self.untracked_files
+        stat_cache = self._stat_cache()
+        if stat_cache is None:
+            self._scan_files(files=files)
+            return
+
+        try:
+            started_ns = time.time_ns()
+            keys = {}
+            racy = set()
+            for fn in files:
+                try:
+                    st = os.stat(fn)
+                except OSError:
+                    continue
+                keys[fn] = stat_key(os.path.abspath(fn), st)
+                if st.st_mtime_ns >= started_ns - RACY_WINDOW_NS:
+                    racy.add(fn)
+            unchanged = stat_cache.clean_objects(keys.values())
+            changed = [fn for fn in files if keys.get(fn) not in unchanged]
+            metrics.count("files.unchanged", len(files) - len(changed))
+            log.debug(f"{len(files) - len(changed)} of {len(files)} untracked file(s) unchanged since scanned clean")
+
+            clean_names = self._scan_files(files=changed)
+            stat_cache.mark_clean(keys[fn] for fn in clean_names if fn in keys and fn not in racy)
+        finally:
+            stat_cache.close()
 
     @property
     def author_name(self) -> str:
@@ -64,43 +501,151 @@ class Operations:
 
     def scan_author_metadata(self) -> None:
         log.info("Looking for bad symbols in git author metadata...")
-        self._scanner.scan_string(context="GitAuthor", value=self.author_name)
-        self._scanner.scan_string(context="GitEmail", value=self.author_email)
+        self._scanner.scan_string(context="GitAuthor", value=self.author_name, scope="metadata")
+        self._scanner.scan_string(context="GitEmail", value=self.author_email, scope="metadata")
 
-    def pre_commit_hook(self) -> None:
+    def pre_commit_hook(self, full: bool = False) -> None:
         log.info("pre-commit-hook")
-        self.scan_cached_files()
-        self.scan_author_metadata()
+        with scanning():
+            if full:
+                self.scan_cached_files()
+            else:
+                self.scan_staged_changes()
+            self.scan_author_metadata()
         self.assert_no_errors()
 
-    def assert_no_errors(self) -> None:
+    def assert_no_errors(self, scanned: str = "local changes") -> None:
         if self._scanner.detections:
             log.error(f"Detection of {len(self._scanner.detections)} bad symbol(s)!")
             self._scanner.display_detections()
-            raise errors.BadSymbolsDetectedError("Bad symbols detected in local changes!")
+            raise errors.BadSymbolsDetectedError(f"Bad symbols detected in {scanned}!")
         else:
             log.info("No bad symbols detected")
 
     def commit_message_hook(self, message: str) -> None:
         log.info("commit-message-hook")
 
-        self._scanner.scan_string(context="CommitMessage", value=message)
+        with scanning():
+            self._scanner.scan_string(context="CommitMessage", value=message, scope="message")
         self.assert_no_errors()
 
-    def scan_git_history(self) -> None:
-        log.info("Scanning git history")
-        t1 = time.time()
-        history = subprocess.check_output(["git", "--no-pager", "log", "-p", "--all"]).decode('utf-8')
+    def _commit_exists(self, sha: str) -> bool:
+        result = subprocess.run(
+            ["git", "rev-parse", "--verify", "--quiet", f"{sha}^{{commit}}"],
+            stdout=subprocess.DEVNULL,
+        )
+        return result.returncode == 0
 
-        t2 = time.time()
-        self._scanner.scan_string(context=f"GitHistory", value=history)
-        t3 = time.time()
-        if log.isEnabledFor(logging.DEBUG):
-            log.debug(f"History size = {len(history)} bytes")
-            log.debug(f"Time to extract git history = {t2-t1} seconds")
-            log.debug(f"Time to process git history = {t3-t2} seconds")
+    def _push_revisions(self, push_refs: List[PushRef]) -> List[str]:
+        included = []
+        excluded = []
+        exclude_remotes = False
+        for ref in push_refs:
+            if ref.is_deletion:
+                log.debug(f"Skipping deletion of '{ref.remote_ref}'")
+                continue
+            included.append(ref.local_sha)
+            if not ref.is_new_branch and self._commit_exists(ref.remote_sha):
+                excluded.append(f"^{ref.remote_sha}")
+            else:
+                # New branch (or the remote has commits we don't): only scan commits not yet on any remote
+                exclude_remotes = True
 
-    def pre_push_hook(self) -> None:
+        if not included:
+            return []
+
+        revisions = included + excluded
+        if exclude_remotes:
+            revisions += ["--not", "--remotes"]
+        return revisions
+
+    def scan_git_history(self, revisions: Optional[List[str]] = None) -> None:
+        """ Scans the history reachable from the revisions (all refs by default)
+
+        History is split into contiguous shards, each scanned with a git process of its own, in as many
+        worker processes as there are jobs. Detections are merged in shard order, so they come out in the
+        same order however many jobs are used.
+        """
+        if revisions is None:
+            revisions = ["--all"]
+        log.info(f"Scanning git history ({self._history_mode})")
+        log.debug(f"History revisions: {' '.join(revisions)}")
+
+        if self._history_mode == self.HISTORY_OBJECTS:
+            # Each commit (message, author and committer), tree (entry names) and blob reachable is read
+            # once, however many commits touch it, and without diff context
+            with metrics.timer("git.rev_list"):
+                reachable = git.rev_list_objects(revisions)
+            keys = [history_object_key(self._scanner, o.sha) for o in reachable]
+            unscanned = set(self._cache.unknown_objects(keys))
+            log.debug(f"{len(reachable) - len(unscanned)} of {len(reachable)} object(s) previously scanned clean")
+            tasks = [o for o, key in zip(reachable, keys) if key in unscanned]
+            scan_shard = scan_object_shard
+            per_job = self.OBJECTS_PER_JOB
+            size_unit = "bytes"
+        else:
+            with metrics.timer("git.rev_list"):
+                commits = git.rev_list(revisions)
+            tasks = self._cache.unknown_objects(commits)
+            log.debug(f"{len(commits) - len(tasks)} of {len(commits)} commit(s) previously scanned clean")
+            scan_shard = scan_log_shard
+            per_job = self.COMMITS_PER_JOB
+            size_unit = "characters"
+
+        jobs = job_count(jobs=self._jobs, tasks=len(tasks), tasks_per_job=per_job)
+        found: List[HistoryDetection] = []
+        clean: List[str] = []
+        unconfirmed: List[str] = []
+        history_size = 0
+        for result in scan_map(scan_shard, shards(tasks, jobs), jobs=jobs, scanner=self._scanner, cache=self._cache):
+            found.extend(result.found)
+            clean.extend(result.clean)
+            unconfirmed.extend(result.unconfirmed)
+            history_size += result.size
+            if found and self._scanner.fail_fast:
+                break
+        if not found:
+            clean.extend(unconfirmed)
+        self._cache.mark_clean(clean)
+        log.debug(f"History size = {history_size} {size_unit} in {len(tasks)} object(s)")
+
+        traced = traced_objects(found, self._scanner.max_detections)
+        introduced = git.introducing_commits(traced, revisions) if traced else {}
+        for d in found:
+            self._scanner.record(context=history_context(d, introduced), detections=d.detections)
+
+    def pre_receive_hook(self, receive_refs: List[ReceiveRef]) -> None:
+        """ Scans what a push brings to this (usually bare, server side) repository
+
+        Git runs pre-receive with the pushed objects held in a quarantine directory, reachable through the
+        environment it sets, and before any ref is updated. So what no existing ref reaches is exactly what
+        the push adds, however many refs it updates, and nothing already accepted is scanned again.
+        """
+        log.info("pre-receive-hook")
+        if os.environ.get("GIT_QUARANTINE_PATH"):
+            log.debug(f"Pushed objects quarantined in '{os.environ['GIT_QUARANTINE_PATH']}'")
+        included = []
+        for ref in receive_refs:
+            if ref.is_deletion:
+                log.debug(f"Skipping deletion of '{ref.ref}'")
+            else:
+                included.append(ref.new_sha)
+        with scanning():
+            if included:
+                self.scan_git_history(revisions=included + ["--not", "--all"])
+            else:
+                log.info("Nothing to scan")
+        self.assert_no_errors(scanned="pushed changes")
+
+    def pre_push_hook(self, push_refs: List[PushRef], full: bool = False) -> None:
         log.info("pre-push-hook")
-        self.scan_git_history()
-        self.assert_no_errors()
\ No newline at end of file
+        with scanning():
+            if full:
+                self.scan_git_history()
+            else:
+                revisions = self._push_revisions(push_refs)
+                if revisions:
+                    self.scan_git_history(revisions=revisions)
+                else:
+                    log.info("No commits to scan")
+        self.assert_no_errors()
@@ -0,0 +1,122 @@
+import os
+import logging
+from collections import deque
+from functools import partial
+from typing import TYPE_CHECKING, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+from . import metrics
+from .scan import Scanner
+from .symbol_index import SymbolIndex
+from .cache import ScanCache
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+ScanTask = Callable[[Scanner, ScanCache, T], R]
+
+# Tasks submitted ahead of the result being waited on, per worker
+QUEUED_TASKS_PER_JOB = 4
+
+# Each worker process loads its own Scanner once, when it starts, from the parent's index (so the list isn't
+# parsed and its regexes built again)
+_worker_scanner: Optional[Scanner] = None
+_worker_cache: Optional[ScanCache] = None
+
+
+def _initialise_worker(
+        index: bytes,
+        budget: Optional[float],
+        max_detections: Optional[int],
+        fail_fast: bool,
+        cache_path: str,
+        digest: str,
+        rescan: bool,
+) -> None:
+    global _worker_scanner, _worker_cache
+    _worker_scanner = Scanner(
+        index=SymbolIndex.from_bytes(index), budget=budget, max_detections=max_detections, fail_fast=fail_fast
+    )
+    _worker_cache = ScanCache(path=cache_path, digest=digest, rescan=rescan)
+
+
+def _run_in_worker(func: ScanTask, task: T) -> Tuple[R, Dict[str, Dict]]:
+    # Returns the metrics gathered since the last task (including the worker start up, the first time)
+    # alongside the result, for the parent process to add to its own
+    result = func(_worker_scanner, _worker_cache, task)
+    snapshot = metrics.metrics.snapshot()
+    metrics.metrics.reset()
+    return result, snapshot
+
+
+def _result(future: "Future") -> R:
+    result, snapshot = future.result()
+    metrics.metrics.merge(snapshot)
+    return result
+
+
+def job_count(jobs: Optional[int], tasks: int, tasks_per_job: int) -> int:
+    """ Number of processes to use for `tasks` tasks
+
+    An explicit `jobs` is honoured. Otherwise one process is used per CPU, but no more than one per
+    `tasks_per_job` tasks, as starting a worker costs more than scanning a handful of small inputs.
+    """
+    if jobs is None:
+        jobs = min(os.cpu_count() or 1, tasks // tasks_per_job)
+    return max(1, min(jobs, tasks))
+
+
+def shards(tasks: List[T], jobs: int) -> List[List[T]]:
+    """ Splits tasks into contiguous shards, in order: one for a single job, otherwise a few per job so
+    that the shards keep every worker busy even when they take uneven time
+    """
+    count = 1 if jobs <= 1 else jobs * QUEUED_TASKS_PER_JOB
+    size = max(1, -(-len(tasks) // count))
+    return [tasks[i:i + size] for i in range(0, len(tasks), size)]
+
+
+def scan_map(func: ScanTask, tasks: Iterable[T], jobs: int, scanner: Scanner, cache: ScanCache) -> Iterator[R]:
+    """ Calls `func(scanner, cache, task)` for each task, yielding results in task order
+
+    With more than one job the calls run in a pool of worker processes, each with its own Scanner and
+    ScanCache built from the same symbol list. Tasks are drawn from the iterable only a few at a time
+    per worker, so a lazily produced stream of tasks is never held in memory all at once.
+    """
+    if jobs <= 1:
+        for task in tasks:
+            yield func(scanner, cache, task)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    log.debug(f"Scanning with {jobs} worker process(es)")
+    run = partial(_run_in_worker, func)
+    with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=_initialise_worker,
+            initargs=(
+                scanner.index.to_bytes(),
+                scanner.budget,
+                scanner.max_detections,
+                scanner.fail_fast,
+                cache.path,
+                scanner.digest,
+                cache.rescan,
+            ),
+    ) as executor:
+        pending: Deque["Future"] = deque()
+        try:
+            for task in tasks:
+                pending.append(executor.submit(run, task))
+                if len(pending) >= jobs * QUEUED_TASKS_PER_JOB:
+                    yield _result(pending.popleft())
+            while pending:
+                yield _result(pending.popleft())
+        finally:
+            # When the caller stops early (e.g. failing fast), tasks not yet started are dropped
+            for future in pending:
+                future.cancel()
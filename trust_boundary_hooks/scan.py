@@ -1,58 +1,494 @@
-import re
-from typing import List, NamedTuple, Tuple
+import codecs
+import mmap
+import signal
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple, Union
+from . import errors
+from . import metrics
 from .template import Template
 from .crypto import Crypto
+from .symbol_index import (
+    PREFILTER_PATTERNS,
+    SCOPES,
+    SymbolIndex,
+    SymbolScopes,
+    read_sidecar,
+    source_digest,
+    write_sidecar,
+)
 
 
-def load_bad_symbols() -> Tuple[str, ...]:
-    with open(Template().bad_symbols_path, "r") as f:
-         ciphertext = f.read()
+log = logging.getLogger(__name__)
+
+# Starts a section of the bad symbols file limited to some scopes, e.g. "#scope: metadata, message"
+SCOPE_TAG = "#scope:"
+
+# Starts the section of a merged bad symbols file downloaded from one source, e.g. "#source: <endpoint>/<bucket>/<object>"
+SOURCE_TAG = "#source:"
+
+
+def parse_bad_symbols(content: str) -> Tuple[str, ...]:
 
-    content = Crypto().decrypt(ciphertext)
-    
     def _l(line: str) -> bool:
         return (not line.startswith("#")) and line.strip()
 
     return tuple([x.strip() for x in content.splitlines(keepends=False) if _l(x)])
 
 
+def parse_scoped_bad_symbols(content: str) -> Tuple[Tuple[str, ...], Optional[SymbolScopes]]:
+    """ Parses the bad symbols, and the scopes each applies to, or None for scopes if no section is tagged
+
+    A `#scope: <scope>, ...` line limits the symbols after it, up to the next such line, to those scopes (see
+    SCOPES); `#scope: all` lifts the limit. Being comments, the tags are ignored by older versions, which
+    search for every symbol everywhere. Each `#source:` section starts unlimited again, as each source's list
+    is written on its own. A symbol listed again with the same scopes, e.g. by several sources, is kept once.
+    """
+    symbols = []
+    scopes = []
+    seen = set()
+    tagged = False
+    current = SCOPES
+    for line in content.splitlines(keepends=False):
+        if line.lower().startswith(SOURCE_TAG):
+            current = SCOPES
+        elif line.lower().startswith(SCOPE_TAG):
+            names = [name.strip().lower() for name in line[len(SCOPE_TAG):].split(",") if name.strip()]
+            unknown = [name for name in names if name not in SCOPES and name != "all"]
+            if unknown:
+                log.warning(f"Unknown bad symbol scope(s) {', '.join(unknown)}, known scopes are {', '.join(SCOPES)}")
+            known = tuple(name for name in SCOPES if name in names)
+            # A section limited to nothing known is searched everywhere, rather than nowhere
+            current = SCOPES if "all" in names or not known else known
+            tagged = True
+        elif not line.startswith("#") and line.strip() and (line.strip(), current) not in seen:
+            seen.add((line.strip(), current))
+            symbols.append(line.strip())
+            scopes.append(current)
+    return tuple(symbols), tuple(scopes) if tagged else None
+
+
+def load_bad_symbols() -> Tuple[str, ...]:
+    with metrics.timer("symbols.load"):
+        with open(Template().bad_symbols_path, "r") as f:
+             ciphertext = f.read()
+
+        content = Crypto().decrypt(ciphertext)
+        return parse_bad_symbols(content)
+
+
+# The last index loaded, with the digest of the bad symbols file it was loaded for, so a long running
+# process (the scanner daemon) only loads it again once the file changes
+_loaded: Optional[Tuple[bytes, SymbolIndex]] = None
+
+
+def load_symbol_index() -> SymbolIndex:
+    """ Loads the bad symbols as an index, ready to search with
+
+    The index is kept, encrypted, in a sidecar of the bad symbols file and rebuilt only when that file
+    changes, so hooks neither parse the list nor build and compile its regexes every time they run.
+    """
+    global _loaded
+
+    template = Template()
+    with metrics.timer("symbols.load"):
+        with open(template.bad_symbols_path, "rb") as f:
+            ciphertext = f.read()
+        digest = source_digest(ciphertext)
+        if _loaded is not None and _loaded[0] == digest:
+            return _loaded[1]
+        index = read_sidecar(template.symbol_index_path, digest)
+        if index is None:
+            symbols, scopes = parse_scoped_bad_symbols(Crypto().decrypt(ciphertext.decode('ascii')))
+
+    if index is None:
+        log.debug(f"Building symbol index '{template.symbol_index_path}'")
+        index = SymbolIndex.build(symbols, scopes).precompile(PREFILTER_PATTERNS)
+        try:
+            write_sidecar(template.symbol_index_path, digest, index)
+        except OSError as e:
+            log.warning(f"Unable to write symbol index '{template.symbol_index_path}' ({e})")
+    _loaded = (digest, index)
+    return index
+
+
+def symbols_digest(symbols: Tuple[str, ...], scopes: Optional[SymbolScopes] = None) -> str:
+    """ Identifies a bad symbol list, and their scopes, e.g. for keying cached scan results """
+    h = hashlib.sha256("\n".join(symbols).encode('utf-8'))
+    if scopes is not None:
+        h.update(b"\0" + "\n".join(",".join(s) for s in scopes).encode('utf-8'))
+    return h.hexdigest()
+
+
+# Raw content is searched this many bytes at a time
+BYTES_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Raw file content: bytes, or a memory map of a large file
+Content = Union[bytes, memoryview, mmap.mmap]
+
+_BOM_ENCODINGS = (
+    # UTF-32 first, as its little-endian mark starts with the UTF-16 one
+    (codecs.BOM_UTF32_LE, "utf-32-le"),
+    (codecs.BOM_UTF32_BE, "utf-32-be"),
+    (codecs.BOM_UTF8, "utf-8"),
+    (codecs.BOM_UTF16_LE, "utf-16-le"),
+    (codecs.BOM_UTF16_BE, "utf-16-be"),
+)
+
+
+# Bytes from the start of content without a byte order mark looked at to tell whether it is UTF-16
+UTF16_SAMPLE_SIZE = 4096
+
+
+def _utf16_byte_order(sample: bytes) -> Optional[str]:
+    """ The encoding of text that looks like UTF-16 without a byte order mark, or None
+
+    Mostly ASCII text in UTF-16 has a NUL in the high byte of most characters and hardly any in the low
+    byte. It is valid UTF-8 too (NUL is ASCII), but decoded as UTF-8 every other character is a NUL.
+    """
+    pairs = len(sample) // 2
+    even_nuls = sample[0:2 * pairs:2].count(0)
+    odd_nuls = sample[1:2 * pairs:2].count(0)
+    if odd_nuls >= pairs / 2 and even_nuls <= odd_nuls / 8:
+        return "utf-16-le"
+    if even_nuls >= pairs / 2 and odd_nuls <= even_nuls / 8:
+        return "utf-16-be"
+    return None
+
+
+def _utf32_like(sample: bytes) -> bool:
+    """ Whether content looks like UTF-32, with a byte order mark or with the NULs of mostly ASCII text
+
+    Mostly ASCII text in UTF-32 is a NUL in the three high bytes of most characters and not in the low one,
+    unlike binary data padded with NULs.
+    """
+    if sample.startswith((codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE)):
+        return True
+    chars = len(sample) // 4
+    if not chars or b"\0\0\0" not in sample:
+        return False
+    little = sum(1 for i in range(0, 4 * chars, 4) if sample[i] and not any(sample[i + 1:i + 4]))
+    big = sum(1 for i in range(0, 4 * chars, 4) if sample[i + 3] and not any(sample[i:i + 3]))
+    return max(little, big) >= chars / 2
+
+
+def decode_text(content: Content) -> Optional[str]:
+    """ Decodes content whose encoding is unambiguous: UTF-8 (including ASCII), UTF-32 with a byte order
+    mark, or UTF-16 with a byte order mark or with the NULs of mostly ASCII text. Returns None for anything
+    else, which needs charset detection.
+    """
+    with metrics.timer("scan.decode"), memoryview(content) as view:
+        encodings = ["utf-8"]
+        start = 0
+        for bom, bom_encoding in _BOM_ENCODINGS:
+            if view[:len(bom)] == bom:
+                encodings = [bom_encoding]
+                start = len(bom)
+                break
+        else:
+            sample = bytes(view[:UTF16_SAMPLE_SIZE])
+            if b"\0" in sample:
+                utf16_encoding = _utf16_byte_order(sample)
+                if utf16_encoding is not None:
+                    encodings.insert(0, utf16_encoding)
+        for encoding in encodings:
+            try:
+                return str(view[start:], encoding)
+            except UnicodeDecodeError:
+                continue
+        return None
+
+
+class _TimeLimitExpired(Exception):
+    pass
+
+
+def _expire(signum, frame) -> None:
+    raise _TimeLimitExpired()
+
+
+@contextmanager
+def time_limit(seconds: Optional[float]) -> Iterator[None]:
+    """ Raises TimeoutError if the body runs for longer than `seconds`
+
+    A regex search can be interrupted like this, as the regex engine checks for signals while it backtracks.
+    Only possible in the main thread of platforms with interval timers; elsewhere there is no limit.
+    """
+    if not seconds or not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    previous = signal.signal(signal.SIGALRM, _expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    except _TimeLimitExpired:
+        raise TimeoutError(f"Took longer than {seconds:g} second(s)") from None
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+# Detections kept, with their context and position, by default; any more are only counted
+DEFAULT_MAX_DETECTIONS = 1000
+
+
+class Detection(NamedTuple):
+
+    # The text matched
+    match: str
+    # Where, in characters and lines from the start of the text searched
+    offset: Optional[int] = None
+    line: Optional[int] = None
+    # For history: the file (of a commit's patch) and commit the match is in
+    path: Optional[str] = None
+    commit: Optional[str] = None
+
+    @property
+    def location(self) -> str:
+        if self.line is None:
+            return ""
+        return f"{self.path}:{self.line}" if self.path else f"line {self.line}"
+
+
 class ScanRun(NamedTuple):
 
     context: str
-    detections: Tuple[str, ...]
+    detections: Tuple[Detection, ...]
+
+
+class FirstDetection(Exception):
+    """ Raised on the first detection when failing fast, to stop scanning """
+
+
+@contextmanager
+def scanning() -> Iterator[None]:
+    """ Scans run in this context stop, without error, at the first detection when failing fast """
+    try:
+        yield
+    except FirstDetection:
+        log.info("Stopped scanning at the first detection")
+
+
+class DetectionStore:
+    """ The detections made so far, grouped by context
+
+    Only contexts with detections are kept, and at most `limit` detections are kept in all (any number for
+    a limit of None or 0); the rest are only counted. The distinct matches are maintained as detections are added.
+    """
+
+    def __init__(self, limit: Optional[int] = DEFAULT_MAX_DETECTIONS) -> None:
+        self._limit = limit or None
+        self._runs: List[ScanRun] = []
+        self._matches: Set[str] = set()
+        self._sorted_matches: Optional[Tuple[str, ...]] = ()
+        self._kept = 0
+        self._dropped = 0
+
+    def add(self, context: str, detections: Tuple[Detection, ...]) -> None:
+        if not detections:
+            return
+        self._matches.update(d.match for d in detections)
+        self._sorted_matches = None
+        if self._limit is not None:
+            room = max(0, self._limit - self._kept)
+            self._dropped += max(0, len(detections) - room)
+            detections = detections[:room]
+        if detections:
+            self._runs.append(ScanRun(context=context, detections=detections))
+            self._kept += len(detections)
+
+    @property
+    def runs(self) -> Tuple[ScanRun, ...]:
+        return tuple(self._runs)
+
+    @property
+    def matches(self) -> Tuple[str, ...]:
+        """ The distinct text matched, sorted """
+        if self._sorted_matches is None:
+            self._sorted_matches = tuple(sorted(self._matches))
+        return self._sorted_matches
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    @property
+    def limit(self) -> Optional[int]:
+        return self._limit
 
 
 class Scanner:
 
-    def __init__(self) -> None:
-        regex = "|".join(load_bad_symbols())
-        self._search = re.compile(regex, re.IGNORECASE)
-        self._scan_runs: List[ScanRun] = []
+    def __init__(
+            self,
+            symbols: Optional[Tuple[str, ...]] = None,
+            index: Optional[SymbolIndex] = None,
+            budget: Optional[float] = None,
+            max_detections: Optional[int] = DEFAULT_MAX_DETECTIONS,
+            fail_fast: bool = False,
+    ) -> None:
+        if index is None:
+            index = load_symbol_index() if symbols is None else SymbolIndex.build(symbols)
+        self._index = index
+        # Seconds a single search may take before the scan fails, rather than hang on pathological input
+        self._budget = budget
+        # Stop scanning at the first detection, e.g. in a hook, which one detection is enough to fail
+        self._fail_fast = fail_fast
+        self._symbols = index.symbols
+        self._digest = symbols_digest(self._symbols, index.scopes)
+        self._store = DetectionStore(limit=max_detections)
 
-    def scan_string(self, context: str, value: str) -> None:
+    @property
+    def digest(self) -> str:
+        return self._digest
+
+    @property
+    def symbols(self) -> Tuple[str, ...]:
+        return self._symbols
+
+    @property
+    def index(self) -> SymbolIndex:
+        return self._index
+
+    @property
+    def budget(self) -> Optional[float]:
+        return self._budget
+
+    @property
+    def fail_fast(self) -> bool:
+        return self._fail_fast
+
+    @property
+    def max_detections(self) -> Optional[int]:
+        return self._store.limit
+
+    @staticmethod
+    def _may_match(index: SymbolIndex, value: str) -> bool:
+        ascii_search = index.pattern("ascii")
+        if ascii_search is not None and ascii_search.search(value.lower()):
+            return True
+        literal_search = index.pattern("literal")
+        if literal_search is not None and literal_search.search(value):
+            return True
+        regex_search = index.pattern("regex")
+        return regex_search is not None and regex_search.search(value) is not None
+
+    @staticmethod
+    def _may_match_bytes(index: SymbolIndex, content: Content) -> bool:
+        utf8_search, utf16_search = index.pattern("utf8"), index.pattern("utf16")
+        # UTF-16 encoded ASCII is full of NUL bytes, which text in other encodings hardly ever contains
+        searches = [utf8_search]
+        if content.find(b"\0") != -1:
+            searches.append(utf16_search)
+
+        # Lower-cased a chunk at a time, so memory mapped content is never copied whole
+        overlap = index.byte_overlap
+        step = max(BYTES_CHUNK_SIZE, 2 * overlap)
+        for start in range(0, len(content), step):
+            chunk = content[start:start + step + overlap].lower()
+            if any(search.search(chunk) for search in searches):
+                return True
+        return False
+
+    def search(self, value: str, scope: Optional[str] = None) -> Tuple[str, ...]:
+        """ Returns the sorted, distinct bad symbol matches in the value """
+        return tuple(sorted({d.match for d in self.locate(value, scope)}))
+
+    def locate(self, value: str, scope: Optional[str] = None) -> Tuple[Detection, ...]:
+        """ Returns the bad symbol matches in the value, in order, with their offsets and lines (no more than
+        the detections kept)
+
+        Only the symbols that apply to the kind of context given by `scope` (see CONTEXT_SCOPES) are searched
+        for, or every symbol for None.
+        """
+        index = self._index.for_context(scope)
+        if index is None:
+            return ()
+
+        # The automaton only tells us whether something matches. What matches is decided by the single
+        # alternation of all symbols (some of which are regexes, e.g. containing white space), so results
+        # are exactly those of matching the whole list at once.
+        metrics.count("scan.chars", len(value))
+        try:
+            with metrics.timer("scan.search"), time_limit(self._budget):
+                if not self._may_match(index, value):
+                    return ()
+                detections = []
+                line = 1
+                previous = 0
+                for match in index.pattern("full").finditer(value):
+                    line += value.count("\n", previous, match.start())
+                    previous = match.start()
+                    detections.append(Detection(match=match.group(), offset=match.start(), line=line))
+                    if self._store.limit is not None and len(detections) >= self._store.limit:
+                        break
+                return tuple(detections)
+        except TimeoutError:
+            # Failing is safer than passing content that was never fully searched
+            raise errors.ScanBudgetExceededError(
+                f"Searching {len(value)} character(s) took longer than the {self._budget:g} second scan budget, "
+                f"check the bad symbols with 'tbh-utils lint-symbols'"
+            ) from None
+
+    def search_bytes(self, content: Content, scope: Optional[str] = None) -> Optional[Tuple[Detection, ...]]:
+        """ Searches raw file content, returning None when it must be decoded with charset detection first
+
+        Content in an unambiguous encoding (see decode_text) is decoded directly and searched as text. For lists
+        of plain ASCII words, large content and content in any other encoding is first searched as bytes for the
+        words as UTF-8, UTF-16 or any ASCII-compatible encoding would store them, and passed without decoding
+        if none occur. Content that looks like UTF-32, which stores them otherwise, is always decoded.
+        """
+        metrics.count("scan.bytes", len(content))
+        index = self._index.for_context(scope)
+        if index is None:
+            return ()
+        small = len(content) < BYTES_CHUNK_SIZE
+        decoded = decode_text(content) if small else None
+        if decoded is None and index.byte_overlap and not _utf32_like(bytes(content[:UTF16_SAMPLE_SIZE])):
+            with metrics.timer("scan.search_bytes"):
+                if not self._may_match_bytes(index, content):
+                    return ()
+        if decoded is None and not small:
+            decoded = decode_text(content)
+        return None if decoded is None else self.locate(decoded, scope)
+
+    def record(self, context: str, detections: Iterable[Union[str, Detection]]) -> None:
+        """ Records the result of a search, e.g. one run in a worker process """
+        metrics.count("scan.contexts")
+        detections = tuple(d if isinstance(d, Detection) else Detection(match=d) for d in detections)
+        self._store.add(context, detections)
+        if detections and self._fail_fast:
+            raise FirstDetection(context)
+
+    def scan_string(self, context: str, value: str, scope: Optional[str] = None) -> Tuple[str, ...]:
         assert isinstance(value, str)
 
-        # Sadly we cannot optimise this search by simplifying to a set of words due to the potential for
-        # regex containing white space
+        # A name, message or author's details, where a position says nothing the context doesn't
+        detections = tuple(d._replace(offset=None, line=None) for d in self.locate(value, scope))
+        self.record(context=context, detections=detections)
+        return tuple(sorted({d.match for d in detections}))
 
-        matches = tuple(sorted(set(self._search.findall(value))))
-        self._scan_runs.append(
-            ScanRun(
-                context=context,
-                detections=tuple(matches),
-            )
-        )
+    @property
+    def scan_runs(self) -> Tuple[ScanRun, ...]:
+        """ The contexts with detections """
+        return self._store.runs
 
     @property
     def detections(self) -> Tuple[str, ...]:
-        r = set()
-        for sr in self._scan_runs:
-            for d in sr.detections:
-                r.add(d)
-        return tuple(sorted(r))
+        return self._store.matches
 
     def display_detections(self) -> None:
-        for sr in self._scan_runs:
-            if sr.detections:
-                fl = ", ".join([f"'{x}'" for x in sr.detections])
-                print(f"Context: {sr.context} -> Detections: {fl}")
+        for sr in self._store.runs:
+            # Each distinct match once, with where it was found
+            locations = {}
+            for d in sr.detections:
+                locations.setdefault(d.match, [])
+                if d.location:
+                    locations[d.match].append(d.location)
+            fl = ", ".join(f"'{m}' ({', '.join(where)})" if where else f"'{m}'" for m, where in locations.items())
+            print(f"Context: {sr.context} -> Detections: {fl}")
+        if self._store.dropped:
+            # Searches stop at the limit too, so there may be more than were counted
+            print(f"... and at least {self._store.dropped} more detection(s), over the limit of {self._store.limit}")
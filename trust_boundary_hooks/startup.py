@@ -0,0 +1,83 @@
+import subprocess
+import sys
+import time
+import logging
+from typing import Dict, List, NamedTuple, Tuple
+
+
+log = logging.getLogger(__name__)
+
+# What a hook process imports before it starts scanning
+HOOK_MODULES = ("trust_boundary_hooks.cli", "trust_boundary_hooks.ops", "click_log")
+
+# Packages only needed to refresh the bad symbols, read the keyring (hooks mostly ask the agent), decode
+# unusual content or scan in worker processes, which hooks must not import up front
+DEFERRED_PACKAGES = ("minio", "urllib3", "keyring", "bs4", "chardet", "multiprocessing", "concurrent")
+
+DEFAULT_BUDGET_MS = 300
+
+
+class ImportProfile(NamedTuple):
+
+    # Wall time of a fresh interpreter importing the hook modules
+    wall_ms: float
+    # Time spent importing each top level package (beyond what interpreter start up imports anyway)
+    packages: Dict[str, float]
+
+    @property
+    def import_ms(self) -> float:
+        return sum(self.packages.values())
+
+    def slowest(self, count: int) -> List[Tuple[str, float]]:
+        return sorted(self.packages.items(), key=lambda x: x[1], reverse=True)[:count]
+
+
+def _import_times(statement: str) -> Tuple[float, Dict[str, int]]:
+    """ Runs the statement in a fresh interpreter, returning its wall time and the self time in
+    microseconds of every module it imported
+    """
+    t1 = time.time()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    wall_ms = (time.time() - t1) * 1000
+
+    # Lines look like "import time: <self us> | <cumulative us> | <indent><module>"
+    modules = {}
+    for line in result.stderr.decode('utf-8').splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        if self_us.strip().isdigit():
+            modules[name.strip()] = int(self_us)
+    return wall_ms, modules
+
+
+def profile_hook_imports() -> ImportProfile:
+    _, baseline = _import_times("pass")
+    wall_ms, modules = _import_times("; ".join(f"import {m}" for m in HOOK_MODULES))
+    packages: Dict[str, float] = {}
+    for module, self_us in modules.items():
+        if module in baseline:
+            continue
+        package = module.split(".")[0]
+        packages[package] = packages.get(package, 0.0) + self_us / 1000
+    return ImportProfile(wall_ms=wall_ms, packages=packages)
+
+
+def check_hook_imports(budget_ms: float = DEFAULT_BUDGET_MS) -> List[str]:
+    """ Returns the ways hook start up is over budget (an empty list when it is within it) """
+    profile = profile_hook_imports()
+    log.info(f"Hook modules import in {profile.import_ms:.0f}ms ({profile.wall_ms:.0f}ms including interpreter start up)")
+    for package, ms in profile.slowest(count=8):
+        log.info(f"  {package}: {ms:.1f}ms")
+
+    failures = []
+    if profile.import_ms > budget_ms:
+        failures.append(f"Hook imports take {profile.import_ms:.0f}ms, over the {budget_ms:.0f}ms budget")
+    for package in DEFERRED_PACKAGES:
+        if package in profile.packages:
+            failures.append(f"Hooks import '{package}' up front")
+    return failures
@@ -0,0 +1,259 @@
+import os
+import re
+import json
+import struct
+import hashlib
+import logging
+from typing import Dict, List, Optional, Pattern, Tuple, Union
+from . import metrics
+from .symbols import (
+    ascii_literal_byte_patterns,
+    ascii_literal_pattern,
+    classify_symbols,
+    literal_trie_pattern,
+    max_encoded_length,
+)
+
+
+log = logging.getLogger(__name__)
+
+# Sidecar file layout: magic, format version, sha256 of the bad symbols file it was built from, then the
+# encrypted index (see SymbolIndex.to_bytes)
+SIDECAR_MAGIC = b"TBHIDX"
+SIDECAR_VERSION = 3
+_SIDECAR_HEADER = struct.Struct(f">{len(SIDECAR_MAGIC)}sH32s")
+
+# Patterns the Scanner compiles up front; the rest are only compiled on a possible match
+PREFILTER_PATTERNS = ("ascii", "literal", "regex")
+ALL_PATTERNS = PREFILTER_PATTERNS + ("full", "utf8", "utf16")
+
+Source = Union[str, bytes]
+
+# Scopes a section of the bad symbols file can be limited to; untagged symbols apply to all of them
+SCOPES = ("metadata", "message", "filename", "content", "history")
+
+# The scopes searched in each kind of context
+CONTEXT_SCOPES = {
+    "metadata": ("metadata", ),
+    "message": ("message", ),
+    "filename": ("filename", ),
+    "content": ("content", ),
+    # A commit's patch holds its author, message, file names and content
+    "history": SCOPES,
+    # A commit, tree and blob object, in history scanned an object at a time: between them they hold
+    # what the commit's patch would
+    "history_commit": ("metadata", "message", "history"),
+    "history_tree": ("filename", "history"),
+    "history_blob": ("content", "history"),
+}
+
+# Each symbol's scopes, in the order of the symbols
+SymbolScopes = Tuple[Tuple[str, ...], ...]
+
+
+class SymbolIndex:
+    """ A bad symbol list, classified and turned into the regexes the Scanner searches with
+
+    Building the regexes is a large part of a hook's start up cost for a long list, so an index can be
+    stored and loaded again without building them. Only their sources are stored, as compiled regexes can
+    only be stored through the regex engine's private internals, which change between Python releases;
+    they are compiled when first used.
+    """
+
+    def __init__(
+            self,
+            symbols: Tuple[str, ...],
+            sources: Dict[str, Tuple[Source, int]],
+            byte_overlap: int,
+            scopes: Optional[SymbolScopes] = None,
+            scoped: Optional[Dict[str, Optional["SymbolIndex"]]] = None,
+    ) -> None:
+        self._symbols = symbols
+        self._sources = sources
+        self._byte_overlap = byte_overlap
+        self._patterns: Dict[str, Pattern] = {}
+        self._scopes = scopes
+        self._scoped = scoped or {}
+
+    @classmethod
+    def build(cls, symbols: Tuple[str, ...], scopes: Optional[SymbolScopes] = None) -> "SymbolIndex":
+        """ Builds the index, and, for symbols limited to some scopes, an index of its own for each kind of
+        context, so e.g. file content isn't searched for symbols that only apply to author metadata
+        """
+        index = cls._build(symbols)
+        if scopes is None or all(set(SCOPES) <= set(s) for s in scopes):
+            return index
+
+        by_symbols: Dict[Tuple[str, ...], Optional[SymbolIndex]] = {symbols: index, (): None}
+        for context, context_scopes in CONTEXT_SCOPES.items():
+            subset = tuple(symbol for symbol, s in zip(symbols, scopes) if set(s) & set(context_scopes))
+            if subset not in by_symbols:
+                by_symbols[subset] = cls._build(subset)
+            index._scoped[context] = by_symbols[subset]
+        index._scopes = scopes
+        return index
+
+    @classmethod
+    def _build(cls, symbols: Tuple[str, ...]) -> "SymbolIndex":
+        # Most symbols are plain words. They are merged into automata, so clean input (the common case) is
+        # rejected at a cost that barely grows with the number of symbols; only the real regexes are tried
+        # one by one. ASCII words (nearly all of them) are matched against lower-cased input, which is
+        # faster than matching case-insensitively.
+        with metrics.timer("scan.compile"):
+            literals, regexes = classify_symbols(symbols)
+            ascii_literals = tuple(literal for literal in literals if literal.isascii())
+            other_literals = tuple(literal for literal in literals if not literal.isascii())
+            sources: Dict[str, Tuple[Source, int]] = {"full": ("|".join(symbols), re.IGNORECASE)}
+            if ascii_literals:
+                sources["ascii"] = (ascii_literal_pattern(ascii_literals), 0)
+            if other_literals:
+                sources["literal"] = (literal_trie_pattern(other_literals), re.IGNORECASE)
+            if regexes or not literals:
+                # An empty symbol list compiles to the empty regex, which matches everything - keep it that way
+                sources["regex"] = ("|".join(regexes), re.IGNORECASE)
+
+            # When every symbol is an ASCII word, raw content can be searched without decoding it at all
+            byte_overlap = 0
+            if ascii_literals and not other_literals and not regexes:
+                utf8, utf16 = ascii_literal_byte_patterns(ascii_literals)
+                sources["utf8"] = (utf8, 0)
+                sources["utf16"] = (utf16, 0)
+                byte_overlap = max_encoded_length(ascii_literals)
+        return cls(symbols=symbols, sources=sources, byte_overlap=byte_overlap)
+
+    @property
+    def symbols(self) -> Tuple[str, ...]:
+        return self._symbols
+
+    @property
+    def scopes(self) -> Optional[SymbolScopes]:
+        """ Each symbol's scopes, or None when none of the symbols are limited to some scopes """
+        return self._scopes
+
+    def for_context(self, context: Optional[str]) -> Optional["SymbolIndex"]:
+        """ The index to search a kind of context (see CONTEXT_SCOPES) with, or None if no symbols apply
+        to it; every symbol applies to a context of None
+        """
+        if context is None or context not in self._scoped:
+            return self
+        return self._scoped[context]
+
+    def _scoped_indexes(self) -> List["SymbolIndex"]:
+        indexes: List[SymbolIndex] = []
+        for index in self._scoped.values():
+            if index is not None and index is not self and not any(index is i for i in indexes):
+                indexes.append(index)
+        return indexes
+
+    @property
+    def byte_overlap(self) -> int:
+        """ Bytes of overlap needed between chunks of raw content, or 0 if raw content can't be searched """
+        return self._byte_overlap
+
+    def pattern(self, name: str) -> Optional[Pattern]:
+        """ The named regex, compiled on first use, or None if the list doesn't need it """
+        if name not in self._sources:
+            return None
+        if name not in self._patterns:
+            source, flags = self._sources[name]
+            with metrics.timer("scan.compile"):
+                self._patterns[name] = re.compile(source, flags)
+        return self._patterns[name]
+
+    def precompile(self, names: Tuple[str, ...] = ALL_PATTERNS) -> "SymbolIndex":
+        for index in [self] + self._scoped_indexes():
+            for name in names:
+                index.pattern(name)
+        return self
+
+    def to_bytes(self) -> bytes:
+        """ A JSON header, with a 4 byte length before it, followed by the index of each scope, each with a 4
+        byte length before it
+        """
+        scoped_indexes = self._scoped_indexes()
+        scoped_data = b"".join(
+            struct.pack(">I", len(data)) + data for data in (index.to_bytes() for index in scoped_indexes)
+        )
+        header = json.dumps({
+            "symbols": list(self._symbols),
+            # Bytes sources are stored as Latin-1, which maps every byte to one character
+            "sources": {
+                name: [source.decode('latin-1') if isinstance(source, bytes) else source, flags, isinstance(source, bytes)]
+                for name, (source, flags) in self._sources.items()
+            },
+            "byte_overlap": self._byte_overlap,
+            "scopes": None if self._scopes is None else [list(s) for s in self._scopes],
+            # Each context's index, by its position in the indexes that follow, with -1 for this one
+            "scoped": {
+                context: None if index is None else -1 if index is self else next(
+                    i for i, scoped_index in enumerate(scoped_indexes) if scoped_index is index
+                )
+                for context, index in self._scoped.items()
+            },
+        }).encode('utf-8')
+        return struct.pack(">I", len(header)) + header + scoped_data
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "SymbolIndex":
+        (header_length, ) = struct.unpack_from(">I", data)
+        header = json.loads(data[4:4 + header_length].decode('utf-8'))
+        sources: Dict[str, Tuple[Source, int]] = {
+            name: (source.encode('latin-1') if is_bytes else source, flags)
+            for name, (source, flags, is_bytes) in header["sources"].items()
+        }
+        scoped_indexes = []
+        offset = 4 + header_length
+        while offset < len(data):
+            (length, ) = struct.unpack_from(">I", data, offset)
+            scoped_indexes.append(cls.from_bytes(data[offset + 4:offset + 4 + length]))
+            offset += 4 + length
+        index = cls(
+            symbols=tuple(header["symbols"]),
+            sources=sources,
+            byte_overlap=header["byte_overlap"],
+            scopes=None if header["scopes"] is None else tuple(tuple(s) for s in header["scopes"]),
+        )
+        index._scoped = {
+            context: None if i is None else index if i == -1 else scoped_indexes[i]
+            for context, i in header["scoped"].items()
+        }
+        return index
+
+
+def source_digest(bad_symbols_file: bytes) -> bytes:
+    return hashlib.sha256(bad_symbols_file).digest()
+
+
+def read_sidecar(path: str, digest: bytes) -> Optional[SymbolIndex]:
+    """ Loads the index stored at `path`, or returns None if there is none for the bad symbols with `digest` """
+    from .crypto import Crypto
+
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        magic, version, sidecar_digest = _SIDECAR_HEADER.unpack_from(data)
+        if magic != SIDECAR_MAGIC or version != SIDECAR_VERSION:
+            log.debug(f"Ignoring symbol index '{path}' in an unknown format")
+            return None
+        if sidecar_digest != digest:
+            log.debug(f"Ignoring symbol index '{path}' built from another bad symbols file")
+            return None
+        with metrics.timer("symbols.index"):
+            return SymbolIndex.from_bytes(Crypto().decrypt_bytes(data[_SIDECAR_HEADER.size:]))
+    except (ValueError, KeyError, TypeError, struct.error) as e:
+        log.warning(f"Ignoring unreadable symbol index '{path}' ({e})")
+        return None
+
+
+def write_sidecar(path: str, digest: bytes, index: SymbolIndex) -> None:
+    from .crypto import Crypto
+
+    data = _SIDECAR_HEADER.pack(SIDECAR_MAGIC, SIDECAR_VERSION, digest) + Crypto().encrypt_bytes(index.to_bytes())
+    # Replaced whole, so concurrent hooks never read a half written index
+    temporary_path = f"{path}.{os.getpid()}"
+    with open(temporary_path, "wb") as f:
+        f.write(data)
+    os.replace(temporary_path, path)
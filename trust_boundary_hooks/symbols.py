@@ -0,0 +1,122 @@
+import re
+from typing import AnyStr, Dict, Iterable, List, Sequence, Tuple
+
+
+# Characters with a special meaning in a (non-verbose) regular expression
+REGEX_METACHARACTERS = frozenset(".^$*+?{}[]\\|()")
+
+
+def is_literal(symbol: str) -> bool:
+    """ True if the symbol matches only its own text, i.e. contains no regex syntax """
+    return not REGEX_METACHARACTERS.intersection(symbol)
+
+
+def classify_symbols(symbols: Iterable[str]) -> Tuple[Tuple[str, ...], Tuple[str, ...]]:
+    """ Splits symbols into (literals, regexes), preserving their order """
+    literals: List[str] = []
+    regexes: List[str] = []
+    for symbol in symbols:
+        (literals if is_literal(symbol) else regexes).append(symbol)
+    return tuple(literals), tuple(regexes)
+
+
+def _fold(c: str) -> str:
+    # Only merge trie branches where lower-casing maps one character to one character, which is exactly
+    # where `re.IGNORECASE` treats the two as equal.
+    lower = c.lower()
+    return lower if len(lower) == 1 else c
+
+
+def _trie_source(sequences: Iterable[Sequence[AnyStr]], empty: AnyStr) -> AnyStr:
+    # Each sequence is a run of already escaped regex atoms; `empty` selects str or bytes output
+    end = None
+    root: Dict = {}
+    for sequence in sequences:
+        node = root
+        for atom in sequence:
+            if end in node:
+                break
+            node = node.setdefault(atom, {})
+        else:
+            node.clear()
+            node[end] = {}
+
+    group_open, alternation, group_close = (x.encode('ascii') if isinstance(empty, bytes) else x for x in ("(?:", "|", ")"))
+
+    def _source(node: Dict) -> AnyStr:
+        parts = []
+        # Runs without branches are emitted iteratively, so only branching points recurse
+        while end not in node:
+            if len(node) == 1:
+                ((atom, node), ) = node.items()
+                parts.append(atom)
+                continue
+            branches = [atom + _source(child) for atom, child in sorted(node.items())]
+            parts.append(group_open + alternation.join(branches) + group_close)
+            break
+        return empty.join(parts)
+
+    return _source(root)
+
+
+def literal_trie_pattern(literals: Iterable[str]) -> str:
+    """ Builds a regex matching wherever any of the literals occurs
+
+    The literals are merged into a prefix tree, and the tree is written out as nested alternations so the
+    regex engine runs it as an automaton: the work per input character depends on the branching of the
+    tree rather than on the number of literals. Compile the result with `re.IGNORECASE`.
+
+    The pattern answers "does any literal occur here", not "which": a literal that has another literal as
+    a prefix is pruned, as the shorter one already occurs wherever the longer one does.
+    """
+    return _trie_source(([re.escape(_fold(c)) for c in literal] for literal in literals), "")
+
+
+# Non-ASCII characters `re.IGNORECASE` treats as equal to an ASCII letter
+_ASCII_CASE_EXTRAS = {"i": "\u0130\u0131", "k": "\u212a", "s": "\u017f"}
+
+
+def ascii_literal_pattern(literals: Iterable[str]) -> str:
+    """ Like `literal_trie_pattern` for ASCII literals, but to be matched case-sensitively against lower-cased
+    text, which the regex engine runs several times faster than a case-insensitive match
+
+    Lower-casing folds every character `re.IGNORECASE` equates with an ASCII letter onto that letter, except
+    for the few spelled out here as alternatives.
+    """
+    atoms = {c: re.escape(c) for c in map(chr, range(128))}
+    for c, extras in _ASCII_CASE_EXTRAS.items():
+        atoms[c] = "(?:" + "|".join(re.escape(v.lower()) for v in c + extras) + ")"
+    return _trie_source(([atoms[c] for c in literal.lower()] for literal in literals), "")
+
+
+def _ascii_literal_byte_pattern(literals: List[str], encodings: Tuple[str, ...]) -> bytes:
+    sequences = []
+    for encoding in encodings:
+
+        def _atom(c: str) -> bytes:
+            variants = [re.escape(v.encode(encoding).lower()) for v in c + _ASCII_CASE_EXTRAS.get(c, "")]
+            return variants[0] if len(variants) == 1 else b"(?:" + b"|".join(variants) + b")"
+
+        sequences += [[_atom(c) for c in literal] for literal in literals]
+    return _trie_source(sequences, b"")
+
+
+def ascii_literal_byte_patterns(literals: Iterable[str]) -> Tuple[bytes, bytes]:
+    """ Builds bytes regexes matching wherever any of the ASCII literals occurs in raw content: the first
+    for content in UTF-8 (ASCII text is encoded identically in Latin-1 and the other ASCII-compatible single
+    byte encodings), the second for UTF-16 in either byte order
+
+    Match them case-sensitively against lower-cased content. Lower-casing bytes folds ASCII letters, and the
+    non-ASCII characters that fold to an ASCII letter in a str pattern are spelled out as alternatives.
+    """
+    literals = [literal.lower() for literal in literals]
+    assert all(literal.isascii() for literal in literals)
+    return (
+        _ascii_literal_byte_pattern(literals, ("utf-8", )),
+        _ascii_literal_byte_pattern(literals, ("utf-16-le", "utf-16-be")),
+    )
+
+
+def max_encoded_length(literals: Iterable[str]) -> int:
+    """ Upper bound on the bytes an ASCII literal (or a case variant of it) occupies in any supported encoding """
+    return 4 * max((len(literal) for literal in literals), default=0)
@@ -4,15 +4,106 @@ from . import errors
 import sys
 from pathlib import Path
 import json
-from minio import Minio
-from minio.error import S3Error
-import urllib3
+import time
 import subprocess
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 from .crypto import Crypto
+from . import metrics
 
 
 log = logging.getLogger(__name__)
 
+# Optional Minio config key: hooks refresh the bad symbols in the background once they were last checked
+# this long ago (0 or absent to only refresh on demand)
+REFRESH_TTL_KEY = "refresh_ttl_seconds"
+DEFAULT_REFRESH_TTL = 24 * 60 * 60
+
+# Optional Minio config key: what to do with a downloaded list containing a regex that backtracks
+# catastrophically, grows super-linearly or doesn't compile - refuse it (keeping the current list), warn
+# about it, or not check at all
+SYMBOL_LINT_KEY = "symbol_lint"
+SYMBOL_LINT_REFUSE = "refuse"
+SYMBOL_LINT_WARN = "warn"
+SYMBOL_LINT_OFF = "off"
+SYMBOL_LINT_ACTIONS = (SYMBOL_LINT_REFUSE, SYMBOL_LINT_WARN, SYMBOL_LINT_OFF)
+DEFAULT_SYMBOL_LINT = SYMBOL_LINT_WARN
+
+# Optional Minio config key: a list of sources, each with a `bucket` and `object` (and optionally its own
+# `endpoint` and `region`), merged into one list, instead of the top level `bucket` and `object`
+SOURCES_KEY = "sources"
+
+# Sources are fetched this many at a time, each request retried this many times, with these timeouts
+MAX_CONCURRENT_FETCHES = 8
+FETCH_RETRIES = 3
+FETCH_CONNECT_TIMEOUT = 10.0
+FETCH_READ_TIMEOUT = 60.0
+
+
+class BadSymbolSource(NamedTuple):
+
+    # As configured, e.g. with an "http://" prefix for a plain HTTP stand-in
+    endpoint: str
+    bucket: str
+    object: str
+    region: Optional[str]
+
+    @property
+    def name(self) -> str:
+        return f"{self.endpoint}/{self.bucket}/{self.object}"
+
+    @property
+    def secure(self) -> bool:
+        return not self.endpoint.startswith("http://")
+
+    @property
+    def host(self) -> str:
+        for prefix in ("https://", "http://"):
+            if self.endpoint.startswith(prefix):
+                return self.endpoint[len(prefix):]
+        return self.endpoint
+
+
+def fetch_bad_symbols(client, source: BadSymbolSource, etag: Optional[str]) -> Tuple[Optional[str], str]:
+    """ Downloads a source's bad symbols, returning them with the object's ETag, or None for them if the
+    object still has `etag`
+    """
+    from minio.error import S3Error
+
+    try:
+        if etag:
+            with metrics.timer("symbols.stat"):
+                stat = client.stat_object(bucket_name=source.bucket, object_name=source.object)
+            if stat.etag == etag:
+                log.info(f"Bad symbols unchanged in bucket '{source.bucket}' object '{source.object}'")
+                return None, etag
+
+        log.info(f"Comparing bad symbols with bucket '{source.bucket}' object '{source.object}'")
+        with metrics.timer("symbols.download"):
+            resp = client.get_object(bucket_name=source.bucket, object_name=source.object)
+            try:
+                return resp.read().decode('utf-8'), resp.headers.get("ETag", "").replace('"', "")
+            finally:
+                resp.close()
+                resp.release_conn()
+    except S3Error as e:
+        if e.code == "NoSuchKey":
+            raise errors.MinioObjectMissingError(f"Minio bucket '{source.bucket}' missing object '{source.object}'") from e
+        raise
+
+
+def split_source_sections(content: str) -> Dict[str, str]:
+    """ The section of a merged bad symbols list from each source, by source name """
+    from .scan import SOURCE_TAG
+
+    sections: Dict[str, List[str]] = {}
+    current: Optional[List[str]] = None
+    for line in content.splitlines(keepends=True):
+        if line.startswith(SOURCE_TAG):
+            current = sections.setdefault(line[len(SOURCE_TAG):].strip(), [])
+        elif current is not None:
+            current.append(line)
+    return {name: "".join(lines) for name, lines in sections.items()}
+
 
 class Template:
 
@@ -21,7 +112,11 @@ class Template:
         self._confirm_ownership_file = os.path.join(self._path, "managed_by_tbh")
         self._hooks_path = os.path.join(self._path, "hooks")
         self._bad_symbols_path = os.path.expanduser("~/.tbh_bad_symbols")
+        self._symbol_index_path = os.path.expanduser("~/.tbh_bad_symbols.idx")
         self._minio_config = os.path.expanduser("~/.tbh_minio_config")
+        self._scan_cache_path = os.path.expanduser("~/.tbh_scan_cache")
+        self._refresh_state_path = os.path.expanduser("~/.tbh_bad_symbols_state")
+        self._refresh_log_path = os.path.expanduser("~/.tbh_refresh.log")
 
     @property
     def minio_configuration_path(self) -> str:
@@ -35,6 +130,22 @@ class Template:
     def bad_symbols_path(self) -> str:
         return self._bad_symbols_path
 
+    @property
+    def symbol_index_path(self) -> str:
+        return self._symbol_index_path
+
+    @property
+    def scan_cache_path(self) -> str:
+        return self._scan_cache_path
+
+    @property
+    def refresh_state_path(self) -> str:
+        return self._refresh_state_path
+
+    @property
+    def refresh_log_path(self) -> str:
+        return self._refresh_log_path
+
     @property
     def can_setup(self) -> bool:
         if not os.path.exists(self._path):
@@ -105,70 +216,269 @@ class Template:
             "object": "",
             "endpoint": "",
             "ca_path": "",
+            REFRESH_TTL_KEY: DEFAULT_REFRESH_TTL,
+            SYMBOL_LINT_KEY: DEFAULT_SYMBOL_LINT,
         }
         log.info(f"Creating example MINIO configuration at '{self._minio_config}'")
         with open(self._minio_config, "w") as f:
             f.write(json.dumps(example_config, indent=4))
 
-    def update_bad_symbols(self) -> None:
-        with open(self._minio_config, "r") as f:
-            config = json.load(fp=f)
+    def _read_refresh_state(self) -> Dict[str, Any]:
+        """ ETag of the bad symbols object last downloaded, and when it was last checked """
+        try:
+            with open(self._refresh_state_path, "r") as f:
+                state = json.load(fp=f)
+        except (OSError, ValueError):
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def _write_refresh_state(self, state: Dict[str, Any]) -> None:
+        # Replaced whole, so a hook never reads a half written file
+        temporary_path = f"{self._refresh_state_path}.{os.getpid()}"
+        with open(temporary_path, "w") as f:
+            f.write(json.dumps(state, indent=4))
+        os.replace(temporary_path, self._refresh_state_path)
+
+    def refresh_in_background(self) -> bool:
+        """ Starts `tbh-utils refresh` as a detached process if the bad symbols are due a refresh, so hooks
+        keep the list fresh without ever waiting on the network. Returns whether a refresh was started.
+        """
+        try:
+            with open(self._minio_config, "r") as f:
+                ttl = float(json.load(fp=f).get(REFRESH_TTL_KEY) or 0)
+        except (OSError, ValueError, AttributeError, TypeError):
+            return False
+        if ttl <= 0:
+            return False
+
+        state = self._read_refresh_state()
+        now = time.time()
+        # A refresh that is running, or failed, is not started again until another TTL has passed
+        if now - max(state.get("checked", 0), state.get("attempted", 0)) < ttl:
+            return False
+
+        utils_path = os.path.join(Path(sys.executable).parent.absolute(), "tbh-utils")
+        if not os.path.exists(utils_path):
+            log.debug(f"Missing '{utils_path}', not refreshing bad symbols")
+            return False
+        try:
+            self._write_refresh_state(dict(state, attempted=now))
+            with open(self._refresh_log_path, "a") as refresh_log:
+                subprocess.Popen(
+                    [utils_path, "refresh"],
+                    stdin=subprocess.DEVNULL,
+                    stdout=refresh_log,
+                    stderr=subprocess.STDOUT,
+                    start_new_session=True,
+                )
+        except OSError as e:
+            log.warning(f"Unable to start refreshing bad symbols in the background ({e})")
+            return False
+        log.debug(f"Refreshing bad symbols in the background (log in '{self._refresh_log_path}')")
+        return True
 
-        def _get_val(k: str) -> str:
+    def _bad_symbol_sources(self, config: Dict[str, Any]) -> List[BadSymbolSource]:
+        """ The sources listed under `sources`, each defaulting to the top level endpoint and region, or the
+        single top level bucket and object
+        """
+
+        def _get_val(c: Dict[str, Any], k: str, where: str = "") -> str:
             try:
-                v = config[k]
-            except KeyError:
-                raise errors.MinioConfigError(f"Minio config ({self._minio_config}) missing key '{k}'") from None
+                v = c[k]
+            except (KeyError, TypeError):
+                raise errors.MinioConfigError(f"Minio config ({self._minio_config}) missing key '{where}{k}'") from None
             if not v:
-                raise errors.MinioConfigError(f"Minio config ({self._minio_config}) empty key '{k}'")
+                raise errors.MinioConfigError(f"Minio config ({self._minio_config}) empty key '{where}{k}'")
             return v
 
-        access_key = _get_val("access_key")
+        if SOURCES_KEY not in config:
+            return [BadSymbolSource(
+                endpoint=_get_val(config, "endpoint"),
+                bucket=_get_val(config, "bucket"),
+                object=_get_val(config, "object"),
+                region=config.get("region") or None,
+            )]
+        if not isinstance(config[SOURCES_KEY], list) or not config[SOURCES_KEY]:
+            raise errors.MinioConfigError(f"Minio config ({self._minio_config}) key '{SOURCES_KEY}' must be a non-empty list")
+        sources = []
+        for i, c in enumerate(config[SOURCES_KEY]):
+            where = f"{SOURCES_KEY}[{i}]."
+            sources.append(BadSymbolSource(
+                endpoint=(c.get("endpoint") if isinstance(c, dict) else None) or _get_val(config, "endpoint"),
+                bucket=_get_val(c, "bucket", where),
+                object=_get_val(c, "object", where),
+                region=(c.get("region") if isinstance(c, dict) else None) or config.get("region") or None,
+            ))
+        return sources
+
+    def update_bad_symbols(self, force: bool = False) -> None:
+        """ Downloads the bad symbols if they changed since last time
+
+        Each source's ETag is kept in the refresh state file, so checking an unchanged list costs a single
+        small `stat_object` request per source. `force` downloads them regardless. Sources are fetched
+        concurrently, over one pool of connections, and merged into one list, with a section per source. A
+        source that can't be fetched keeps its section from the last list, so the rest are still updated.
+        """
+        # Only needed here, so hooks don't pay for importing them
+        from concurrent.futures import ThreadPoolExecutor
+        from minio import Minio
+        import urllib3
+        from .scan import SOURCE_TAG
+
+        with open(self._minio_config, "r") as f:
+            config = json.load(fp=f)
+
+        sources = self._bad_symbol_sources(config)
+        try:
+            access_key = config["access_key"]
+        except KeyError:
+            raise errors.MinioConfigError(f"Minio config ({self._minio_config}) missing key 'access_key'") from None
+        if not access_key:
+            raise errors.MinioConfigError(f"Minio config ({self._minio_config}) empty key 'access_key'")
         secret_key = Crypto().minio_secret_key
-        bucket = _get_val("bucket")
-        object = _get_val("object")
-        endpoint = _get_val("endpoint")
- 
-        # Minio doesn't use protocol prefixes
-        if endpoint.startswith("https://"):
-            endpoint = endpoint[len("https://"):]
-
-        ca_path = os.path.expanduser(_get_val("ca_path"))
-
-        if not os.path.exists(ca_path):
-            raise errors.MinioConfigError(f"Minio config ({self._minio_config}) points to bad CA path '{ca_path}'")
-
-        log.info(f"Connecting to MINIO server {endpoint}")
-        http_client = urllib3.PoolManager(cert_reqs="CERT_REQUIRED", ca_certs=ca_path)
-        c = Minio(
-            endpoint,
-            access_key=access_key,
-            secret_key=secret_key,
-            http_client=http_client,
+
+        # One pool of connections for every source, retrying failed requests (and server errors) with backoff
+        pool_options: Dict[str, Any] = dict(
+            num_pools=len(sources),
+            maxsize=min(len(sources), MAX_CONCURRENT_FETCHES),
+            timeout=urllib3.Timeout(connect=FETCH_CONNECT_TIMEOUT, read=FETCH_READ_TIMEOUT),
+            retries=urllib3.Retry(total=FETCH_RETRIES, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504]),
         )
-        log.info(f"Comparing bad symbols with bucket '{bucket}' object '{object}'")
-        try:
-            resp = c.get_object(
-                bucket_name=bucket,
-                object_name=object,
-            )
-            file_content = resp.read().decode('utf-8')
-        except S3Error as e:
-            if e.code == "NoSuchKey":
-                raise errors.MinioObjectMissingError(f"Minio bucket '{bucket}' missing object '{object}'") from e
-            raise
+        # Minio doesn't use protocol prefixes. Plain HTTP is only for local stand-ins, e.g. when testing.
+        if any(source.secure for source in sources):
+            if not config.get("ca_path"):
+                raise errors.MinioConfigError(f"Minio config ({self._minio_config}) missing key 'ca_path'")
+            ca_path = os.path.expanduser(config["ca_path"])
+            if not os.path.exists(ca_path):
+                raise errors.MinioConfigError(f"Minio config ({self._minio_config}) points to bad CA path '{ca_path}'")
+            pool_options.update(cert_reqs="CERT_REQUIRED", ca_certs=ca_path)
+        http_client = urllib3.PoolManager(**pool_options)
+
+        clients = {}
+        for source in sources:
+            if (source.endpoint, source.region) not in clients:
+                log.info(f"Connecting to MINIO server {source.host}")
+                clients[(source.endpoint, source.region)] = Minio(
+                    source.host,
+                    access_key=access_key,
+                    secret_key=secret_key,
+                    secure=source.secure,
+                    # Optional, but saves looking up the bucket's region before every request
+                    region=source.region,
+                    http_client=http_client,
+                )
 
         old_file_content = None
         if os.path.exists(self._bad_symbols_path):
             with open(self._bad_symbols_path, "r") as f:
                 old_file_content = Crypto().decrypt(f.read())
+        state = self._read_refresh_state()
+        etags = dict(state.get("sources") or {})
+        old_sections = split_source_sections(old_file_content or "")
+        if old_file_content is not None and not old_sections and state.get("source") and state.get("etag"):
+            # Written before lists had a section per source
+            etags[state["source"]] = state["etag"]
+            old_sections[state["source"]] = old_file_content
+
+        def _fetch(source: BadSymbolSource) -> Tuple[Optional[str], str]:
+            # Only a source whose section is still at hand can be left as it is
+            etag = None if force or source.name not in old_sections else etags.get(source.name)
+            return fetch_bad_symbols(clients[(source.endpoint, source.region)], source, etag)
+
+        with ThreadPoolExecutor(max_workers=min(len(sources), MAX_CONCURRENT_FETCHES)) as executor:
+            futures = [executor.submit(_fetch, source) for source in sources]
+            fetched: List[Optional[Tuple[Optional[str], str]]] = []
+            failures: List[Tuple[BadSymbolSource, Exception]] = []
+            for source, future in zip(sources, futures):
+                try:
+                    fetched.append(future.result())
+                except Exception as e:
+                    log.warning(f"Unable to fetch bad symbols from '{source.name}' ({e})")
+                    failures.append((source, e))
+                    fetched.append(None)
+        if len(failures) == len(sources):
+            raise failures[0][1]
+
+        unchanged = set(old_sections) == {source.name for source in sources}
+        if not failures and unchanged and all(f[0] is None for f in fetched):
+            log.info("Bad symbols unchanged in every source")
+            self._write_refresh_state(dict(state, checked=time.time()))
+            return
+
+        sections = []
+        new_etags = {}
+        for source, result in zip(sources, fetched):
+            if result is None or result[0] is None:
+                if source.name not in old_sections:
+                    log.warning(f"No earlier bad symbols from '{source.name}' to keep")
+                    continue
+                content = old_sections[source.name]
+                if source.name in etags:
+                    new_etags[source.name] = etags[source.name]
+            else:
+                content, new_etags[source.name] = result
+            sections.append(f"{SOURCE_TAG} {source.name}\n{content.rstrip()}\n")
+        file_content = "".join(sections)
 
         if old_file_content is None or old_file_content != file_content:
+            from .scan import parse_scoped_bad_symbols, symbols_digest
+            from .cache import ScanCache
+            from .symbol_index import SymbolIndex, source_digest, write_sidecar
+            symbols, scopes = parse_scoped_bad_symbols(file_content)
+
+            lint_action = config.get(SYMBOL_LINT_KEY) or DEFAULT_SYMBOL_LINT
+            if lint_action not in SYMBOL_LINT_ACTIONS:
+                raise errors.MinioConfigError(
+                    f"Minio config ({self._minio_config}) key '{SYMBOL_LINT_KEY}' must be one of {', '.join(SYMBOL_LINT_ACTIONS)}"
+                )
+            if lint_action != SYMBOL_LINT_OFF:
+                self._lint_bad_symbols(symbols, refuse=lint_action == SYMBOL_LINT_REFUSE, state=state)
+
             action = "Creating" if old_file_content is None else "Updating"
             log.info(f"{action} bad symbols file '{self._bad_symbols_path}'")
 
+            ciphertext = Crypto().encrypt(file_content)
             with open(self._bad_symbols_path, "w") as f:
-                f.write(Crypto().encrypt(file_content))
+                f.write(ciphertext)
+
+            # Built now, so hooks don't have to
+            log.info(f"Building symbol index '{self._symbol_index_path}'")
+            write_sidecar(
+                self._symbol_index_path,
+                source_digest(ciphertext.encode('ascii')),
+                SymbolIndex.build(symbols, scopes),
+            )
+
+            # Results cached against the old list no longer say anything useful
+            ScanCache(
+                path=self._scan_cache_path,
+                digest=symbols_digest(symbols, scopes),
+            ).purge_stale()
+
+        self._write_refresh_state(dict(
+            {k: v for k, v in state.items() if k not in ("source", "etag")},
+            sources=new_etags,
+            checked=time.time(),
+        ))
+        if failures:
+            raise errors.BadSymbolSourcesError(
+                f"Failed to fetch {len(failures)} of {len(sources)} bad symbol source(s), kept their earlier symbols: "
+                f"{', '.join(source.name for source, _ in failures)}"
+            )
+
+    def _lint_bad_symbols(self, symbols, refuse: bool, state: Dict[str, Any]) -> None:
+        from .lint import lint_symbols
+
+        log.info("Checking bad symbol regexes for catastrophic backtracking")
+        problems = [result for result in lint_symbols(symbols) if not result.ok]
+        for result in problems:
+            log.warning(f"Bad symbol '{result.symbol}' {result.problem}")
+        if problems and refuse:
+            # Checked, so hooks don't download the same list again until the TTL passes
+            self._write_refresh_state(dict(state, checked=time.time()))
+            raise errors.BadSymbolsLintError(
+                f"Refusing a bad symbols list with {len(problems)} problem regex(es), keeping the current list"
+            )
 
     def _setup_git_global_template_configuration(self) -> None:
         try:
@@ -0,0 +1,69 @@
+import os
+import stat
+import socket
+import struct
+import logging
+import socketserver
+from typing import Optional
+
+
+log = logging.getLogger(__name__)
+
+
+def peer_uid(connection: socket.socket) -> Optional[int]:
+    """ User id of the process at the other end of a Unix socket connection, where the platform tells us """
+    # Linux only; elsewhere the socket's permissions are all that keeps other users out
+    if not hasattr(socket, "SO_PEERCRED"):
+        return None
+    credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", credentials)
+    return uid
+
+
+def is_private_socket(path: str) -> bool:
+    """ True if `path` is a socket of the current user's, which no other user can connect to (or have put
+    there for us to find)
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        log.debug(f"Ignoring socket '{path}' with unexpected owner or permissions")
+        return False
+    return True
+
+
+def connect(path: str, timeout: float) -> Optional[socket.socket]:
+    """ Connects to a private socket, returning None if there is nothing usable listening on it """
+    if not is_private_socket(path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+    except OSError as e:
+        log.debug(f"Nothing listening on '{path}' ({e})")
+        client.close()
+        return None
+    return client
+
+
+class PrivateUnixStreamServer(socketserver.UnixStreamServer):
+    """ Listens on a socket created without any access for group or others, and only serves requests from
+    processes of the current user
+    """
+
+    def server_bind(self) -> None:
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+
+    def verify_request(self, request: socket.socket, client_address) -> bool:
+        uid = peer_uid(request)
+        if uid is not None and uid != os.getuid():
+            log.warning(f"Refusing connection from uid {uid}")
+            return False
+        return True
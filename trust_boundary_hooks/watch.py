@@ -0,0 +1,307 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+import subprocess
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+from . import errors
+from . import metrics
+from .cache import ScanCache
+from .ops import scan_file
+from .scan import Scanner
+from .template import Template
+
+
+log = logging.getLogger(__name__)
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_ONLYDIR
+
+# Changes are scanned once no more have arrived for this many seconds, so a burst of saves (e.g. a checkout
+# or a build) is scanned as one batch
+SETTLE_SECONDS = 0.5
+
+# Seconds between checks of the bad symbols file for changes
+RELOAD_INTERVAL = 5.0
+
+# Seconds between listings of the changed files, where there is no inotify to follow changes with
+POLL_INTERVAL = 2.0
+
+# Files larger than this are left for the hooks to scan
+MAX_FILE_SIZE = 64 * 1024 * 1024
+
+_EVENT = struct.Struct("iIII")
+
+
+class InotifyEvent(NamedTuple):
+
+    wd: int
+    mask: int
+    name: str
+
+
+class Inotify:
+    """ A minimal inotify(7) binding, through the C library """
+
+    def __init__(self) -> None:
+        libc_name = ctypes.util.find_library("c")
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            raise errors.WatchUnavailableError(f"inotify is not available on this platform ({e})")
+        if fd < 0:
+            raise errors.WatchUnavailableError(f"Unable to start inotify ({os.strerror(ctypes.get_errno())})")
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._fd = fd
+
+    def add_watch(self, path: str, mask: int) -> int:
+        wd = self._add_watch(self._fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def read(self, timeout: Optional[float]) -> List[InotifyEvent]:
+        """ Events queued so far, waiting up to `timeout` seconds (forever for None) for the first """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append(InotifyEvent(wd=wd, mask=mask, name=os.fsdecode(name)))
+        return events
+
+    def close(self) -> None:
+        os.close(self._fd)
+
+
+def _changed_files(root: str) -> List[str]:
+    """ Files in the working tree which differ from the index, or are untracked and not ignored """
+    output = subprocess.check_output(
+        ["git", "ls-files", "-z", "--modified", "--others", "--exclude-standard"], cwd=root
+    ).decode('utf-8')
+    return sorted({os.path.join(root, f) for f in output.split("\0") if f})
+
+
+def _ignored_directories(root: str) -> Set[str]:
+    """ Directories git ignores whole (e.g. build output), which are not watched """
+    output = subprocess.check_output(
+        ["git", "ls-files", "-z", "--others", "--ignored", "--exclude-standard", "--directory"], cwd=root
+    ).decode('utf-8')
+    return {os.path.join(root, f.rstrip("/")) for f in output.split("\0") if f.endswith("/")}
+
+
+def _ignored(root: str, paths: List[str]) -> Set[str]:
+    if not paths:
+        return set()
+    proc = subprocess.run(
+        ["git", "check-ignore", "-z", "--stdin"],
+        cwd=root,
+        input="\0".join(paths).encode('utf-8'),
+        stdout=subprocess.PIPE,
+    )
+    return {p for p in proc.stdout.decode('utf-8').split("\0") if p}
+
+
+class Watcher:
+    """ Follows changes to a repository's working tree, scanning each changed file soon after it is saved
+
+    Changes are followed with inotify, or where it isn't available by listing the files git sees changed
+    every few seconds, and comparing their stat data with the last listing's. Files found clean are recorded in the scan cache by their content's git blob id, so when that content is
+    staged the pre-commit hook finds it already scanned and only searches what is left. Nothing else is
+    recorded: files with detections are reported here, and scanned again, in full, by the hook.
+    """
+
+    def __init__(self, root: str) -> None:
+        self._root = os.path.abspath(root)
+        self._git_dir = os.path.realpath(
+            subprocess.check_output(["git", "rev-parse", "--absolute-git-dir"], cwd=self._root).decode('utf-8').strip()
+        )
+        try:
+            self._inotify: Optional[Inotify] = Inotify()
+        except errors.WatchUnavailableError as e:
+            log.warning(f"{e}, looking for changes every {POLL_INTERVAL:g} second(s) instead")
+            self._inotify = None
+        self._directories: Dict[int, str] = {}
+        self._ignored_directories: Set[str] = set()
+        self._scanner: Optional[Scanner] = None
+        self._cache: Optional[ScanCache] = None
+        self._bad_symbols_stat: Optional[Tuple[int, int, int]] = None
+        self._watch_limit_reached = False
+
+    def _load(self) -> None:
+        """ Loads the bad symbols again if their file has changed, as results are kept per symbol list """
+        st = os.stat(Template().bad_symbols_path)
+        bad_symbols_stat = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if bad_symbols_stat == self._bad_symbols_stat:
+            return
+        self._scanner = Scanner()
+        if self._cache is not None:
+            self._cache.close()
+        self._cache = ScanCache(path=Template().scan_cache_path, digest=self._scanner.digest)
+        self._bad_symbols_stat = bad_symbols_stat
+        log.info(f"Loaded {len(self._scanner.index.symbols)} bad symbol(s)")
+
+    def _watch_tree(self, top: str) -> List[str]:
+        """ Watches a directory and every directory under it, returning the files found """
+        files = []
+        for directory, dirs, names in os.walk(top):
+            if os.path.realpath(directory) == self._git_dir:
+                dirs.clear()
+                continue
+            dirs[:] = [d for d in dirs if d != ".git" and os.path.join(directory, d) not in self._ignored_directories]
+            try:
+                wd = self._inotify.add_watch(directory, WATCH_MASK)
+            except OSError as e:
+                if e.errno == errno.ENOSPC and not self._watch_limit_reached:
+                    self._watch_limit_reached = True
+                    log.warning(
+                        "Out of inotify watches, some directories are not watched (raise "
+                        "fs.inotify.max_user_watches to watch them all)"
+                    )
+                elif e.errno != errno.ENOSPC:
+                    log.debug(f"Unable to watch '{directory}' ({e})")
+                continue
+            self._directories[wd] = directory
+            files.extend(os.path.join(directory, n) for n in names)
+        return files
+
+    def _changes(self, events: Iterable[InotifyEvent]) -> Set[str]:
+        changed = set()
+        for event in events:
+            if event.mask & IN_Q_OVERFLOW:
+                log.info("Missed some changes, scanning every changed file")
+                changed.update(_changed_files(self._root))
+                continue
+            if event.mask & IN_IGNORED:
+                self._directories.pop(event.wd, None)
+                continue
+            directory = self._directories.get(event.wd)
+            if directory is None or not event.name:
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & IN_ISDIR:
+                if event.mask & (IN_CREATE | IN_MOVED_TO) and event.name != ".git":
+                    relative = os.path.relpath(path, self._root)
+                    if relative in _ignored(self._root, [relative]):
+                        self._ignored_directories.add(path)
+                    else:
+                        changed.update(self._watch_tree(path))
+            elif event.mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                changed.add(path)
+        return changed
+
+    def scan(self, paths: Iterable[str]) -> None:
+        """ Scans the files, recording those found clean """
+        self._load()
+        candidates = []
+        for path in sorted(paths):
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            # Symbolic links are stored by git as their target's name, which the hook scans anyway
+            if os.path.isfile(path) and not os.path.islink(path) and st.st_size <= MAX_FILE_SIZE:
+                candidates.append(os.path.relpath(path, self._root))
+        ignored = _ignored(self._root, candidates)
+        clean = []
+        for path in candidates:
+            if path in ignored:
+                continue
+            metrics.count("watch.files")
+            try:
+                result = scan_file(self._scanner, self._cache, os.path.join(self._root, path))
+            except OSError as e:
+                log.debug(f"Unable to scan '{path}' ({e})")
+                continue
+            if result.clean:
+                clean.append(result.blob)
+            elif result.content_detections:
+                matches = sorted({d.match for d in result.content_detections})
+                log.warning(f"Bad symbol(s) in '{path}': {', '.join(repr(m) for m in matches)}")
+        self._cache.mark_clean(clean)
+        log.debug(f"Scanned {len(candidates) - len(ignored)} changed file(s), {len(clean)} clean")
+
+    def _poll(self, stats: Dict[str, Tuple[int, int, int]]) -> Set[str]:
+        """ Changed files whose stat data differs from that in `stats`, which is updated to match """
+        changed = set()
+        current = {}
+        for path in _changed_files(self._root):
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            current[path] = (st.st_mtime_ns, st.st_size, st.st_ino)
+            if stats.get(path) != current[path]:
+                changed.add(path)
+        stats.clear()
+        stats.update(current)
+        return changed
+
+    def _watch_by_polling(self) -> None:
+        stats: Dict[str, Tuple[int, int, int]] = {}
+        self.scan(self._poll(stats))
+        try:
+            while True:
+                time.sleep(POLL_INTERVAL)
+                changed = self._poll(stats)
+                if changed:
+                    self.scan(changed)
+                else:
+                    self._load()
+        finally:
+            if self._cache is not None:
+                self._cache.close()
+
+    def watch(self) -> None:
+        """ Scans the files already changed, then each file as it changes, until interrupted """
+        if self._inotify is None:
+            self._watch_by_polling()
+            return
+        self._ignored_directories = _ignored_directories(self._root)
+        self._watch_tree(self._root)
+        log.info(f"Watching {len(self._directories)} directories under '{self._root}'")
+        self.scan(_changed_files(self._root))
+
+        pending: Set[str] = set()
+        try:
+            while True:
+                events = self._inotify.read(SETTLE_SECONDS if pending else RELOAD_INTERVAL)
+                if events:
+                    pending.update(self._changes(events))
+                elif pending:
+                    self.scan(pending)
+                    pending.clear()
+                else:
+                    # Idle, so pick up a refreshed bad symbols list before the next change arrives
+                    self._load()
+        finally:
+            self._inotify.close()
+            if self._cache is not None:
+                self._cache.close()